@@ -0,0 +1,72 @@
+# Benchmark for client-side key handling
+#
+# Per-message cost of wrapping and unwrapping AES keys and of fingerprinting a
+# client list, re-importing keys every time (before) versus using the keys and
+# fingerprints cached by the client (after).
+#
+# Usage: python3 bench_client_keys.py
+
+import base64
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+
+from client import Client, fingerprint
+
+REPEAT = 200
+LIST_SIZE = 500
+
+
+def per_call_us(function, repeat=REPEAT):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    client = Client("ws://localhost:8765")
+    recipient = Client("ws://localhost:8765")
+    recipient_pem = recipient.public_key_pem.decode('utf-8')
+
+    _, wrapped_key = client.encrypt_aes_key(recipient_pem)
+    list_keys = [Client("ws://localhost:8765").public_key_pem.decode('utf-8') for _ in range(10)] * (LIST_SIZE // 10)
+
+    # Old code paths (import the key on every call)
+    def wrap_before():
+        cipher = PKCS1_OAEP.new(RSA.import_key(recipient_pem.encode('utf-8')))
+        cipher.encrypt(os.urandom(32))
+
+    def unwrap_before():
+        cipher = PKCS1_OAEP.new(RSA.import_key(recipient.private_key_pem))
+        cipher.decrypt(base64.b64decode(wrapped_key))
+
+    def fingerprint_before():
+        for public_key in list_keys:
+            hashlib.sha256(base64.b64encode(public_key.encode('utf-8'))).hexdigest()
+
+    # Cached paths
+    def wrap_after():
+        client.encrypt_aes_key(recipient_pem)
+
+    def unwrap_after():
+        recipient.decrypt_aes_key(wrapped_key)
+
+    def fingerprint_after():
+        for public_key in list_keys:
+            fingerprint(public_key)
+
+    print(f"{'operation':>22} {'before (us)':>12} {'after (us)':>11}")
+    print(f"{'wrap AES key':>22} {per_call_us(wrap_before):>12.1f} {per_call_us(wrap_after):>11.1f}")
+    print(f"{'unwrap AES key':>22} {per_call_us(unwrap_before):>12.1f} {per_call_us(unwrap_after):>11.1f}")
+    print(f"{f'fingerprint {LIST_SIZE} keys':>22} {per_call_us(fingerprint_before, 20):>12.1f} {per_call_us(fingerprint_after, 20):>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
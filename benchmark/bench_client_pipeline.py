@@ -0,0 +1,89 @@
+# Benchmark for pipelined client sends
+#
+# Sends private chat messages from one client, awaiting each send before the
+# next (one at a time) or starting them all and awaiting them together
+# (pipelined), with encryption and signing done inline on the event loop or in
+# a thread or process pool. Measures messages/s and the longest time the event
+# loop was blocked (how long incoming messages would wait to be read).
+#
+# Usage: python3 bench_client_pipeline.py [messages] [workers]
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+
+from client import Client
+from signer import SigningPool
+
+
+# Stand-in for the server connection
+class CountingWebSocket:
+    def __init__(self):
+        self.frames = 0
+        self.open = True
+
+    async def send(self, frame):
+        self.frames += 1
+
+    async def close(self):
+        self.open = False
+
+
+# Longest gap between event loop iterations while the benchmark runs
+async def measure_lag(stop, result):
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        result[0] = max(result[0], now - last - 0.001)
+        last = now
+
+
+async def run(mode, pipelined, messages, workers, recipient):
+    pool = SigningPool(mode, workers)
+    sender = Client("ws://localhost:8765", private_key=recipient.private_key, signing_pool=pool)
+    sender.websocket = CountingWebSocket()
+    sender.clients = {recipient.client_id: {"public_key": recipient.public_key_pem.decode('utf-8')}}
+
+    # Warm up (starts the workers and parses the keys in them)
+    await asyncio.gather(*(sender.send_chat("warm up", recipient.client_id) for _ in range(workers or 1)))
+
+    stop = asyncio.Event()
+    lag = [0.0]
+    lag_task = asyncio.ensure_future(measure_lag(stop, lag))
+    await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    if pipelined:
+        await asyncio.gather(*(sender.send_chat(f"message {i}", recipient.client_id) for i in range(messages)))
+    else:
+        for i in range(messages):
+            await sender.send_chat(f"message {i}", recipient.client_id)
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await lag_task
+    await sender.close()
+    pool.close()
+    return messages / elapsed, lag[0]
+
+
+async def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+    recipient = Client("ws://localhost:8765")
+
+    print(f"{messages} private chat messages, {workers} worker(s)")
+    print(f"{'mode':>22} {'messages/s':>11} {'max loop lag (ms)':>18}")
+    for mode, pipelined in (("inline", False), ("inline", True), ("thread", True), ("process", True)):
+        name = f"{mode} {'pipelined' if pipelined else 'one at a time'}"
+        rate, lag = await run(mode, pipelined, messages, workers, recipient)
+        print(f"{name:>22} {rate:>11.1f} {lag * 1000:>18.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
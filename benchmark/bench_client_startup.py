@@ -0,0 +1,65 @@
+# Benchmark for client startup
+#
+# Time to create a client and have its identity ready (client ID and hello
+# message signed): generating a new key pair (the old behaviour), loading a
+# stored identity (plain and password-encrypted) and taking a key from a
+# pre-generated key pool.
+#
+# Usage: python3 bench_client_startup.py [clients]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+
+from client import Client
+from keystore import KeyPool, KeyStore
+
+URI = "ws://localhost:8765"
+
+
+# Create a client and make it ready to send its hello
+def start_client(*args, **kwargs):
+    client = Client(URI, *args, **kwargs)
+    client.generate_signed_data({"type": "hello", "public_key": client.public_key_pem.decode('utf-8')})
+    return client
+
+
+def average_ms(function, count):
+    start = time.perf_counter()
+    for i in range(count):
+        function(i)
+    return (time.perf_counter() - start) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    with tempfile.TemporaryDirectory() as directory:
+        plain = KeyStore(os.path.join(directory, "plain.pem"))
+        encrypted = KeyStore(os.path.join(directory, "encrypted.pem"), "benchmark password")
+        plain.load_or_create()
+        encrypted.load_or_create()
+
+        pool = KeyPool(os.path.join(directory, "pool"))
+        pool.fill(count)
+
+        results = [
+            ("generate key pair", average_ms(lambda i: start_client(), count)),
+            ("stored identity", average_ms(lambda i: start_client(plain), count)),
+            ("encrypted identity", average_ms(lambda i: start_client(encrypted), count)),
+            ("key pool (load)", average_ms(lambda i: start_client(private_key=pool.load(1, i)[0]), count)),
+        ]
+
+        keys = pool.load(count)
+        results.append(("key pool (preloaded)", average_ms(lambda i: start_client(private_key=keys[i]), count)))
+
+    print(f"Average client startup over {count} clients")
+    for name, ms in results:
+        print(f"{name:>22}: {ms:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
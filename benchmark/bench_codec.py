@@ -0,0 +1,71 @@
+# Benchmark for the message codec
+#
+# Compares the per-message cost of the old relay path (json.loads, json.dumps of
+# the data to rebuild the signed bytes, json.dumps of the message to forward)
+# with the codec path (one parse, signed bytes sliced from the frame, original
+# frame forwarded), for different message sizes.
+#
+# Usage: python3 bench_codec.py
+
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import codec
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+SIZES = [100, 1000, 10000, 100000]
+
+PSS = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+
+
+def time_per_call(function, frame, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(frame)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_key = private_key.public_key()
+
+    def sign(data_c):
+        return private_key.sign(data_c, PSS, hashes.SHA256())
+
+    print(f"JSON backend: {'orjson' if codec.orjson else 'json'} (times in microseconds per message)")
+    print(f"{'size':>7} {'parse old':>10} {'parse new':>10} {'signed old':>11} {'signed new':>11} "
+          f"{'fwd old':>8} {'fwd new':>8} {'verify':>8}")
+
+    for size in SIZES:
+        data = {"type": "public_chat", "sender": "f" * 64, "message": "x" * size}
+        frame = codec.encode_signed_data(data, 1, sign)
+        message = json.loads(frame)
+        repeat = max(20, 200000 // size)
+
+        parse_old = time_per_call(json.loads, frame, repeat)
+        parse_new = time_per_call(codec.loads, frame, repeat)
+
+        signed_old = time_per_call(lambda f: bytes(json.dumps(message["data"]) + str(message["counter"]), 'utf-8'), frame, repeat)
+        signed_new = time_per_call(lambda f: codec.signed_bytes(f, message), frame, repeat)
+
+        forward_old = time_per_call(lambda f: json.dumps(message), frame, repeat)
+        forward_new = 0.0
+
+        data_c = codec.signed_bytes(frame, message)
+        signature = base64.b64decode(message["signature"])
+        verify = time_per_call(lambda f: public_key.verify(signature, data_c, PSS, hashes.SHA256()), frame, 50)
+
+        print(f"{size:>7} {parse_old:>10.2f} {parse_new:>10.2f} {signed_old:>11.2f} {signed_new:>11.2f} "
+              f"{forward_old:>8.2f} {forward_new:>8.2f} {verify:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
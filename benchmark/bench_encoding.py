@@ -0,0 +1,123 @@
+# Benchmark for the wire encodings and permessage-deflate settings
+#
+# Bytes on the wire and CPU time per message for JSON (base64 fields) and the
+# binary msgpack encoding (raw byte fields), each without compression and
+# with permessage-deflate at a few zlib levels. CPU time is split into the
+# sender building the frame (without the RSA work, which is the same for both
+# encodings), the server parsing it and finding the signed bytes, the
+# recipient decoding its fields, and compressing and decompressing it.
+#
+# Usage: python3 bench_encoding.py [messages]
+
+import os
+import secrets
+import sys
+import time
+import zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+sys.path.insert(0, os.path.join(ROOT, "common"))
+
+import codec
+import signer
+
+# (name, recipients, message length)
+MESSAGES = [
+    ("chat, 100 chars", 1, 100),
+    ("chat, 1000 chars", 1, 1000),
+    ("group of 5, 100 chars", 5, 100),
+]
+
+# (name, zlib level or None for no compression)
+DEFLATE = [("off", None), ("level 1", 1), ("level 6", 6)]
+
+# Server's default permessage-deflate window and memory level (see config.py)
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+
+SENDER = "a" * 64
+
+
+def per_message_us(function, items):
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+# Build a chat frame like signer.chat_frame, with random bytes in place of the
+# RSA results (wrapped keys and signature, which are just as incompressible)
+def chat_frame(encoding, recipients, text, counter):
+    aes_key = secrets.token_bytes(32)
+    data = {
+        "type": "chat",
+        "sender": SENDER,
+        "recipients": [f"{i:064x}" for i in range(recipients)],
+        "aes_keys": [codec.encode_bytes(secrets.token_bytes(256), encoding) for _ in range(recipients)],
+        "message": signer.aes_encrypt_message(aes_key, text, encoding),
+    }
+    return codec.encode_signed_data(data, counter, lambda _: secrets.token_bytes(256), encoding)
+
+
+# Server side: parse the frame and get the bytes to verify
+def relay(frame):
+    message = codec.loads(frame)
+    codec.signed_bytes(frame, message)
+
+
+# Recipient side: parse the frame and decode the byte fields it needs
+def receive(frame):
+    data = codec.loads(frame)["data"]
+    codec.decode_bytes(data["aes_keys"][0])
+    for field in ("ciphertext", "nonce", "tag"):
+        codec.decode_bytes(data["message"][field])
+
+
+# permessage-deflate: one compressor per connection (context kept between messages),
+# each message flushed and the 4 byte sync marker left off
+def deflate_all(frames, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL)
+    decompressor = zlib.decompressobj(-WINDOW_BITS)
+    payloads = [frame.encode('utf-8') if isinstance(frame, str) else frame for frame in frames]
+
+    start = time.perf_counter()
+    compressed = [(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4] for payload in payloads]
+    compress_us = (time.perf_counter() - start) / len(frames) * 1e6
+
+    start = time.perf_counter()
+    for payload in compressed:
+        decompressor.decompress(payload + b"\x00\x00\xff\xff")
+    decompress_us = (time.perf_counter() - start) / len(frames) * 1e6
+
+    return sum(len(payload) for payload in compressed) / len(frames), compress_us, decompress_us
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    encodings = codec.available_encodings()
+    if "msgpack" not in encodings:
+        print("msgpack is not installed, only JSON is measured")
+
+    print(f"{'message':>22} {'encoding':>8} {'deflate':>8} {'bytes':>7} {'encode us':>10} {'relay us':>9} {'receive us':>11} {'deflate us':>11} {'inflate us':>11}")
+    for name, recipients, length in MESSAGES:
+        text = "x" * length
+        for encoding in encodings:
+            frames = [chat_frame(encoding, recipients, text, i) for i in range(messages)]
+
+            encode_us = per_message_us(lambda i: chat_frame(encoding, recipients, text, i), range(messages))
+            relay_us = per_message_us(relay, frames)
+            receive_us = per_message_us(receive, frames)
+
+            for deflate_name, level in DEFLATE:
+                if level is None:
+                    size = sum(len(frame) for frame in frames) / messages
+                    compress_us = decompress_us = 0.0
+                else:
+                    size, compress_us, decompress_us = deflate_all(frames, level)
+
+                print(f"{name:>22} {encoding:>8} {deflate_name:>8} {size:>7.0f} {encode_us:>10.2f} {relay_us:>9.2f} {receive_us:>11.2f} {compress_us:>11.2f} {decompress_us:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
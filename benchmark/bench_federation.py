@@ -0,0 +1,58 @@
+# Multi-node benchmark for neighbourhood federation
+#
+# Starts several server processes on localhost, all in one neighbourhood,
+# connects clients to each of them and measures cross-server delivery
+# throughput for public chats and private chats.
+#
+# Usage: python3 bench_federation.py [servers] [clients per server] [messages per client]
+
+import asyncio
+import sys
+
+from benchclient import BenchClient, connect_clients, run_scenario, start_server
+
+BASE_PORT = 9100
+
+
+async def main():
+    server_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    per_server = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    uris = [f"ws://localhost:{BASE_PORT + i}" for i in range(server_count)]
+    processes = [start_server(BASE_PORT + i, *uris) for i in range(server_count)]
+    try:
+        # Give the servers time to start and link up
+        await asyncio.sleep(2 + server_count * 0.5)
+
+        clients = [BenchClient(uri) for uri in uris for _ in range(per_server)]
+        await connect_clients(clients)
+        total = len(clients)
+
+        print(f"{server_count} servers, {total} clients, {messages} messages per client")
+
+        # Every client broadcasts; every other client receives each message once
+        async def send_public(client):
+            for i in range(messages):
+                await client.send_public(f"public {i}")
+
+        await run_scenario("public_chat", clients, send_public, lambda client: (total - 1) * messages)
+
+        # Every client sends private chats to a client on the next server
+        peers = {client: clients[(i + per_server) % total] for i, client in enumerate(clients)}
+
+        async def send_private(client):
+            for i in range(messages):
+                await client.send_chat(f"private {i}", peers[client].client_id)
+
+        await run_scenario("chat", clients, send_private, lambda client: messages)
+
+        for client in clients:
+            await client.websocket.close()
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
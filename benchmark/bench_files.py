@@ -0,0 +1,96 @@
+# Benchmark for file upload and download
+#
+# Uploads a large file to a server, uploads it again (stored once, see
+# files.py) and downloads it, reporting throughput and the server's CPU time
+# and peak memory for each step. Memory should not grow with the file size:
+# uploads are streamed to disk in chunks and downloads use sendfile.
+#
+# Usage: python3 bench_files.py [file size in MB]
+
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+import transfer
+from files import issue_token
+from resumption import load_ticket_key
+from server import Server
+from workers import run_worker
+
+PORT = 9700
+FILE_PORT = 9701
+
+
+# Server process CPU time (seconds) and peak resident memory (MB)
+def process_usage(pid):
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    with open(f"/proc/{pid}/status") as file:
+        peak = next(int(line.split()[1]) for line in file if line.startswith("VmHWM:"))
+    return cpu, peak / 1024
+
+
+# Run a transfer, returning (seconds, server CPU seconds, server peak RSS MB)
+def measure(pid, coroutine):
+    cpu_before, _ = process_usage(pid)
+    start = time.perf_counter()
+    result = asyncio.run(coroutine)
+    elapsed = time.perf_counter() - start
+    cpu_after, peak = process_usage(pid)
+    return result, elapsed, cpu_after - cpu_before, peak
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    directory = tempfile.mkdtemp(prefix="olaf-bench-files-")
+    path = os.path.join(directory, "upload.bin")
+    download_path = os.path.join(directory, "download.bin")
+
+    # Random content (incompressible, and a new hash every run)
+    with open(path, "wb") as file:
+        for _ in range(size_mb):
+            file.write(os.urandom(1 << 20))
+
+    key_file = os.path.join(directory, "resumption.key")
+    config = {"file_port": FILE_PORT, "file_dir": os.path.join(directory, "files"), "log_level": "ERROR", "offline_dir": None,
+              "ticket_key_file": key_file, "ticket_store_file": os.path.join(directory, "resumption.db")}
+    process = multiprocessing.Process(target=run_worker, args=(Server, "localhost", PORT, config), daemon=True)
+    process.start()
+    try:
+        time.sleep(1.5)
+        _, _, _, idle_peak = measure(process.pid, asyncio.sleep(0))
+        upload_url = f"http://localhost:{FILE_PORT}/api/upload"
+        token = issue_token(load_ticket_key(key_file), "0" * 64, 3600)
+
+        print(f"{size_mb} MB file, server peak RSS at start {idle_peak:.1f} MB")
+        print(f"{'step':>18} {'MB/s':>8} {'server CPU s':>13} {'server peak RSS MB':>19}")
+
+        file_url, elapsed, cpu, peak = measure(process.pid, transfer.upload(upload_url, path, token))
+        print(f"{'upload':>18} {size_mb / elapsed:>8.0f} {cpu:>13.2f} {peak:>19.1f}")
+
+        _, elapsed, cpu, peak = measure(process.pid, transfer.upload(upload_url, path, token))
+        print(f"{'upload (dedup)':>18} {size_mb / elapsed:>8.0f} {cpu:>13.2f} {peak:>19.1f}")
+
+        _, elapsed, cpu, peak = measure(process.pid, transfer.download(file_url, download_path))
+        print(f"{'download':>18} {size_mb / elapsed:>8.0f} {cpu:>13.2f} {peak:>19.1f}")
+
+        stored = os.listdir(config["file_dir"])
+        print(f"Files stored: {len(stored)}")
+    finally:
+        process.terminate()
+        process.join()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
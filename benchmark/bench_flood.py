@@ -0,0 +1,196 @@
+# Benchmark for per-connection limits under a flood
+#
+# Well-behaved clients each send a chat to themselves every 100 ms and measure
+# how long it takes to come back, while flooding clients send public chats
+# with bad (but well-formed) signatures as fast as they can, each costing the
+# server an RSA verification. Runs without a flood, then with a flood against
+# a server without limits, with rate limits and fair verification scheduling
+# (delay policy), and with the reject policy.
+#
+# Usage: python3 bench_flood.py [light clients] [flooding clients] [seconds]
+
+import asyncio
+import base64
+import multiprocessing
+import os
+import sys
+import time
+
+import websockets
+
+from benchclient import quiet
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from client import Client
+from server import Server
+from workers import run_worker
+
+import codec
+
+PORT = 9600
+INTERVAL = 0.1
+
+UNLIMITED = {"rate_limit": 0, "verify_concurrency": 1 << 20}
+LIMITED = {"rate_limit": 20, "rate_limit_burst": 20, "verify_concurrency": 4}
+
+RUNS = [
+    ("no flood", UNLIMITED, False),
+    ("flood, no limits", UNLIMITED, True),
+    ("flood, limits (delay)", LIMITED, True),
+    ("flood, limits (reject)", dict(LIMITED, rate_limit_policy="reject"), True),
+]
+
+
+# Client that sends chats to itself and records their round trip times
+class LightClient(Client):
+    def __init__(self, uri):
+        super().__init__(uri)
+        self.sent = {}
+        self.latencies = []
+
+    async def send_frame(self, frame):
+        if '"signed_data"' in frame[:32]:
+            self.sent[frame[-34:-2]] = time.perf_counter()
+        await self.websocket.send(frame)
+
+    async def start(self):
+        self.websocket = await websockets.connect(self.uri, max_size=None)
+        await self.send_hello()
+        await self.websocket.recv()
+        self.clients[self.client_id] = {"public_key": self.public_key_pem.decode('utf-8')}
+        asyncio.ensure_future(self.receive())
+
+    async def receive(self):
+        try:
+            async for frame in self.websocket:
+                sent = self.sent.pop(frame[-34:-2], None)
+                if sent is not None:
+                    self.latencies.append(time.perf_counter() - sent)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def run_for(self, seconds):
+        end = time.perf_counter() + seconds
+        i = 0
+        while time.perf_counter() < end:
+            await self.send_chat(f"ping {i}", self.client_id)
+            i += 1
+            await asyncio.sleep(INTERVAL)
+        return i
+
+
+# Client that floods the server with frames carrying bad signatures
+class Flooder(Client):
+    async def start(self):
+        self.websocket = await websockets.connect(self.uri, max_size=None)
+        await self.send_hello()
+        await self.websocket.recv()
+        asyncio.ensure_future(self.drain())
+
+    # Read (and ignore) the error replies, so the server is never blocked sending them
+    async def drain(self):
+        try:
+            async for _ in self.websocket:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+
+    async def run_for(self, seconds):
+        signature = base64.b64encode(os.urandom(256)).decode('utf-8')
+        data = codec.dumps({"type": "public_chat", "sender": self.client_id, "message": "flood"})
+        end = time.perf_counter() + seconds
+        sent = 0
+        while time.perf_counter() < end:
+            self.counter += 1
+            await self.websocket.send('{"type": "signed_data", "data": ' + data + f', "counter": {self.counter}, "signature": "{signature}"}}')
+            sent += 1
+
+            # Let the reply reader run
+            await asyncio.sleep(0)
+        return sent
+
+
+# Run the flooding clients (in their own process, so they do not slow down the light clients)
+def run_flooders(uri, count, seconds, ready, results):
+    async def flood():
+        flooders = [Flooder(uri) for _ in range(count)]
+        for flooder in flooders:
+            await flooder.start()
+        ready.set()
+        sent = await asyncio.gather(*(flooder.run_for(seconds) for flooder in flooders))
+        for flooder in flooders:
+            await flooder.websocket.close()
+        results.put(sum(sent))
+
+    with quiet():
+        asyncio.run(flood())
+
+
+async def server_stats(uri):
+    async with websockets.connect(uri, max_size=None) as websocket:
+        await websocket.send(codec.dumps({"type": "stats_request"}))
+        return codec.loads(await websocket.recv())
+
+
+async def measure(flood, light_count, flood_count, seconds):
+    uri = f"ws://localhost:{PORT}"
+    light = [LightClient(uri) for _ in range(light_count)]
+
+    with quiet():
+        for client in light:
+            await client.start()
+
+    flood_results = multiprocessing.Queue()
+    if flood:
+        ready = multiprocessing.Event()
+        flooders = multiprocessing.Process(target=run_flooders, args=(uri, flood_count, seconds, ready, flood_results))
+        flooders.start()
+        await asyncio.get_running_loop().run_in_executor(None, ready.wait)
+
+    results = await asyncio.gather(*(client.run_for(seconds) for client in light))
+    flood_sent = await asyncio.get_running_loop().run_in_executor(None, flood_results.get) if flood else 0
+    await asyncio.sleep(1)
+    stats = await server_stats(uri)
+
+    for client in light:
+        await client.websocket.close()
+
+    latencies = sorted(latency for client in light for latency in client.latencies)
+    sent = sum(results)
+    return {
+        "light_sent": sent,
+        "light_delivered": len(latencies),
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        "flood_sent": flood_sent,
+        "verified": stats["latency"].get("validate_signature", {}).get("count", 0),
+        "rate_limited": stats["counters"].get("rate_limited", 0),
+    }
+
+
+def main():
+    light_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    flood_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    print(f"{light_count} light clients (1 chat every {INTERVAL * 1000:.0f} ms), {flood_count} flooding clients, {seconds:.0f}s")
+    print(f"{'run':>24} {'light sent':>10} {'delivered':>9} {'p50 ms':>8} {'p99 ms':>8} {'flood sent':>10} {'verified':>9} {'limited':>8}")
+    for name, config, flood in RUNS:
+        process = multiprocessing.Process(target=run_worker, args=(Server, "localhost", PORT, dict(config, log_level="ERROR")), daemon=True)
+        process.start()
+        try:
+            time.sleep(1.5)
+            result = asyncio.run(measure(flood, light_count, flood_count, seconds))
+        finally:
+            process.terminate()
+            process.join()
+
+        p50 = f"{result['p50_ms']:.1f}" if result["p50_ms"] is not None else "-"
+        p99 = f"{result['p99_ms']:.1f}" if result["p99_ms"] is not None else "-"
+        print(f"{name:>24} {result['light_sent']:>10} {result['light_delivered']:>9} {p50:>8} {p99:>8} {result['flood_sent']:>10} {result['verified']:>9} {result['rate_limited']:>8}")
+
+
+if __name__ == "__main__":
+    main()
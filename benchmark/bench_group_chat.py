@@ -0,0 +1,65 @@
+# Benchmark for group chats
+#
+# Compares sending one message to a group with send_chat (one AES encryption,
+# one signature, one frame) against calling send_chat once per recipient. Measures sender CPU time, frames and bytes sent.
+#
+# Usage: python3 bench_group_chat.py [group size] [messages]
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+
+from client import Client
+from signer import SigningPool
+
+
+# Stand-in for the server connection (records what would be sent)
+class CountingWebSocket:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send(self, frame):
+        self.frames += 1
+        self.bytes += len(frame)
+
+
+async def run(sender, recipient_ids, messages, group):
+    sender.websocket = CountingWebSocket()
+
+    start = time.perf_counter()
+    for i in range(messages):
+        if group:
+            await sender.send_chat(f"message {i}", recipient_ids)
+        else:
+            for recipient_id in recipient_ids:
+                await sender.send_chat(f"message {i}", recipient_id)
+    elapsed = time.perf_counter() - start
+
+    return messages / elapsed, sender.websocket.frames, sender.websocket.bytes
+
+
+async def main():
+    group_size = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    sender = Client("ws://localhost:8765", signing_pool=SigningPool("inline"))
+    recipients = [Client("ws://localhost:8765") for _ in range(group_size)]
+    sender.clients = {
+        recipient.client_id: {"public_key": recipient.public_key_pem.decode('utf-8')}
+        for recipient in recipients
+    }
+    recipient_ids = list(sender.clients)
+
+    print(f"{messages} messages to a group of {group_size}")
+    print(f"{'mode':>12} {'messages/s':>11} {'frames':>7} {'bytes':>10}")
+    for name, group in (("individual", False), ("group", True)):
+        rate, frames, sent = await run(sender, recipient_ids, messages, group)
+        print(f"{name:>12} {rate:>11.1f} {frames:>7} {sent:>10}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
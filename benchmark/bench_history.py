@@ -0,0 +1,149 @@
+# Benchmark for the client's message history
+#
+# Adds a number of chats (1M by default) to a new history file the way the
+# client does (on the event loop, written in batches by the writer thread), and
+# reports the insert rate, the time the event loop spent adding them and how
+# late it woke up a sleeping task at worst. Then opens the history again as a
+# client starting up would, and reports the latency of the first query and of
+# typical queries: the latest page, a page further back, one sender, one
+# recipient, a time range and full-text searches for common and rare words.
+#
+# Usage: python3 bench_history.py [messages]
+
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+
+from history import MessageHistory
+
+MESSAGES = 1000000
+CLIENTS = 1000
+WORDS = 5000
+
+# Times each query is run
+REPEATS = 50
+
+
+def client_id(i):
+    return f"{i:064x}"
+
+
+# Chats from CLIENTS clients: a third private (to one to three recipients), words from a
+# vocabulary where a few are common and most are rare
+def generate(count, now):
+    generator = random.Random(1)
+    vocabulary = [f"word{i}" for i in range(WORDS)]
+    weights = [1 / (i + 1) for i in range(WORDS)]
+
+    messages = []
+    for i in range(count):
+        sender = client_id(generator.randrange(CLIENTS))
+        text = " ".join(generator.choices(vocabulary, weights, k=generator.randint(5, 15)))
+        if generator.random() < 1 / 3:
+            recipients = [client_id(generator.randrange(CLIENTS)) for _ in range(generator.randint(1, 3))]
+            messages.append(("chat", sender, recipients, text, now - count + i))
+        else:
+            messages.append(("public_chat", sender, [], text, now - count + i))
+    return messages
+
+
+async def insert(path, messages):
+    history = MessageHistory(path)
+    loop = asyncio.get_running_loop()
+
+    # Longest time a task sleeping on the event loop was woken up late
+    stall = 0.0
+    running = True
+
+    async def watch():
+        nonlocal stall
+        while running:
+            before = loop.time()
+            await asyncio.sleep(0.005)
+            stall = max(stall, loop.time() - before - 0.005)
+
+    watcher = asyncio.ensure_future(watch())
+
+    start = time.perf_counter()
+    on_loop = 0.0
+    for i in range(0, len(messages), 1000):
+        # Add a thousand at a time, then let the loop run (like messages arriving)
+        added = time.perf_counter()
+        for message_type, sender, recipients, text, sent in messages[i:i + 1000]:
+            history.add("in", message_type, sender, recipients, text, sent)
+        on_loop += time.perf_counter() - added
+        await asyncio.sleep(0)
+    await history.flush()
+    elapsed = time.perf_counter() - start
+
+    running = False
+    await watcher
+    await history.close()
+    return elapsed, on_loop, stall
+
+
+# Median latency of a query (ms)
+async def latency(query):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        await query()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+async def queries(path, now, count):
+    # Startup: nothing is read until the first query
+    start = time.perf_counter()
+    history = MessageHistory(path)
+    opened = time.perf_counter() - start
+    page = await history.query()
+    first = time.perf_counter() - start
+    print(f"{'open':>24}: {opened * 1000:8.3f} ms")
+    print(f"{'first query':>24}: {first * 1000:8.3f} ms")
+
+    deep = page[-1]["id"] - count // 2
+    runs = [
+        ("latest page", lambda: history.query()),
+        ("page halfway back", lambda: history.query(before=deep)),
+        ("one sender", lambda: history.query(sender=client_id(7))),
+        ("one recipient", lambda: history.query(recipient=client_id(7))),
+        ("last hour", lambda: history.query(since=now - 3600)),
+        ("sender, older than a day", lambda: history.query(sender=client_id(7), until=now - 86400)),
+        ("search common word", lambda: history.search("word0")),
+        ("search rare word", lambda: history.search("word4999")),
+        ("search two words", lambda: history.search("word3 word4000")),
+    ]
+    for name, query in runs:
+        print(f"{name:>24}: {await latency(query):8.3f} ms")
+
+    await history.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    now = time.time()
+
+    print(f"Generating {count} messages...")
+    messages = generate(count, now)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.db")
+        elapsed, on_loop, stall = asyncio.run(insert(path, messages))
+        print(f"Inserted {count} messages in {elapsed:.1f}s ({count / elapsed:.0f} msg/s), "
+              f"{on_loop * 1e6 / count:.2f} us per message on the event loop, loop woken up at most {stall * 1000:.1f} ms late")
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f"History file: {size / 2**20:.0f} MB")
+
+        del messages
+        asyncio.run(queries(path, now, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# Benchmark for memory per idle connection
+#
+# Opens a number of client connections to a server (each sends hello, then
+# stays idle) and reports how much the server's resident memory grew per
+# connection, with the default settings and with the high-density settings
+# (HIGH_DENSITY_CONFIG in config.py). Client list pushes are off in both runs:
+# with them every hello queues an update for every connected client, so just
+# connecting the clients would take O(n^2) frames.
+#
+# Every connection takes a file descriptor in the server and in a client
+# process, so counts the open file limit does not allow are skipped (raise it
+# with ulimit -n). Client processes connect from their own loopback address
+# (127.0.0.2, 127.0.0.3, ...) so they do not run out of local ports.
+#
+# Usage: python3 bench_idle.py [connections ...]
+
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import websockets
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from benchclient import hello_frames
+from config import HIGH_DENSITY_CONFIG
+from server import Server
+from workers import run_worker
+
+PORT = 9750
+COUNTS = [10000, 50000, 100000]
+
+# (name, server config)
+MODES = [
+    ("default", {}),
+    ("high density", HIGH_DENSITY_CONFIG),
+]
+
+# Connections opened at once by each client process
+CONNECT_BATCH = 200
+
+# File descriptors kept free in each process (listening sockets, pipes, logs)
+SPARE_FDS = 100
+
+
+# Client process: connect one client per frame, then hold the connections open until told to stop
+def run_clients(uri, source, frames, connected, stop):
+    async def connect(frame):
+        websocket = await websockets.connect(uri, max_size=None, open_timeout=None, local_addr=(source, 0))
+        await websocket.send(frame)
+        await websocket.recv()
+        return websocket
+
+    async def main():
+        websockets_open = []
+        for i in range(0, len(frames), CONNECT_BATCH):
+            websockets_open += await asyncio.gather(*(connect(frame) for frame in frames[i:i + CONNECT_BATCH]))
+        connected.put(len(websockets_open))
+
+        while not stop.is_set():
+            await asyncio.sleep(0.2)
+
+    asyncio.run(main())
+
+
+# Resident memory of a process (MB)
+def rss(pid):
+    with open(f"/proc/{pid}/status") as file:
+        return next(int(line.split()[1]) for line in file if line.startswith("VmRSS:")) / 1024
+
+
+# Connect count idle clients to a server with the given config, returning
+# (seconds to connect, server RSS growth per connection in KB)
+def measure(config, frames):
+    config = {**config, "push_client_updates": False, "offline_dir": None, "file_port": 0, "log_level": "ERROR", "rate_limit": 0}
+
+    # Spawned, so the server does not start with a copy of this process (and its hello frames)
+    server = multiprocessing.get_context("spawn").Process(target=run_worker, args=(Server, "127.0.0.1", PORT, config), daemon=True)
+    server.start()
+    time.sleep(1.5)
+    before = rss(server.pid)
+
+    per_process = resource.getrlimit(resource.RLIMIT_NOFILE)[0] - SPARE_FDS
+    connected = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    clients = []
+    start = time.perf_counter()
+    for i in range(0, len(frames), per_process):
+        process = multiprocessing.Process(
+            target=run_clients,
+            args=(f"ws://127.0.0.1:{PORT}", f"127.0.0.{2 + len(clients)}", frames[i:i + per_process], connected, stop),
+            daemon=True
+        )
+        process.start()
+        clients.append(process)
+
+    try:
+        total = sum(connected.get() for _ in clients)
+        elapsed = time.perf_counter() - start
+
+        # Let the connections settle (hello replies sent, buffers drained)
+        time.sleep(2)
+        after = rss(server.pid)
+    finally:
+        stop.set()
+        for process in clients:
+            process.join()
+        server.terminate()
+        server.join()
+
+    return elapsed, (after - before) * 1024 / total
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or COUNTS
+
+    # Use as many file descriptors as allowed
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    runnable = [count for count in counts if count <= hard - SPARE_FDS]
+    for count in counts:
+        if count not in runnable:
+            print(f"Skipping {count} connections: the open file limit is {hard}")
+    if not runnable:
+        return
+
+    print(f"Signing {max(runnable)} hello messages...")
+    frames = hello_frames(max(runnable))
+
+    print(f"{'connections':>11} {'mode':>13} {'connect s':>10} {'server KB/connection':>21}")
+    for count in runnable:
+        for name, config in MODES:
+            elapsed, per_connection = measure(config, frames[:count])
+            print(f"{count:>11} {name:>13} {elapsed:>10.1f} {per_connection:>21.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Benchmark for server logging and metrics overhead
+#
+# Per-message cost on the event loop of the old per-frame print (line buffered
+# like a terminal, or block buffered like a file) against the levelled, queued
+# logging that replaced it, and the cost of timing a handler with metrics.
+#
+# Usage: python3 bench_metrics.py [messages]
+
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from logs import setup_logging
+from metrics import Metrics, timed
+
+FRAME = '{"type": "signed_data", "data": {"type": "public_chat", "sender": "' + "a" * 64 + '", "message": "' + "x" * 200 + '"}, "counter": 1, "signature": "' + "s" * 344 + '"}'
+
+
+def per_message_us(function, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        function()
+    return (time.perf_counter() - start) / messages * 1e6
+
+
+class Handlers:
+    def __init__(self):
+        self.metrics = Metrics()
+
+    async def bare(self):
+        pass
+
+    @timed("timed")
+    async def timed(self):
+        pass
+
+
+async def handler_us(handler, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        await handler()
+    return (time.perf_counter() - start) / messages * 1e6
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    log = logging.getLogger("olaf.bench")
+    results = []
+
+    # Line buffered, like a terminal
+    with tempfile.TemporaryFile("w", buffering=1) as output:
+        with contextlib.redirect_stdout(output):
+            results.append(("print every frame (tty)", per_message_us(lambda: print(f"Received message: {FRAME}"), messages)))
+
+    with tempfile.TemporaryFile("w") as output:
+        with contextlib.redirect_stdout(output):
+            results.append(("print every frame (file)", per_message_us(lambda: print(f"Received message: {FRAME}"), messages)))
+
+        listener, _ = setup_logging("INFO", 0, output)
+        results.append(("debug log (level INFO)", per_message_us(lambda: log.debug("Received %s message (%d bytes)", "signed_data", len(FRAME)), messages)))
+        results.append(("info log, no limit", per_message_us(lambda: log.info("Received %s message (%d bytes)", "signed_data", len(FRAME)), messages)))
+        listener.stop()
+
+        listener, _ = setup_logging("INFO", 10, output)
+        results.append(("info log, 10/s limit", per_message_us(lambda: log.info("Received %s message (%d bytes)", "signed_data", len(FRAME)), messages)))
+        listener.stop()
+
+    handlers = Handlers()
+    results.append(("handler call", asyncio.run(handler_us(handlers.bare, messages))))
+    results.append(("timed handler call", asyncio.run(handler_us(handlers.timed, messages))))
+
+    print(f"{'operation':>26} {'us/message':>11}")
+    for name, us in results:
+        print(f"{name:>26} {us:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
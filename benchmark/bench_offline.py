@@ -0,0 +1,149 @@
+# Benchmark for store-and-forward of chats to offline recipients
+#
+# First the offline log on its own: how fast chats can be stored, read back
+# for delivery, and the index rebuilt after a restart. Then against a running
+# server: the time from an offline client's hello until its whole backlog has
+# arrived, compared with the sender sending the same (already signed) chats
+# again once the recipient is back, which is what clients did before chats
+# were stored.
+#
+# Usage: python3 bench_offline.py [stored chats] [recipients]
+
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import websockets
+
+from benchclient import quiet
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from client import Client
+from offline import OfflineStore
+from server import Server
+from signer import SigningPool
+from workers import run_worker
+
+import signer
+
+PORT = 9650
+BACKLOGS = [10, 100, 1000]
+
+# A typical chat frame (about 1 KB: 2048-bit RSA wrapped key, signature and a short message)
+FRAME = '{"type": "signed_data", "data": {"type": "chat", "sender": "' + "a" * 64 + '", "recipient": "' + "b" * 64 + '", "aes_key": "' + "k" * 344 + '", "message": "' + "m" * 120 + '"}, "counter": 1, "signature": "' + "s" * 344 + '"}'
+
+
+# Store, deliver and reload chats for a number of recipients
+def bench_log(chats, recipients):
+    directory = tempfile.mkdtemp(prefix="olaf-bench-offline-")
+    try:
+        ids = [f"{i:064x}" for i in range(recipients)]
+        store = OfflineStore(directory, max_per_recipient=chats)
+
+        start = time.perf_counter()
+        for i in range(chats):
+            store.put([ids[i % recipients]], FRAME)
+        stored = time.perf_counter() - start
+        store.close()
+
+        start = time.perf_counter()
+        store = OfflineStore(directory, max_per_recipient=chats)
+        loaded = time.perf_counter() - start
+
+        start = time.perf_counter()
+        delivered = sum(len(store.take(recipient_id)) for recipient_id in ids)
+        taken = time.perf_counter() - start
+        store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    megabytes = chats * len(FRAME) / 1e6
+    print(f"Offline log: {chats} chats of {len(FRAME)} bytes for {recipients} recipients")
+    print(f"  store:   {chats / stored:>10.0f} chats/s {megabytes / stored:>8.1f} MB/s")
+    print(f"  reload:  {chats / loaded:>10.0f} chats/s ({loaded * 1000:.1f} ms to rebuild the index)")
+    print(f"  deliver: {delivered / taken:>10.0f} chats/s")
+
+
+# Recipient that counts the chats it receives after its hello
+class Recipient(Client):
+    async def receive_backlog(self, expected, after_hello=None):
+        self.websocket = await websockets.connect(self.uri, max_size=None)
+        start = time.perf_counter()
+        await self.send_hello()
+        await self.websocket.recv()
+        if after_hello is not None:
+            await after_hello()
+
+        received = 0
+        while received < expected:
+            frame = await self.websocket.recv()
+            if '"signed_data"' in frame:
+                received += 1
+        elapsed = time.perf_counter() - start
+        await self.websocket.close()
+        return elapsed
+
+
+async def bench_delivery(backlog, pool):
+    uri = f"ws://localhost:{PORT}"
+    sender = Client(uri, signing_pool=pool)
+    recipient = Recipient(uri, signing_pool=pool)
+    await sender.connect()
+
+    # Chats signed in advance, so only relaying them is timed
+    recipients = [(recipient.client_id, recipient.public_key_pem.decode('utf-8'))]
+    frames = [signer.chat_frame(sender.private_key_pem, sender.client_id, recipients, f"chat {i}", sender.next_counter()) for i in range(backlog)]
+
+    # Stored while the recipient is offline, delivered at its hello
+    for frame in frames:
+        await sender.websocket.send(frame)
+    await asyncio.sleep(0.5)
+    stored = await recipient.receive_backlog(backlog)
+
+    # Sent again by the sender once the recipient is back
+    async def resend():
+        for frame in frames:
+            await sender.websocket.send(frame)
+
+    frames = [signer.chat_frame(sender.private_key_pem, sender.client_id, recipients, f"chat {i}", sender.next_counter()) for i in range(backlog)]
+    await asyncio.sleep(0.5)
+    resent = await recipient.receive_backlog(backlog, resend)
+
+    await sender.close()
+    return stored, resent
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    recipients = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    bench_log(chats, recipients)
+
+    directory = tempfile.mkdtemp(prefix="olaf-bench-offline-")
+    config = {"offline_dir": directory, "rate_limit": 0, "log_level": "ERROR"}
+    process = multiprocessing.Process(target=run_worker, args=(Server, "localhost", PORT, config), daemon=True)
+    process.start()
+    pool = SigningPool("inline")
+    try:
+        time.sleep(1.5)
+        print("\nBacklog delivery on reconnect (hello to last chat received)")
+        print(f"{'chats':>8} {'stored ms':>10} {'resent ms':>10}")
+        for backlog in BACKLOGS:
+            with quiet():
+                stored, resent = asyncio.run(bench_delivery(backlog, pool))
+            print(f"{backlog:>8} {stored * 1000:>10.1f} {resent * 1000:>10.1f}")
+    finally:
+        process.terminate()
+        process.join()
+        pool.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
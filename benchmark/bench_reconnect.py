@@ -0,0 +1,199 @@
+# Benchmark for a reconnect storm after a server restart
+#
+# Connects a number of clients to a server (each sends hello and keeps the
+# resumption ticket from the reply), restarts the server with the same ticket
+# key, and has every client reconnect at once. Reports how long it took until
+# all clients were accepted again, the server's CPU time for that, and how many
+# times clients were turned away (told to try again later, or their connection
+# failed) and had to retry, once with every client sending hello again and
+# once with every client resuming its session with its ticket.
+#
+# Client list pushes are off (see bench_idle.py). Client processes connect from
+# their own loopback address (127.0.0.2, 127.0.0.3, ...).
+#
+# Usage: python3 bench_reconnect.py [clients]
+
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import websockets
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from benchclient import hello_frames
+from server import Server
+from workers import run_worker
+
+import codec
+
+PORT = 9800
+CLIENTS = 10000
+
+# Client processes the clients are spread over
+CLIENT_PROCESSES = 4
+
+# Connections opened at once by each client process for the first connection
+# (the reconnects after the restart all start at once)
+CONNECT_BATCH = 200
+
+# Server listen backlog (with the default of 100, connections beyond it wait
+# for TCP to retransmit their SYN, which soon takes longer than the hellos)
+LISTEN_BACKLOG = 4096
+
+# Seconds to wait before retrying a connection that failed
+CONNECT_RETRY = 0.5
+
+# File descriptors kept free in each process (listening sockets, pipes, logs)
+SPARE_FDS = 100
+
+
+# Connect, send a frame and return the reply (None if the connection failed)
+async def exchange(uri, source, frame):
+    try:
+        websocket = await websockets.connect(uri, max_size=None, open_timeout=None, local_addr=(source, 0))
+    except (OSError, websockets.InvalidHandshake):
+        return None, None
+    try:
+        await websocket.send(frame)
+        return websocket, json.loads(await websocket.recv())
+    except websockets.ConnectionClosed:
+        return None, None
+
+
+# Client process: connect with hello to get tickets, then reconnect after the restart
+# with hello or resume frames, holding the connections open until told to stop
+def run_clients(uri, source, frames, mode, tickets, restarted, done, stop):
+    async def connect(frame):
+        retries = 0
+        while True:
+            websocket, reply = await exchange(uri, source, frame)
+            if reply is not None and reply.get("status") == "success":
+                return websocket, reply, retries
+
+            retries += 1
+            if websocket is not None:
+                await websocket.close()
+            retry_after = CONNECT_RETRY if reply is None else reply.get("retry_after", CONNECT_RETRY)
+            await asyncio.sleep(retry_after * random.uniform(0.5, 1.5))
+
+    async def main():
+        # First connection, in batches
+        sessions = []
+        for i in range(0, len(frames), CONNECT_BATCH):
+            sessions += await asyncio.gather(*(connect(frame) for frame in frames[i:i + CONNECT_BATCH]))
+        for websocket, _, _ in sessions:
+            websocket.transport.abort()
+        tickets.put(len(sessions))
+
+        while not restarted.is_set():
+            await asyncio.sleep(0.05)
+
+        # Reconnect all clients at once
+        if mode == "resume":
+            reconnect_frames = []
+            for frame, (_, reply, _) in zip(frames, sessions):
+                public_key = codec.loads(frame)["data"]["public_key"]
+                reconnect_frames.append(codec.dumps({"type": "resume", "ticket": reply["ticket"], "public_key": public_key, "counter": 1}))
+        else:
+            reconnect_frames = frames
+        sessions = await asyncio.gather(*(connect(frame) for frame in reconnect_frames))
+        done.put(sum(retries for _, _, retries in sessions))
+
+        while not stop.is_set():
+            await asyncio.sleep(0.2)
+
+    asyncio.run(main())
+
+
+# CPU time used by a process so far (seconds)
+def cpu_time(pid):
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def start_server(config):
+    server = multiprocessing.get_context("spawn").Process(target=run_worker, args=(Server, "127.0.0.1", PORT, config), daemon=True)
+    server.start()
+    time.sleep(1.5)
+    return server
+
+
+# Connect the clients, restart the server and reconnect them all at once,
+# returning (seconds until all were accepted, server CPU seconds, retries)
+def measure(mode, frames, key_file, store_file):
+    config = {"push_client_updates": False, "offline_dir": None, "file_port": 0, "log_level": "ERROR", "rate_limit": 0,
+              "ticket_key_file": key_file, "ticket_store_file": store_file, "listen_backlog": LISTEN_BACKLOG}
+    server = start_server(config)
+
+    per_process = -(-len(frames) // CLIENT_PROCESSES)
+    tickets = multiprocessing.Queue()
+    done = multiprocessing.Queue()
+    restarted = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    clients = []
+    for i in range(0, len(frames), per_process):
+        process = multiprocessing.Process(
+            target=run_clients,
+            args=(f"ws://127.0.0.1:{PORT}", f"127.0.0.{2 + len(clients)}", frames[i:i + per_process], mode, tickets, restarted, done, stop),
+            daemon=True
+        )
+        process.start()
+        clients.append(process)
+
+    try:
+        for _ in clients:
+            tickets.get()
+        server.terminate()
+        server.join()
+
+        server = start_server(config)
+        cpu_before = cpu_time(server.pid)
+        start = time.perf_counter()
+        restarted.set()
+        retries = sum(done.get() for _ in clients)
+        elapsed = time.perf_counter() - start
+        cpu = cpu_time(server.pid) - cpu_before
+    finally:
+        stop.set()
+        for process in clients:
+            process.join()
+        server.terminate()
+        server.join()
+
+    return elapsed, cpu, retries
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else CLIENTS
+
+    # Use as many file descriptors as allowed
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if count > hard - SPARE_FDS:
+        print(f"Cannot connect {count} clients: the open file limit is {hard}")
+        return
+
+    print(f"Signing {count} hello messages...")
+    frames = hello_frames(count)
+
+    with tempfile.TemporaryDirectory() as directory:
+        key_file = os.path.join(directory, "resumption.key")
+        store_file = os.path.join(directory, "resumption.db")
+        print(f"{'clients':>8} {'reconnect':>9} {'all accepted s':>15} {'server CPU s':>13} {'retries':>8}")
+        for mode in ("hello", "resume"):
+            elapsed, cpu, retries = measure(mode, frames, key_file, store_file)
+            print(f"{count:>8} {mode:>9} {elapsed:>15.2f} {cpu:>13.2f} {retries:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Benchmark for the server connection registry
+#
+# Measures the per-message lookup cost (websocket -> client) and the
+# connect/disconnect cost at different numbers of connected clients.
+#
+# Usage: python3 bench_registry.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from registry import ClientRecord, ClientRegistry
+
+SIZES = [10, 100, 1000, 10000, 100000]
+LOOKUPS = 200000
+
+
+# Stand-in for a websocket connection (only needs to be hashable)
+class FakeWebSocket:
+    pass
+
+
+def fill_registry(size):
+    registry = ClientRegistry("ws://localhost:8765")
+    sockets = []
+    for i in range(size):
+        websocket = FakeWebSocket()
+        fingerprint = f"{i:064x}"
+        registry.add(ClientRecord(fingerprint, f"key-{i}".encode('utf-8'), None, websocket, None, 0))
+        sockets.append(websocket)
+    return registry, sockets
+
+
+def bench_lookup(registry, sockets):
+    # Spread lookups across the whole registry
+    step = max(1, len(sockets) // 1000)
+    sample = sockets[::step]
+
+    start = time.perf_counter()
+    for i in range(LOOKUPS):
+        registry.get_by_websocket(sample[i % len(sample)])
+    elapsed = time.perf_counter() - start
+
+    return elapsed / LOOKUPS * 1e9
+
+
+def bench_disconnect(registry, sockets):
+    # Remove the middle 1% of clients then add them back
+    count = max(1, len(sockets) // 100)
+    middle = len(sockets) // 2
+    victims = sockets[middle:middle + count]
+
+    start = time.perf_counter()
+    removed = [registry.remove_websocket(websocket) for websocket in victims]
+    elapsed = time.perf_counter() - start
+
+    for record in removed:
+        registry.add(record)
+
+    return elapsed / count * 1e9
+
+
+def main():
+    print(f"{'clients':>8} {'lookup (ns)':>12} {'disconnect (ns)':>16}")
+    for size in SIZES:
+        registry, sockets = fill_registry(size)
+        lookup_ns = bench_lookup(registry, sockets)
+        disconnect_ns = bench_disconnect(registry, sockets)
+        print(f"{size:>8} {lookup_ns:>12.1f} {disconnect_ns:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Benchmark for replayed messages
+#
+# A number of clients each connect, send hello and a run of public chats, and
+# disconnect. Their frames are then sent again exactly as they were, as an
+# attacker who recorded the traffic (or a relay resending it) would: every
+# session replayed on its own connection, all at once. Reports the time and
+# server CPU the replay took, how many signatures the server verified for it
+# and how many replayed chats it accepted, with the replay filter (replay.py)
+# off and on.
+#
+# Without the filter a replayed hello is accepted once its client has gone,
+# and the chats after it then pass the counter check too, so every replayed
+# frame is verified (and the chats delivered again). With it, the hellos are
+# turned away before any key is parsed, and the chats are turned away as sent
+# before hello.
+#
+# Usage: python3 bench_replay.py [sessions] [chats per session]
+
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import websockets
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from benchclient import bench_keys
+from server import Server
+from workers import run_worker
+
+import codec
+import signer
+
+PORT = 9850
+SESSIONS = 100
+CHATS = 50
+
+# (name, server config)
+MODES = [
+    ("filter off", {"replay_window": 0}),
+    ("filter on", {}),
+]
+
+
+# Signed frames of count sessions: hello, then chats public chats
+def session_frames(count, chats):
+    sessions = []
+    for key, public_key in bench_keys(count):
+        sign = functools.partial(signer.sign, key)
+        client_id = hashlib.sha256(base64.b64encode(public_key.encode('utf-8'))).hexdigest()
+
+        frames = [codec.encode_signed_data({"type": "hello", "public_key": public_key}, 1, sign)]
+        for i in range(chats):
+            data = {"type": "public_chat", "sender": client_id, "message": f"message {i}"}
+            frames.append(codec.encode_signed_data(data, 2 + i, sign))
+        sessions.append(frames)
+    return sessions
+
+
+# Send a session's frames on a new connection, then wait until the server has handled them
+# (a stats request is answered after the frames before it)
+async def send_session(uri, frames):
+    async with websockets.connect(uri, max_size=None, ping_interval=None) as websocket:
+        for frame in frames:
+            await websocket.send(frame)
+        await websocket.send(codec.dumps({"type": "stats_request"}))
+        while True:
+            reply = json.loads(await websocket.recv())
+            if reply.get("type") == "stats":
+                return reply
+
+
+# CPU time used by a process so far (seconds)
+def cpu_time(pid):
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+# Run the sessions, then replay them all at once, returning
+# (seconds, server CPU seconds, signatures verified, chats accepted, duplicates rejected) for the replay
+async def replay(uri, pid, sessions):
+    # The original sessions, one after another (so each client has gone before the next starts)
+    for frames in sessions:
+        stats = await send_session(uri, frames)
+
+    verified = stats["latency"]["validate_signature"]["count"]
+    accepted = stats["latency"].get("handle_public_chat", {}).get("count", 0)
+
+    cpu_before = cpu_time(pid)
+    start = time.perf_counter()
+    replies = await asyncio.gather(*(send_session(uri, frames) for frames in sessions))
+    elapsed = time.perf_counter() - start
+    cpu = cpu_time(pid) - cpu_before
+
+    # The last stats reply counts everything before it
+    stats = max(replies, key=lambda reply: reply["latency"]["handle_signed_data"]["count"])
+    return (
+        elapsed,
+        cpu,
+        stats["latency"]["validate_signature"]["count"] - verified,
+        stats["latency"].get("handle_public_chat", {}).get("count", 0) - accepted,
+        stats["counters"].get("rejected.duplicate", 0),
+    )
+
+
+def measure(config, sessions):
+    config = {**config, "offline_dir": None, "file_port": 0, "log_level": "ERROR", "rate_limit": 0, "ticket_lifetime": 0}
+    server = multiprocessing.get_context("spawn").Process(target=run_worker, args=(Server, "127.0.0.1", PORT, config), daemon=True)
+    server.start()
+    time.sleep(1.5)
+    try:
+        return asyncio.run(replay(f"ws://127.0.0.1:{PORT}", server.pid, sessions))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else SESSIONS
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else CHATS
+
+    print(f"Signing {count} sessions of {chats} chats...")
+    sessions = session_frames(count, chats)
+
+    print(f"Replaying {count * (chats + 1)} frames")
+    print(f"{'mode':>10} {'replay s':>9} {'server CPU s':>13} {'verified':>9} {'accepted':>9} {'duplicates':>11}")
+    for name, config in MODES:
+        elapsed, cpu, verified, accepted, duplicates = measure(config, sessions)
+        print(f"{name:>10} {elapsed:>9.2f} {cpu:>13.2f} {verified:>9} {accepted:>9} {duplicates:>11}")
+
+
+if __name__ == "__main__":
+    main()
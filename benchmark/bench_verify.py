@@ -0,0 +1,78 @@
+# Benchmark for server signature verification
+#
+# Compares verification throughput inline on the event loop against the thread
+# and process pools, with many connections verifying concurrently.
+#
+# Usage: python3 bench_verify.py [messages] [connections]
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from verifier import VerificationPool
+
+
+def make_jobs(count):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_key = private_key.public_key()
+    public_pem = public_key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode('utf-8')
+
+    jobs = []
+    for i in range(count):
+        data = bytes('{"type": "public_chat", "message": "benchmark"}' + str(i), 'utf-8')
+        signature = private_key.sign(
+            data,
+            padding.PSS(
+                mgf=padding.MGF1(hashes.SHA256()),
+                salt_length=padding.PSS.MAX_LENGTH
+            ),
+            hashes.SHA256()
+            )
+        jobs.append((public_key, public_pem, signature, data))
+    return jobs
+
+
+async def run_mode(mode, jobs, connections):
+    pool = VerificationPool(mode, workers=os.cpu_count())
+
+    # Each connection verifies its share of messages one after another (like handle_connection)
+    async def connection(share):
+        for verify_key, public_pem, signature, data in share:
+            assert await pool.verify(verify_key, public_pem, signature, data)
+
+    # Warm up the workers before timing
+    await connection(jobs[:connections])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connection(jobs[i::connections]) for i in range(connections)))
+    elapsed = time.perf_counter() - start
+
+    pool.close()
+    return len(jobs) / elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    jobs = make_jobs(count)
+    print(f"{count} messages over {connections} connections, {os.cpu_count()} cores")
+
+    for mode in ("inline", "thread", "process"):
+        rate = asyncio.run(run_mode(mode, jobs, connections))
+        print(f"{mode:>8}: {rate:10.0f} verifies/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Benchmark for multi-process server mode
+#
+# Starts the server with 1, 2, 4, ... workers on one port and measures public
+# chat and private chat throughput with the same set of clients each time.
+#
+# Usage: python3 bench_workers.py [max workers] [clients] [messages per client]
+
+import asyncio
+import sys
+
+from benchclient import BenchClient, connect_clients, run_scenario, start_server
+
+PORT = 9200
+
+
+async def measure(workers, client_count, messages):
+    process = start_server(PORT, "--workers", workers)
+    try:
+        await asyncio.sleep(2 + workers * 0.5)
+
+        clients = [BenchClient(f"ws://localhost:{PORT}") for _ in range(client_count)]
+        await connect_clients(clients)
+
+        print(f"{workers} worker(s), {client_count} clients, {messages} messages per client")
+
+        async def send_public(client):
+            for i in range(messages):
+                await client.send_public(f"public {i}")
+
+        public_rate = await run_scenario("public_chat", clients, send_public, lambda client: (client_count - 1) * messages)
+
+        peers = {client: clients[(i + 1) % client_count] for i, client in enumerate(clients)}
+
+        async def send_private(client):
+            for i in range(messages):
+                await client.send_chat(f"private {i}", peers[client].client_id)
+
+        chat_rate = await run_scenario("chat", clients, send_private, lambda client: messages)
+
+        for client in clients:
+            await client.websocket.close()
+
+        return public_rate, chat_rate
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    client_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    results = {}
+    workers = 1
+    while workers <= max_workers:
+        results[workers] = await measure(workers, client_count, messages)
+        workers *= 2
+
+    print(f"\n{'workers':>8} {'public msg/s':>13} {'chat msg/s':>11}")
+    for workers, (public_rate, chat_rate) in results.items():
+        print(f"{workers:>8} {public_rate:>13.0f} {chat_rate:>11.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+# Helpers shared by the multi-process benchmarks
+#
+# BenchClient is a headless Client that counts the signed messages it receives
+# instead of printing them. bench_keys and hello_frames make keys and signed
+# hellos for many clients quickly.
+
+import asyncio
+import contextlib
+import functools
+import math
+import os
+import subprocess
+import sys
+import time
+
+import websockets
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+
+from client import Client
+
+import codec
+import signer
+
+
+# Start a server process (output discarded) with the given command line arguments
+def start_server(*args):
+    return subprocess.Popen(
+        [sys.executable, "server.py"] + [str(arg) for arg in args],
+        cwd=os.path.join(ROOT, "server"),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+
+# Discard the client's per-message prints
+def quiet():
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+
+# Client that counts received messages instead of printing them
+class BenchClient(Client):
+    def __init__(self, uri):
+        super().__init__(uri)
+        self.received = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.uri, max_size=None)
+        await self.send_hello()
+        asyncio.ensure_future(self.receive())
+
+    async def receive(self):
+        try:
+            async for message in self.websocket:
+                if '"signed_data"' in message:
+                    self.received += 1
+                    if self.received >= self.expected:
+                        self.done.set()
+                elif '"client_list"' in message or '"client_update"' in message:
+                    await self.handle_messages(codec.loads(message))
+        except websockets.ConnectionClosed:
+            pass
+
+
+# Private keys and PEM public keys for count distinct clients. Generating 2048-bit
+# keys takes long, so the clients share one modulus with a different public
+# exponent each (from 65537 up), which gives PEM keys (and client IDs) just like
+# real ones in a fraction of the time.
+def bench_keys(count):
+    numbers = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_numbers()
+    p, q, n = numbers.p, numbers.q, numbers.public_numbers.n
+    phi = (p - 1) * (q - 1)
+
+    keys = []
+    e = 65537
+    while len(keys) < count:
+        if math.gcd(e, phi) == 1:
+            d = pow(e, -1, phi)
+            key = rsa.RSAPrivateNumbers(
+                p, q, d, rsa.rsa_crt_dmp1(d, p), rsa.rsa_crt_dmq1(d, q), rsa.rsa_crt_iqmp(p, q),
+                rsa.RSAPublicNumbers(e, n)
+            ).private_key(unsafe_skip_rsa_key_validation=True)
+
+            public_key = key.public_key().public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo
+            )
+            keys.append((key, public_key.decode('utf-8')))
+        e += 2
+    return keys
+
+
+# Signed hello frames for count distinct clients
+def hello_frames(count):
+    return [
+        codec.encode_signed_data({"type": "hello", "public_key": public_key}, 1, functools.partial(signer.sign, key))
+        for key, public_key in bench_keys(count)
+    ]
+
+
+# Connect clients and wait until each of them sees all the others
+async def connect_clients(clients):
+    with quiet():
+        for client in clients:
+            await client.connect()
+
+    for _ in range(100):
+        for client in clients:
+            await client.client_list_request()
+        await asyncio.sleep(0.2)
+        if all(len(client.clients) == len(clients) - 1 for client in clients):
+            return True
+
+    print("Warning: client lists did not converge")
+    return False
+
+
+# Run one send scenario and report delivered messages per second
+async def run_scenario(name, clients, send, expected):
+    for client in clients:
+        client.received = 0
+        client.expected = expected(client)
+        client.done.clear()
+        if client.expected == 0:
+            client.done.set()
+
+    start = time.perf_counter()
+    with quiet():
+        await asyncio.gather(*(send(client) for client in clients))
+    await asyncio.wait_for(asyncio.gather(*(client.done.wait() for client in clients)), timeout=120)
+    elapsed = time.perf_counter() - start
+
+    delivered = sum(client.received for client in clients)
+    print(f"{name:>12}: {delivered} messages delivered in {elapsed:.2f}s ({delivered / elapsed:.0f} msg/s)")
+    return delivered / elapsed
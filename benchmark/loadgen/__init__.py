@@ -0,0 +1,16 @@
+# Headless load generator for the OLAF server
+#
+# Runs thousands of simulated clients (keys taken from a pre-generated key
+# pool) in one or more processes against a server, through a fixed sequence
+# of scenarios:
+#
+#   hello_storm        every client connects and sends its hello at once
+#   public_chat        a set of senders broadcast public chat messages
+#   chat               every client sends private chats to other clients
+#   client_list        every client polls for the full client list
+#   client_list_delta  every client polls with its list version (changes only)
+#
+# For each scenario it reports messages/s, p50/p99/p999 latency and the
+# server's RSS, and can save the results as JSON to compare between commits.
+#
+# Usage (from the benchmark directory): python3 -m loadgen --help
@@ -0,0 +1,138 @@
+# Load generator command line
+#
+# Usage (from the benchmark directory):
+#   python3 -m loadgen --clients 2000 --processes 4 --output results.json
+#   python3 -m loadgen --clients 2000 --processes 4 --compare results.json
+#
+# Without --uri a local server is started (with --server-workers processes).
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import time
+
+import websockets
+
+from benchclient import start_server
+
+from .report import print_comparison, print_results, process_rss_kb, results_document, save, summarise
+from .scenarios import SCENARIOS, run_process
+from .simclient import ROOT
+
+from keystore import KeyPool
+
+DEFAULT_KEYS = os.path.join(ROOT, "benchmark", "keys")
+
+
+# Allow as many open sockets as the hard limit does (inherited by a local server)
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# Wait until the server accepts connections
+async def wait_for_server(uri, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            websocket = await websockets.connect(uri)
+            await websocket.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+# Run every scenario, timing each one and sampling the server's memory after it
+def run(options, server_pid):
+    # Controller and processes meet at the barrier before and after each scenario
+    barrier = multiprocessing.Barrier(options.processes + 1)
+    results = multiprocessing.Queue()
+
+    processes = []
+    first = 0
+    for i in range(options.processes):
+        count = options.clients // options.processes + (1 if i < options.clients % options.processes else 0)
+        process = multiprocessing.Process(target=run_process, args=(options, first, count, barrier, results), daemon=True)
+        process.start()
+        processes.append(process)
+        first += count
+
+    server_rss_kb = {"start": process_rss_kb(server_pid) if server_pid else None}
+    scenarios = {}
+    for name in SCENARIOS:
+        barrier.wait()
+        start = time.perf_counter()
+        barrier.wait()
+        elapsed = time.perf_counter() - start
+
+        server_rss_kb[name] = process_rss_kb(server_pid) if server_pid else None
+        phase_results = [result for phase, result in (results.get() for _ in processes)]
+        scenarios[name] = summarise(name, phase_results, elapsed)
+        print(f"{name}: done in {elapsed:.2f}s")
+
+    for process in processes:
+        process.join()
+
+    return results_document(options, scenarios, server_rss_kb)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m loadgen", description="OLAF server load generator")
+    parser.add_argument("--clients", type=int, default=200, help="number of simulated clients (default 200)")
+    parser.add_argument("--processes", type=int, default=1, help="load generator processes to spread the clients over")
+    parser.add_argument("--senders", type=int, default=10, help="clients sending public chat messages (default 10)")
+    parser.add_argument("--messages", type=int, default=10, help="messages sent per client in the chat scenarios (default 10)")
+    parser.add_argument("--rate", type=float, default=0, help="messages/s per sending client (default 0, as fast as possible)")
+    parser.add_argument("--polls", type=int, default=5, help="client list requests per client (default 5)")
+    parser.add_argument("--concurrency", type=int, default=500, help="connection handshakes in progress at once per process (default 500)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for replies and deliveries in each scenario")
+    parser.add_argument("--keys", default=DEFAULT_KEYS, help="key pool directory (keys are generated if there are not enough)")
+    parser.add_argument("--uri", help="server to test (default: start a local server)")
+    parser.add_argument("--port", type=int, default=9300, help="port for the local server (default 9300)")
+    parser.add_argument("--server-workers", type=int, default=1, help="worker processes for the local server")
+    parser.add_argument("--server-pid", type=int, help="process ID of the server given with --uri (to report its memory)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with an earlier JSON results file")
+    options = parser.parse_args()
+
+    pool = KeyPool(options.keys)
+    if len(pool) < options.clients:
+        print(f"Generating {options.clients - len(pool)} keys in {options.keys}...")
+        pool.fill(options.clients)
+
+    raise_file_limit()
+
+    server = None
+    server_pid = options.server_pid
+    if options.uri is None:
+        options.uri = f"ws://localhost:{options.port}"
+        args = [options.port]
+        if options.server_workers > 1:
+            args += ["--workers", options.server_workers]
+        server = start_server(*args)
+        server_pid = server.pid
+
+    try:
+        asyncio.run(wait_for_server(options.uri))
+        print(f"{options.clients} clients in {options.processes} process(es) against {options.uri}")
+        document = run(options, server_pid)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_results(document)
+    if options.output:
+        save(options.output, document)
+        print(f"\nResults saved to {options.output}")
+    if options.compare:
+        print_comparison(document, options.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# Load generator results: latency percentiles, server memory and JSON output
+
+import json
+import math
+import os
+import subprocess
+import time
+
+from .simclient import ROOT
+
+
+# Value below which the fraction p of the (sorted) values lie (nearest rank)
+def percentile(values, p):
+    if not values:
+        return None
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    summary = {}
+    for name, p in (("p50_ms", 0.5), ("p99_ms", 0.99), ("p999_ms", 0.999)):
+        value = percentile(latencies, p)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+# Delivery latencies for messages relayed by the server (arrival time minus send time)
+def delivery_latencies(sent, received):
+    send_times = dict(sent)
+    return [arrived - send_times[key] for key, arrived in received if key in send_times]
+
+
+# Combine the per-process results of one scenario
+def summarise(name, results, elapsed):
+    if name in ("public_chat", "chat"):
+        sent = [entry for result in results for entry in result["sent"]]
+        received = [entry for result in results for entry in result["received"]]
+        expected = sum(result["expected"] for result in results)
+        latencies = delivery_latencies(sent, received)
+        summary = {
+            "sent": len(sent),
+            "delivered": len(received),
+            "lost": max(0, expected - len(received)),
+            "messages_per_s": round(len(received) / elapsed, 1),
+        }
+    else:
+        latencies = [latency for result in results for latency in result["latencies"]]
+        summary = {
+            "completed": len(latencies),
+            "errors": sum(result["errors"] for result in results),
+            "messages_per_s": round(len(latencies) / elapsed, 1),
+        }
+
+    summary["elapsed_s"] = round(elapsed, 3)
+    summary.update(latency_summary(latencies))
+    return summary
+
+
+# Resident memory (kB) of a process and all its children (worker processes)
+def process_rss_kb(pid):
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{current}/task/{current}/children") as file:
+                pids.extend(int(child) for child in file.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+# Commit the results were measured on (None outside a git checkout)
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def results_document(options, scenarios, server_rss_kb):
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "cpus": os.cpu_count(),
+        "options": {key: value for key, value in vars(options).items() if key not in ("output", "compare")},
+        "server_rss_kb": server_rss_kb,
+        "scenarios": scenarios,
+    }
+
+
+def save(path, document):
+    with open(path, "w") as file:
+        json.dump(document, file, indent=2)
+        file.write("\n")
+
+
+def print_results(document):
+    print(f"\n{'scenario':>18} {'msg/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'server RSS':>12}")
+    for name, summary in document["scenarios"].items():
+        rss = document["server_rss_kb"].get(name)
+        row = [summary["messages_per_s"], summary["p50_ms"], summary["p99_ms"], summary["p999_ms"]]
+        cells = " ".join(f"{value:>9.2f}" if value is not None else f"{'-':>9}" for value in row[1:])
+        print(f"{name:>18} {row[0]:>10.1f} {cells} {f'{rss / 1024:.1f} MB' if rss else '-':>12}")
+
+        problems = summary.get("lost") or summary.get("errors")
+        if problems:
+            print(f"{'':>18} ({problems} lost or failed)")
+
+
+# Print the change of each metric against an earlier results file
+def print_comparison(document, path):
+    with open(path) as file:
+        previous = json.load(file)
+
+    print(f"\nChange from {path} (commit {previous.get('commit')})")
+    for name, summary in document["scenarios"].items():
+        before = previous["scenarios"].get(name)
+        if not before:
+            continue
+        changes = []
+        for metric in ("messages_per_s", "p50_ms", "p99_ms", "p999_ms"):
+            if summary.get(metric) is not None and before.get(metric):
+                changes.append(f"{metric} {(summary[metric] - before[metric]) / before[metric] * 100:+.1f}%")
+        print(f"{name:>18}: {', '.join(changes)}")
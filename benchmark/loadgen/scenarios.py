@@ -0,0 +1,209 @@
+# Scenarios run by each load generator process
+#
+# Every process runs its share of the clients through the same sequence of
+# phases. The processes and the controller (which measures elapsed time and
+# server RSS) meet at a barrier before and after each phase. Each process puts
+# one result dict per phase on the results queue.
+
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+from .simclient import SimClient, ROOT
+
+sys.path.insert(0, os.path.join(ROOT, "client"))
+
+from keystore import KeyPool
+
+import codec
+
+# Scenarios in the order they run (the client list is fetched between the
+# hello storm and the chat scenarios, it is not measured)
+SCENARIOS = ("hello_storm", "public_chat", "chat", "client_list", "client_list_delta")
+
+
+# Wait at a multiprocessing barrier without blocking the event loop
+async def wait_barrier(barrier):
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+
+# Connect every client and send its hello, limited to concurrency handshakes at a time
+async def hello_storm(clients, options):
+    semaphore = asyncio.Semaphore(options.concurrency)
+
+    async def hello(client):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await client.connect()
+                if await asyncio.wait_for(client.hello(), options.timeout):
+                    return time.perf_counter() - start
+            except Exception:
+                pass
+            return None
+
+    latencies = await asyncio.gather(*(hello(client) for client in clients))
+    return {
+        "latencies": [latency for latency in latencies if latency is not None],
+        "errors": sum(1 for latency in latencies if latency is None),
+    }
+
+
+# Fetch the full client list once (with the first client) and share it with all
+# clients of this process, waiting until it holds every simulated client
+async def fetch_client_list(clients, total, options):
+    client = clients[0]
+    deadline = time.monotonic() + options.timeout
+    while True:
+        reply = await client.request(lambda: client.websocket.send('{"type": "client_list_request"}'), ("client_list",))
+        await client.handle_client_list(reply)
+        if len(client.clients) >= total - 1 or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.2)
+
+    # One shared dict for all clients (contains this process's first client too)
+    shared = dict(client.clients)
+    shared[client.client_id] = {"public_key": client.public_key_pem.decode('utf-8')}
+    for other in clients:
+        other.clients = shared
+    return sorted(shared)
+
+
+# Wait until every client received what it expects (or the timeout passes)
+async def wait_delivered(clients, options):
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(asyncio.gather(*(client.done.wait() for client in clients)), options.timeout)
+
+
+# Send messages from each client in senders, at most rate messages/s per client (0 = no limit)
+async def send_all(senders, send, options):
+    async def run(client):
+        interval = 1 / options.rate if options.rate else 0
+        for i in range(options.messages):
+            await send(client, i)
+            if interval:
+                await asyncio.sleep(interval)
+
+    await asyncio.gather(*(run(client) for client in senders))
+
+
+def delivery_result(clients):
+    return {
+        "sent": [entry for client in clients for entry in client.sent],
+        "received": [entry for client in clients for entry in client.received],
+        "expected": sum(client.expected for client in clients),
+    }
+
+
+# The first options.senders clients (over all processes) broadcast public chats
+async def public_chat(clients, indices, options):
+    senders = [client for client, index in zip(clients, indices) if index < options.senders]
+    sent_total = min(options.senders, options.clients) * options.messages
+    for client, index in zip(clients, indices):
+        own = options.messages if index < options.senders else 0
+        client.expect(sent_total - own)
+
+    await send_all(senders, lambda client, i: client.send_public(f"load {i}"), options)
+    await wait_delivered(clients, options)
+    return delivery_result(clients)
+
+
+# Every client sends private chats to the clients after it in the (sorted)
+# client ID list, so every client also receives exactly options.messages chats
+async def chat(clients, client_ids, options):
+    total = len(client_ids)
+    position = {client_id: i for i, client_id in enumerate(client_ids)}
+    for client in clients:
+        client.expect(options.messages if total > 1 else 0)
+
+    def recipient(client, i):
+        return client_ids[(position[client.client_id] + 1 + i % (total - 1)) % total]
+
+    if total > 1:
+        await send_all(clients, lambda client, i: client.send_chat(f"load {i}", recipient(client, i)), options)
+    await wait_delivered(clients, options)
+    return delivery_result(clients)
+
+
+# Every client requests the client list options.polls times (one request at a time)
+async def client_list(clients, options, delta):
+    async def poll(client):
+        message = {"type": "client_list_request"}
+        if delta:
+            message["list_id"] = client.client_list_id
+            message["version"] = client.client_list_version
+        frame = codec.dumps(message)
+
+        latencies = []
+        for _ in range(options.polls):
+            start = time.perf_counter()
+            try:
+                reply = await asyncio.wait_for(client.request(lambda: client.websocket.send(frame), ("client_list", "client_update")), options.timeout)
+            except Exception:
+                break
+            latencies.append(time.perf_counter() - start)
+
+            # Keep the version for the delta requests
+            if reply.get("type") == "client_list":
+                client.client_list_id = reply.get("list_id")
+                client.client_list_version = reply.get("version")
+        return latencies
+
+    results = await asyncio.gather(*(poll(client) for client in clients))
+    latencies = [latency for result in results for latency in result]
+    return {
+        "latencies": latencies,
+        "errors": len(clients) * options.polls - len(latencies),
+    }
+
+
+async def run_clients(options, first, count, barrier, results):
+    keys = KeyPool(options.keys).load(count, first)
+    clients = [SimClient(options.uri, key) for key in keys]
+
+    # Compute client IDs (and the signing key) before the storm starts
+    for client in clients:
+        client.client_id
+
+    await wait_barrier(barrier)
+    results.put(("hello_storm", await hello_storm(clients, options)))
+    await wait_barrier(barrier)
+
+    # Not measured: every client needs the others' public keys for the chat scenario
+    connected, indices = [], []
+    for index, client in enumerate(clients, first):
+        if client.reader_task is not None and not client.reader_task.done():
+            connected.append(client)
+            indices.append(index)
+    client_ids = await fetch_client_list(connected, options.clients, options) if connected else []
+
+    await wait_barrier(barrier)
+    results.put(("public_chat", await public_chat(connected, indices, options)))
+    await wait_barrier(barrier)
+
+    await wait_barrier(barrier)
+    results.put(("chat", await chat(connected, client_ids, options)))
+    await wait_barrier(barrier)
+
+    await wait_barrier(barrier)
+    results.put(("client_list", await client_list(connected, options, delta=False)))
+    await wait_barrier(barrier)
+
+    await wait_barrier(barrier)
+    results.put(("client_list_delta", await client_list(connected, options, delta=True)))
+    await wait_barrier(barrier)
+
+    await asyncio.gather(*(client.close() for client in connected), return_exceptions=True)
+
+
+# Entry point of a load generator process (client output is discarded)
+def run_process(options, first, count, barrier, results):
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(run_clients(options, first, count, barrier, results))
+    except BaseException:
+        # Release the other processes and the controller waiting at the barrier
+        barrier.abort()
+        raise
@@ -0,0 +1,103 @@
+# Simulated client
+#
+# A headless Client that does not print or decrypt what it receives. It only
+# records when each signed message arrives, keyed by the end of the message's
+# signature (the server relays frames unchanged, so the sender records the
+# same key when it sends). Joining the two gives the delivery latency, even
+# when sender and receiver are in different processes.
+
+import asyncio
+import os
+import sys
+import time
+
+import websockets
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+
+from client import Client
+
+import codec
+
+# Characters at the end of a signed data frame used to identify it (base64 signature)
+MESSAGE_KEY_LENGTH = 32
+
+
+# Key identifying a signed data frame (encode_signed_data puts the signature last)
+def message_key(frame):
+    return frame[-MESSAGE_KEY_LENGTH - 2:-2]
+
+
+class SimClient(Client):
+    def __init__(self, uri, private_key):
+        super().__init__(uri, private_key=private_key)
+
+        # (message key, send time) for signed messages sent
+        self.sent = []
+
+        # (message key, arrival time) for signed messages received
+        self.received = []
+        self.expected = 0
+        self.done = asyncio.Event()
+
+        # Future waiting for the next reply (hello status or client list)
+        # and the message types accepted as that reply
+        self.reply = None
+        self.reply_types = ()
+        self.reader_task = None
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.uri, max_size=None, open_timeout=None)
+        self.reader_task = asyncio.ensure_future(self.reader())
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    # Record every signed message sent (with its send time)
+    async def send_frame(self, frame):
+        if '"signed_data"' in frame[:32]:
+            self.sent.append((message_key(frame), time.time()))
+        await self.websocket.send(frame)
+
+    # Start counting received messages for a new scenario
+    def expect(self, count):
+        self.sent = []
+        self.received = []
+        self.expected = count
+        self.done.clear()
+        if count <= 0:
+            self.done.set()
+
+    # Send a frame and wait for the server's reply to it (the first message of
+    # one of the given types, status replies have no type)
+    async def request(self, send, reply_types):
+        self.reply = asyncio.get_running_loop().create_future()
+        self.reply_types = reply_types
+        await send()
+        return await self.reply
+
+    async def hello(self):
+        reply = await self.request(self.send_hello, (None,))
+        return reply.get("status") == "success"
+
+    async def reader(self):
+        try:
+            async for frame in self.websocket:
+                if '"signed_data"' in frame[:32]:
+                    self.received.append((message_key(frame), time.time()))
+                    if len(self.received) >= self.expected:
+                        self.done.set()
+                    continue
+
+                # Status replies and client lists
+                if self.reply is not None and not self.reply.done():
+                    message = codec.loads(frame)
+                    if message.get("type") in self.reply_types:
+                        self.reply.set_result(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self.reply is not None and not self.reply.done():
+                self.reply.set_result({})
@@ -1,197 +1,280 @@
+import argparse
 import asyncio
 import websockets
-import json
 import base64
+import functools
+import getpass
 import hashlib
+import os
+import random
 import secrets
+import sys
+import time
 from aioconsole import ainput
 
-from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
 
-# VULNERABLE MODULES
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import AES, PKCS1_OAEP
+# Shared modules (message codec) are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import codec
+import signer
+import transfer
+from history import MessageHistory
+from keystore import KeyStore, generate_private_key
+from signer import SigningPool, fingerprint
+
+# Sends that can be waiting to be prepared or written in batch mode
+BATCH_WINDOW = 1024
+
 
 class Client:
-    def __init__(self, uri):
+    # key_store: KeyStore to load the identity from (created on first use if missing)
+    # private_key: existing private key to use (e.g. from a KeyPool)
+    # Without either, a new key pair is generated. Keys are only loaded or
+    # generated when first needed.
+    # signing_pool: SigningPool that encrypts, signs and decrypts messages
+    # (by default one thread pool shared by all clients)
+    # encoding: wire encoding to ask the server for ("json" or "msgpack", see codec.py)
+    # history: MessageHistory to keep sent and received chats in (none kept without it)
+    def __init__(self, uri, key_store: KeyStore = None, private_key=None, signing_pool: SigningPool = None, encoding="json",
+                 history: MessageHistory = None):
+        if encoding not in codec.available_encodings():
+            raise ValueError(f"Encoding not available: {encoding}")
+
         # Address of server to connect to
         self.uri = uri
 
+        # Encoding asked for at hello, and the one in use (JSON until the server agrees to another)
+        self.preferred_encoding = encoding
+        self.encoding = "json"
+
         # Counter value (to be sent with signed data)
         self.counter = 0
 
         # Websocket connection object
         self.websocket = None
 
-        # 2048-bit RSA key pair
-        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-        
-        # Private key (unencrypted for now)
-        self.private_key_pem = self.private_key.private_bytes(
-            encoding=serialization.Encoding.PEM, 
+        # Where the identity comes from
+        self.key_store = key_store
+        if private_key is not None:
+            self.private_key = private_key
+
+        self.signing_pool = signing_pool or signer.default_pool()
+
+        # List of clients on home server (excluding this one)
+        self.clients = {}
+
+        # Clients that have left since we connected (chats to them are stored
+        # by the server until they connect again)
+        self.offline_clients = {}
+
+        # Version of the client list held (None until the first full list is received)
+        # and the server's ID for its list versions
+        self.client_list_version = None
+        self.client_list_id = None
+        self.client_list_ready = asyncio.Event()
+
+        # Frames to send, in counter order: (future for the frame, future set once it is sent)
+        self.send_queue = asyncio.Queue()
+        self.sender_task = None
+
+        # Incoming messages (or futures for messages still being decrypted), None once disconnected
+        self.incoming = asyncio.Queue()
+        self.listener_task = None
+
+        # Future for the server's reply to our hello
+        self.hello_reply = None
+
+        # Server's file upload URL and the token to upload with (from the hello reply, None if it does not take files)
+        self.upload_url = None
+        self.upload_token = None
+
+        # Ticket from the server's last hello reply, to resume the session with when reconnecting
+        self.ticket = None
+
+        # Sent and received chats (see history.py)
+        self.history = history
+
+    # 2048-bit RSA key pair
+    @functools.cached_property
+    def private_key(self):
+        if self.key_store is not None:
+            return self.key_store.load_or_create()
+        return generate_private_key()
+
+    # Private key (unencrypted, only kept in memory)
+    @functools.cached_property
+    def private_key_pem(self):
+        return self.private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
             format=serialization.PrivateFormat.PKCS8,
             encryption_algorithm=serialization.NoEncryption()
             )
-        
-        # Public key
-        self.public_key_pem = self.private_key.public_key().public_bytes(
+
+    # Public key
+    @functools.cached_property
+    def public_key_pem(self):
+        return self.private_key.public_key().public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
             )
 
-        # Client's own client ID (SHA256 of base64 encoded public key)
-        self.client_id = hashlib.sha256(base64.b64encode(self.public_key_pem)).hexdigest()
-
-        # List of clients on home server (excluding this one)
-        self.clients = {}
+    # Client's own client ID (SHA256 of base64 encoded public key)
+    @functools.cached_property
+    def client_id(self):
+        return hashlib.sha256(base64.b64encode(self.public_key_pem)).hexdigest()
 
-    # Function to generate signed data messages
+    # Function to generate signed data messages (signed on the event loop)
     def generate_signed_data(self, data):
-        # Concatenate data and counter (this will form the signature)
-        data_c = bytes(json.dumps(data) + str(self.counter), 'utf-8')
-
-        # Sign the hash using the RSA private key
-        signature = self.private_key.sign(
-            data_c, 
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ), 
-            hashes.SHA256()
-            )
+        # Create the signed data structure (signature covers data and counter, see codec.py)
+        signed_data = codec.encode_signed_data(data, self.next_counter(), self.sign, self.encoding)
 
-        # Base64 encode the signature
-        signature_b64 = base64.b64encode(signature).decode('utf-8')
+        return signed_data
 
-        # Create the signed data structure
-        signed_data = {
-            "type": "signed_data",
-            "data": data,
-            "counter": self.counter,
-            "signature": signature_b64
-        }
-
-        # Increment counter value (for future signed data messages)
+    # Counter value for the next signed data message
+    def next_counter(self):
+        counter = self.counter
         self.counter += 1
+        return counter
+
+    # Sign bytes using the RSA private key, returning the signature bytes
+    def sign(self, data_c):
+        return signer.sign(self.private_key, data_c)
 
-        return json.dumps(signed_data)
+    # Send one frame to the server
+    async def send_frame(self, frame):
+        await self.websocket.send(frame)
 
     # Helper function to generate and send a hello message
     async def send_hello(self):
-        print("Sending hello message to server...")
-        # Create hello message with the client's public key
+        # Create hello message with the client's public key (and the encodings it can
+        # use, best first, if it would like something other than JSON)
         data = {"type": "hello", "public_key": self.public_key_pem.decode('utf-8')}
+        if self.preferred_encoding != "json":
+            data["encodings"] = [self.preferred_encoding, "json"]
 
-        # Generate signed data for the hello message
-        hello_msg = self.generate_signed_data(data)
-
-        # Send the hello message
-        await self.websocket.send(hello_msg)
-
-    # Function to encrypt a message using AES-GCM
-    def aes_encrypt_message(self, aes_key, message):
-        aes_cipher = AES.new(aes_key, AES.MODE_GCM)
-        ciphertext, tag = aes_cipher.encrypt_and_digest(message.encode('utf-8'))
+        # Generate signed data for the hello message and send it
+        await self.send_frame(self.generate_signed_data(data))
 
-        # Return the encrypted message components in base64 format for safe transmission
-        return {
-            "ciphertext": base64.b64encode(ciphertext).decode('utf-8'),
-            "nonce": base64.b64encode(aes_cipher.nonce).decode('utf-8'),
-            "tag": base64.b64encode(tag).decode('utf-8')
-        }
-
-    # Function to decrypt a message using AES-GCM
-    def aes_decrypt_message(self, aes_key, encrypted_message):
-        ciphertext = base64.b64decode(encrypted_message["ciphertext"])
-        nonce = base64.b64decode(encrypted_message["nonce"])
-        tag = base64.b64decode(encrypted_message["tag"])
-
-        aes_cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
-        try:
-            # Decrypt the message and verify its integrity
-            message = aes_cipher.decrypt_and_verify(ciphertext, tag)
-            return message.decode('utf-8')
-        except ValueError:
-            print("Decryption failed. Invalid AES key or message tampered.")
-            return None
+    # Resume the session with the ticket from the last connection (no signature needed,
+    # the server checks the ticket instead), with the last counter used
+    async def send_resume(self):
+        message = {"type": "resume", "ticket": self.ticket, "public_key": self.public_key_pem.decode('utf-8'), "counter": self.counter - 1}
+        if self.preferred_encoding != "json":
+            message["encodings"] = [self.preferred_encoding, "json"]
+        await self.send_frame(codec.dumps(message))
 
     # Function to encrypt the AES key using the recipient's RSA public key
     def encrypt_aes_key(self, recipient_public_key):
         # Generate a 256-bit AES key
         aes_key = secrets.token_bytes(32)
 
-        # Import the recipient's RSA public key and encrypt the AES key
-        recipient_key = RSA.import_key(recipient_public_key.encode('utf-8'))
-        cipher_rsa = PKCS1_OAEP.new(recipient_key)
-        encrypted_aes_key = cipher_rsa.encrypt(aes_key)
+        return aes_key, self.wrap_aes_key(aes_key, recipient_public_key)
 
-        return aes_key, base64.b64encode(encrypted_aes_key).decode('utf-8')
+    # Function to encrypt an existing AES key for one recipient (base64 result, raw bytes for the binary encoding)
+    def wrap_aes_key(self, aes_key, recipient_public_key):
+        return signer.wrap_aes_key(aes_key, recipient_public_key, self.encoding)
 
     # Function to decrypt the AES key using the client's own RSA private key
     def decrypt_aes_key(self, encrypted_aes_key):
-        encrypted_aes_key_bytes = base64.b64decode(encrypted_aes_key)
-
-        pc_private_key = RSA.import_key(self.private_key_pem)
-
-        # Decrypt the AES key using the client's private RSA key
-        cipher_rsa = PKCS1_OAEP.new(pc_private_key)
-        aes_key = cipher_rsa.decrypt(encrypted_aes_key_bytes)
-
-        return aes_key
-
-    # Function to send a public chat message to all connected clients
-    async def send_public_chat(self, message):
-        # Create the public chat message structure
-        data = {
-            "type": "public_chat",
-            "sender": self.client_id,
-            "message": message
-        }
-
-        # Generate signed data for the public chat message
-        public_chat_msg = self.generate_signed_data(data)
-
-        # Send the public chat message to the server
-        await self.websocket.send(public_chat_msg)
-        print("Public chat message sent.")
-
-    # Function to send an encrypted private chat message
-    async def send_chat(self, message, recipient_id):
-        if recipient_id not in self.clients:
-            print(f"Client {recipient_id} not found in client list.")
+        return signer.decrypt_cipher(self.private_key_pem).decrypt(codec.decode_bytes(encrypted_aes_key))
+
+    # Queue a frame built by function(private key PEM, *args, counter, encoding) in the signing pool
+    # Frames are sent in the order they were queued (so counters stay in order),
+    # returns a future that is set once the frame is sent
+    def queue_frame(self, function, *args):
+        frame = self.signing_pool.submit(function, self.private_key_pem, *args, self.next_counter(), self.encoding)
+        sent = asyncio.get_running_loop().create_future()
+        self.send_queue.put_nowait((frame, sent))
+
+        if self.sender_task is None:
+            self.sender_task = asyncio.ensure_future(self.sender())
+        return sent
+
+    # Send queued frames as they become ready
+    async def sender(self):
+        while True:
+            frame, sent = await self.send_queue.get()
+            try:
+                await self.send_frame(await frame)
+                if not sent.done():
+                    sent.set_result(None)
+            except Exception as error:
+                if not sent.done():
+                    sent.set_exception(error)
+            finally:
+                self.send_queue.task_done()
+
+    # Send a public chat message to all connected clients
+    # Returns a future that is set once the message is sent
+    def send_public(self, message):
+        sent = self.queue_frame(signer.public_chat_frame, self.client_id, message)
+        if self.history is not None:
+            sent.add_done_callback(functools.partial(self.record_sent, "public_chat", [], message))
+        return sent
+
+    # Send an encrypted chat message to one client ID, or to a list of client IDs
+    # (a group chat: the message is encrypted and signed once, and the AES key is
+    # wrapped for each recipient)
+    # Returns a future that is set once the message is sent. Raises ValueError if
+    # a recipient is not in the client list (or a client seen since connecting).
+    def send_chat(self, message, recipient_ids):
+        if isinstance(recipient_ids, str):
+            recipient_ids = [recipient_ids]
+
+        recipients = []
+        for recipient_id in recipient_ids:
+            recipient = self.clients.get(recipient_id) or self.offline_clients.get(recipient_id)
+            if recipient is None:
+                raise ValueError(f"Client {recipient_id} not found in client list.")
+            recipients.append((recipient_id, recipient['public_key']))
+
+        sent = self.queue_frame(signer.chat_frame, self.client_id, recipients, message)
+        if self.history is not None:
+            sent.add_done_callback(functools.partial(self.record_sent, "chat", list(recipient_ids), message))
+        return sent
+
+    # Add a sent chat to the history (once it has been sent)
+    def record_sent(self, message_type, recipient_ids, message, sent):
+        if not sent.cancelled() and sent.exception() is None:
+            self.history.add("out", message_type, self.client_id, recipient_ids, message)
+
+    # Add a received chat to the history once it has been decrypted (with the time it arrived)
+    def record_received(self, arrived, decrypted):
+        if decrypted.cancelled() or decrypted.exception() is not None:
             return
-
-        # Get the recipient's public key
-        recipient_public_key = self.clients[recipient_id]['public_key']
-
-        # Encrypt the AES key with the recipient's RSA public key
-        aes_key, encrypted_aes_key = self.encrypt_aes_key(recipient_public_key)
-
-        # Encrypt the message using AES
-        encrypted_message = self.aes_encrypt_message(aes_key, message)
-
-        # Create the chat message structure
-        data = {
-            "type": "chat",
-            "sender": self.client_id,
-            "recipient": recipient_id,
-            "aes_key": encrypted_aes_key,
-            "message": encrypted_message
-        }
-
-        # Generate signed data and send it
-        chat_msg = self.generate_signed_data(data)
-        await self.websocket.send(chat_msg)
-        print("Encrypted chat message sent.")
+        chat = decrypted.result()
+        if chat["message"] is not None:
+            self.history.add("in", "chat", chat["sender"], chat["recipients"], chat["message"], arrived)
+
+    # Upload a file to the server and send its URL in a chat (or a public chat if
+    # there are no recipients). The file is streamed, never read into memory.
+    # Returns the file's URL.
+    async def send_file(self, path, recipient_ids=None):
+        if self.upload_url is None:
+            raise ValueError("Server does not accept file uploads.")
+
+        file_url = await transfer.upload(self.upload_url, path, self.upload_token)
+        message = f"[file] {os.path.basename(path)} {file_url}"
+        if recipient_ids:
+            await self.send_chat(message, recipient_ids)
+        else:
+            await self.send_public(message)
+        return file_url
+
+    # Download a file sent in a chat to path
+    async def download_file(self, file_url, path):
+        await transfer.download(file_url, path)
 
     # Function to send a client list request
     async def client_list_request(self):
-        # Create a client list request message
+        # Create a client list request message (with our version, so only changes are sent back)
         message = {"type": "client_list_request"}
-        await self.websocket.send(json.dumps(message))
+        if self.client_list_version is not None:
+            message["list_id"] = self.client_list_id
+            message["version"] = self.client_list_version
+        await self.send_frame(codec.dumps(message))
 
     # Handle the received client list from the server
     async def handle_client_list(self, message):
@@ -200,7 +283,7 @@ class Client:
 
         for server in message["servers"]:
             for public_key in server['clients']:
-                client_id = hashlib.sha256(base64.b64encode(public_key.encode('utf-8'))).hexdigest()
+                client_id = fingerprint(public_key)
                 if client_id != self.client_id:
                     temp_list[client_id] = {
                         "home_server": server["address"],
@@ -209,7 +292,55 @@ class Client:
                     }
 
         # Replace the client's stored client list with the received list
+        for client_id, client in self.clients.items():
+            if client_id not in temp_list:
+                self.offline_clients[client_id] = client
+        for client_id in temp_list:
+            self.offline_clients.pop(client_id, None)
         self.clients = temp_list
+        self.client_list_version = message.get("version")
+        self.client_list_id = message.get("list_id")
+        self.client_list_ready.set()
+
+    # Apply client list changes from the server to the stored client list
+    async def handle_client_update(self, message):
+        # Nothing to apply to yet
+        if self.client_list_version is None:
+            return
+
+        # Versions are from a different list (e.g. the server restarted), fetch the whole list again
+        if message.get("list_id") != self.client_list_id:
+            self.client_list_version = None
+            await self.client_list_request()
+            return
+
+        # Already have these changes
+        if message["version"] <= self.client_list_version:
+            return
+
+        # Missed some changes, fetch the whole list again
+        if message["base_version"] > self.client_list_version:
+            self.client_list_version = None
+            await self.client_list_request()
+            return
+
+        for server in message["servers"]:
+            for client_id in server["removed"]:
+                client = self.clients.pop(client_id, None)
+                if client is not None:
+                    self.offline_clients[client_id] = client
+
+            for public_key in server["added"]:
+                client_id = fingerprint(public_key)
+                if client_id != self.client_id:
+                    self.offline_clients.pop(client_id, None)
+                    self.clients[client_id] = {
+                        "home_server": server["address"],
+                        "fingerprint": client_id,
+                        "public_key": public_key,
+                    }
+
+        self.client_list_version = message["version"]
 
     # Print the list of clients
     def print_client_list(self):
@@ -217,40 +348,45 @@ class Client:
         for client in self.clients:
             home_server = self.clients[client]["home_server"]
             print(f"{client} ({home_server})")
+        for client in self.offline_clients:
+            print(f"{client} (offline, chats are delivered when it reconnects)")
 
-    # Handle signed data messages
+    # Handle signed data messages (decoded messages are passed on to messages())
     async def handle_signed_data(self, message):
-        message_type = message["data"]["type"]
+        data = message["data"]
 
-        match message_type:
+        match data["type"]:
             case "public_chat":
-                sender = message["data"]["sender"]
-                chat = message["data"]["message"]
-                print(f"From {sender} (public): {chat}")
+                self.incoming.put_nowait({"type": "public_chat", "sender": data["sender"], "message": data["message"]})
+                if self.history is not None:
+                    self.history.add("in", "public_chat", data["sender"], [], data["message"])
             case "chat":
-                sender = message["data"]["sender"]
-                encrypted_message = message["data"]["message"]
-                encrypted_aes_key = message["data"]["aes_key"]
-
-                # Decrypt the AES key using the client's private key
-                aes_key = self.decrypt_aes_key(encrypted_aes_key)
-
-                # Decrypt the message using the AES key
-                decrypted_message = self.aes_decrypt_message(aes_key, encrypted_message)
-
-                if decrypted_message:
-                    print(f"From {sender} (private): {decrypted_message}")
+                # Decrypted in the signing pool (messages() keeps the arrival order)
+                decrypted = self.signing_pool.submit(signer.decrypt_chat, self.private_key_pem, self.client_id, data)
+                if self.history is not None:
+                    decrypted.add_done_callback(functools.partial(self.record_received, time.time()))
+                self.incoming.put_nowait(decrypted)
             case _:
                 print("Invalid message type received")
 
     # Listen for messages from the server
     async def listen(self):
-        async for message in self.websocket:
-            data = json.loads(message)
-            if "type" not in data.keys():
-                print(f"Received from server: {message}")
-            else:
-                await self.handle_messages(data)
+        try:
+            async for frame in self.websocket:
+                message = codec.loads(frame)
+                if "type" in message:
+                    await self.handle_messages(message)
+                elif self.hello_reply is not None and not self.hello_reply.done():
+                    self.hello_reply.set_result(message)
+                else:
+                    # Status replies (e.g. errors for messages we sent)
+                    self.incoming.put_nowait(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self.hello_reply is not None and not self.hello_reply.done():
+                self.hello_reply.set_exception(ConnectionError("Connection closed before hello was accepted"))
+            self.incoming.put_nowait(None)
 
     # Handle the received message based on its type
     async def handle_messages(self, message):
@@ -261,22 +397,174 @@ class Client:
                 await self.handle_signed_data(message)
             case "client_list":
                 await self.handle_client_list(message)
+            case "client_update":
+                await self.handle_client_update(message)
             case _:
                 print("Invalid message type received")
 
-    # Run the client
-    async def run(self):
-        print(f"Connecting to server at {self.uri}...")
-        self.websocket = await websockets.connect(self.uri)
+    # Connect to the server, send hello and wait for the client list
+    # Calling connect again after the connection was lost resumes the session
+    # (falling back to hello if the server does not accept the ticket). A busy
+    # server is tried again after the delay it asks for, until the timeout.
+    # Raises ConnectionError if the server rejects the hello
+    async def connect(self, timeout=30):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            reply = await self.open_session(deadline - loop.time())
+            if reply.get("status") == "success":
+                break
 
-        # Send hello message
-        await self.send_hello()
+            await self.close()
+            retry_after = reply.get("retry_after")
+            if retry_after is None or loop.time() + retry_after > deadline:
+                raise ConnectionError(reply.get("message", "Hello rejected"))
 
-        # Start listening for incoming messages
-        asyncio.ensure_future(self.listen())
+            # Spread the retries of clients turned away together
+            await asyncio.sleep(retry_after * random.uniform(0.5, 1.5))
+
+        self.encoding = reply.get("encoding", "json")
+        self.upload_url = reply.get("upload_url")
+        self.upload_token = reply.get("upload_token")
+        self.ticket = reply.get("ticket")
 
-        # Request the client list
         await self.client_list_request()
+        await asyncio.wait_for(self.client_list_ready.wait(), max(deadline - loop.time(), 0))
+
+    # Open a connection and send resume (if we have a ticket) or hello, returning the server's reply
+    async def open_session(self, timeout):
+        self.websocket = await websockets.connect(self.uri)
+        self.encoding = "json"
+
+        # messages() ends with the previous connection, so each connection gets its own queue
+        self.incoming = asyncio.Queue()
+        self.listener_task = asyncio.ensure_future(self.listen())
+
+        if self.ticket is not None:
+            reply = await self.hello_exchange(self.send_resume, timeout)
+            if reply.get("status") == "success":
+                return reply
+            self.ticket = None
+
+        return await self.hello_exchange(self.send_hello, timeout)
+
+    # Send hello (or resume) and wait for the reply
+    async def hello_exchange(self, send, timeout):
+        self.hello_reply = asyncio.get_running_loop().create_future()
+        await send()
+        return await asyncio.wait_for(self.hello_reply, timeout)
+
+    # Send everything still queued, then close the connection
+    async def close(self):
+        if self.websocket is None:
+            return
+
+        if self.sender_task is not None:
+            if self.websocket.open:
+                await self.send_queue.join()
+            self.sender_task.cancel()
+            self.sender_task = None
+
+        await self.websocket.close()
+        if self.listener_task is not None:
+            await self.listener_task
+
+        if self.history is not None:
+            await self.history.flush()
+
+    # Incoming messages, in arrival order, until the connection closes:
+    #   {"type": "public_chat", "sender", "message"}
+    #   {"type": "chat", "sender", "recipients", "message"} (message is None if it could not be decrypted)
+    #   status replies from the server, e.g. {"status": "error", "message"}
+    async def messages(self):
+        while True:
+            message = await self.incoming.get()
+            if message is None:
+                return
+            if asyncio.isfuture(message):
+                message = await message
+            yield message
+
+    # Print incoming messages (interactive mode)
+    async def print_messages(self):
+        async for message in self.messages():
+            match message.get("type"):
+                case "public_chat":
+                    print(f"From {message['sender']} (public): {message['message']}")
+                case "chat" if message["message"] is None:
+                    print("Decryption failed. Invalid AES key or message tampered.")
+                case "chat":
+                    print(f"From {message['sender']} (private): {message['message']}")
+                case _:
+                    print(f"Received from server: {message}")
+
+    # Print messages from the history, oldest first
+    def print_history(self, messages):
+        for message in sorted(messages, key=lambda message: message["id"]):
+            sent = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message["time"]))
+            kind = "public" if message["type"] == "public_chat" else "private"
+            if message["direction"] == "out":
+                to = " to " + ", ".join(message["recipients"]) if message["recipients"] else ""
+                print(f"[{sent}] You ({kind}){to}: {message['message']}")
+            else:
+                print(f"[{sent}] From {message['sender']} ({kind}): {message['message']}")
+
+    # Send messages read from a file, one per line, at up to rate messages/s (0 = no limit):
+    #   <message>                   public chat
+    #   chat <id>[,<id>...] <message>  private chat (group chat for several IDs)
+    # Messages are prepared and sent in the background, with up to window sends pending.
+    async def run_batch(self, file, rate=0, window=BATCH_WINDOW):
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Semaphore(window)
+        rejected = 0
+
+        sends = []
+        start = time.perf_counter()
+        while True:
+            # Read in a thread, so a slow pipe does not block sending
+            line = await loop.run_in_executor(None, file.readline)
+            if not line:
+                break
+            line = line.rstrip("\n")
+            if not line:
+                continue
+
+            # Keep to the target rate
+            if rate:
+                delay = start + len(sends) / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await pending.acquire()
+            try:
+                if line.startswith("chat "):
+                    _, recipient_ids, message = (line.split(" ", 2) + [""])[:3]
+                    future = self.send_chat(message, recipient_ids.split(","))
+                else:
+                    future = self.send_public(line)
+            except ValueError as error:
+                pending.release()
+                rejected += 1
+                print(error, file=sys.stderr)
+                continue
+
+            future.add_done_callback(lambda _: pending.release())
+            sends.append(future)
+
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        sent = sum(1 for result in results if not isinstance(result, BaseException))
+        errors = len(results) - sent + rejected
+        print(f"Sent {sent} messages in {elapsed:.2f}s ({sent / elapsed:.1f} msg/s), {errors} errors", file=sys.stderr)
+
+    # Run the client
+    async def run(self):
+        print(f"Connecting to server at {self.uri}...")
+        await self.connect()
+        print(f"Connected as {self.client_id}")
+
+        # Print incoming messages in the background
+        asyncio.ensure_future(self.print_messages())
 
         # Main loop to handle user inputs
         while True:
@@ -285,29 +573,94 @@ class Client:
             match prompt:
                 case "public":
                     public_message = await ainput("Enter a message: ")
-                    await self.send_public_chat(public_message)
+                    await self.send_public(public_message)
+                    print("Public chat message sent.")
                 case "chat":
                     await self.client_list_request()
                     self.print_client_list()
-                    recipient_id = await ainput("Enter recipient Client ID: ")
+                    recipient_ids = (await ainput("Enter recipient Client ID(s), separated by spaces: ")).split()
                     chat_message = await ainput("Enter a message: ")
-                    await self.send_chat(chat_message, recipient_id)
+                    if recipient_ids:
+                        try:
+                            await self.send_chat(chat_message, recipient_ids)
+                            print(f"Encrypted chat message sent to {len(recipient_ids)} recipient(s).")
+                        except ValueError as error:
+                            print(error)
+                case "file":
+                    await self.client_list_request()
+                    self.print_client_list()
+                    path = await ainput("Enter the path of the file: ")
+                    recipient_ids = (await ainput("Enter recipient Client ID(s), separated by spaces (none for public): ")).split()
+                    try:
+                        file_url = await self.send_file(path, recipient_ids)
+                        print(f"File uploaded and sent: {file_url}")
+                    except (OSError, ValueError) as error:
+                        print(error)
+                case "download":
+                    file_url = await ainput("Enter the file URL: ")
+                    path = await ainput("Save as: ")
+                    try:
+                        await self.download_file(file_url, path)
+                        print(f"File saved to {path}")
+                    except (OSError, ValueError) as error:
+                        print(error)
+                case "history" | "search" if self.history is None:
+                    print("No message history kept (start the client with --history FILE).")
+                case "history":
+                    client_id = (await ainput("Enter a Client ID (none for all messages): ")).strip()
+                    messages = await self.history.query(sender=client_id) if client_id else await self.history.query()
+                    if client_id:
+                        messages += await self.history.query(recipient=client_id)
+                    self.print_history(messages)
+                case "search":
+                    words = await ainput("Enter words to search for: ")
+                    self.print_history(await self.history.search(words))
                 case "list":
                     await self.client_list_request()
                     self.print_client_list()
                 case "close":
                     print("Closing connection to server...")
-                    if self.websocket:
-                        await self.websocket.close()
+                    await self.close()
                     return
                 case _:
-                    print("Valid commands are ('public', 'chat', 'list', 'close')")
+                    print("Valid commands are ('public', 'chat', 'file', 'download', 'history', 'search', 'list', 'close')")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OLAF Neighbourhood client")
+    parser.add_argument("--server", help="address (host:port) of the server to connect to (asked for if missing)")
+    parser.add_argument("--identity", help="file to keep this client's private key in (created if missing)")
+    parser.add_argument("--encrypt", action="store_true", help="encrypt the identity file with a password")
+    parser.add_argument("--batch", metavar="FILE", help="send the messages in FILE (- for stdin) instead of running interactively")
+    parser.add_argument("--rate", type=float, default=0, help="messages/s to send in batch mode (default 0, as fast as possible)")
+    parser.add_argument("--sign-mode", choices=signer.SIGNING_MODES, default="thread", help="where to encrypt and sign messages (default thread)")
+    parser.add_argument("--sign-workers", type=int, help="number of signing threads or processes")
+    parser.add_argument("--encoding", choices=codec.ENCODINGS, default="json", help="wire encoding to use if the server supports it (default json, msgpack needs the msgpack package)")
+    parser.add_argument("--history", metavar="FILE", help="keep sent and received chats in FILE (an SQLite database, created if missing)")
+    args = parser.parse_args()
+
+    # Stored identity (password from OLAF_IDENTITY_PASSWORD, or prompted for)
+    key_store = None
+    if args.identity:
+        password = os.environ.get("OLAF_IDENTITY_PASSWORD")
+        if password is None and args.encrypt:
+            password = getpass.getpass("Identity password: ")
+        key_store = KeyStore(args.identity, password)
+
     # Get host and port from user input
-    hostname = input("Enter address (host:port) of server to connect to: ")
+    hostname = args.server or input("Enter address (host:port) of server to connect to: ")
     uri = "ws://" + hostname
-    
+
     # Connect to server
-    client = Client(uri)
-    asyncio.run(client.run())
+    history = MessageHistory(args.history) if args.history else None
+    client = Client(uri, key_store, signing_pool=SigningPool(args.sign_mode, args.sign_workers), encoding=args.encoding, history=history)
+
+    if args.batch:
+        async def batch():
+            await client.connect()
+            with (sys.stdin if args.batch == "-" else open(args.batch)) as file:
+                await client.run_batch(file, args.rate)
+            await client.close()
+
+        asyncio.run(batch())
+    else:
+        asyncio.run(client.run())
@@ -0,0 +1,260 @@
+# Local message history
+#
+# MessageHistory keeps the public and private chats a client sends and
+# receives in an SQLite database (in WAL mode, so reads are not blocked by
+# writes), indexed by sender, recipient and time, with a full-text index on
+# the message text.
+#
+# Messages are added on the event loop without waiting: they are collected
+# and written in one transaction per batch (every batch_size messages, or
+# flush_interval seconds after the first one) by a writer thread. Queries run
+# on a reader thread with its own connection. Nothing is opened or read until
+# the history is first used, and queries return a page of messages at a time,
+# so a large history costs nothing at startup.
+#
+# Private chats are stored decrypted, so the file is only readable by the
+# current user (like the identity file, see keystore.py). Each history file is
+# meant for one client at a time.
+
+import asyncio
+import concurrent.futures
+import os
+import sqlite3
+import sys
+import time
+
+# Messages written per transaction (the full-text index writes a new segment per
+# transaction, so larger batches are much faster), and how long a message waits
+# for others to batch with (seconds)
+BATCH_SIZE = 5000
+FLUSH_INTERVAL = 0.5
+
+# Page cache per connection (bytes)
+CACHE_SIZE = 16 << 20
+
+# Messages returned per query by default
+PAGE_SIZE = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    direction TEXT NOT NULL,
+    type TEXT NOT NULL,
+    sender TEXT,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+
+CREATE TABLE IF NOT EXISTS recipients (
+    recipient TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (recipient, message_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS recipients_message ON recipients (message_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5 (message, content='messages', content_rowid='id');
+"""
+
+# Columns of a message row (recipients joined with spaces)
+COLUMNS = """
+    m.id, m.time, m.direction, m.type, m.sender, m.message,
+    (SELECT group_concat(recipient, ' ') FROM recipients WHERE message_id = m.id)
+"""
+
+
+# Open the database (created, readable only by the current user, if it does not exist)
+def open_database(path):
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # With WAL, only the last transactions can be lost on power failure (the file is never corrupted)
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA cache_size={-CACHE_SIZE // 1024}")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+# Message row as a dict (the format of Client.messages(), plus id, time and direction)
+def row_to_message(row):
+    message_id, sent, direction, message_type, sender, message, recipients = row
+    return {
+        "id": message_id,
+        "time": sent,
+        "direction": direction,
+        "type": message_type,
+        "sender": sender,
+        "recipients": recipients.split() if recipients else [],
+        "message": message,
+    }
+
+
+# Full-text query matching messages that contain all the words in text
+def match_words(text):
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+class MessageHistory:
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # Messages waiting to be written: (time, direction, type, sender, recipients, message)
+        self.pending = []
+        self.flush_handle = None
+
+        # Writer and reader threads, each with its own connection (opened on first use)
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-write")
+        self.reader = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-read")
+        self.write_connection = None
+        self.read_connection = None
+
+        # Next message ID (set when the writer opens the database) and the last batch written
+        self.next_id = None
+        self.last_write = None
+
+        # Counters
+        self.written = 0
+        self.batches = 0
+
+    # Add a message (direction "in" or "out"), to be written with the next batch
+    def add(self, direction, message_type, sender, recipients, message, sent=None):
+        self.pending.append((sent or time.time(), direction, message_type, sender, tuple(recipients), message))
+
+        if len(self.pending) >= self.batch_size:
+            self.write_pending()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.write_pending)
+
+    # Hand the pending messages to the writer thread
+    def write_pending(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        self.last_write = asyncio.get_running_loop().run_in_executor(self.writer, self.write_batch, batch)
+        self.last_write.add_done_callback(self.written_batch)
+
+    def written_batch(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Could not write message history: {future.exception()}", file=sys.stderr)
+
+    # Write everything added so far, and wait until it is written
+    async def flush(self):
+        self.write_pending()
+        if self.last_write is not None:
+            await asyncio.wait([self.last_write])
+
+    # Write a batch in one transaction (on the writer thread)
+    def write_batch(self, batch):
+        if self.write_connection is None:
+            self.write_connection = open_database(self.path)
+            self.next_id = (self.write_connection.execute("SELECT max(id) FROM messages").fetchone()[0] or 0) + 1
+
+        first = self.next_id
+        with self.write_connection:
+            self.write_connection.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                [(first + i, sent, direction, message_type, sender, message)
+                 for i, (sent, direction, message_type, sender, _, message) in enumerate(batch)]
+            )
+            self.write_connection.executemany(
+                "INSERT OR IGNORE INTO recipients VALUES (?, ?)",
+                [(recipient, first + i) for i, entry in enumerate(batch) for recipient in entry[4]]
+            )
+            self.write_connection.executemany(
+                "INSERT INTO messages_text (rowid, message) VALUES (?, ?)",
+                [(first + i, entry[5]) for i, entry in enumerate(batch) if entry[5] is not None]
+            )
+
+        self.next_id += len(batch)
+        self.written += len(batch)
+        self.batches += 1
+
+    # Run a query on the reader thread, returning all rows
+    async def read(self, sql, parameters=()):
+        return await asyncio.get_running_loop().run_in_executor(self.reader, self.fetch, sql, parameters)
+
+    def fetch(self, sql, parameters):
+        if self.read_connection is None:
+            self.read_connection = open_database(self.path)
+        return self.read_connection.execute(sql, parameters).fetchall()
+
+    # Messages newest first, optionally only those from a sender, to a recipient, or sent
+    # between since and until (times), a page at a time (before: ID of the last message of
+    # the previous page). Messages added but not yet written are not included.
+    async def query(self, sender=None, recipient=None, since=None, until=None, before=None, limit=PAGE_SIZE):
+        conditions = []
+        parameters = []
+        if recipient is not None:
+            source = "recipients r JOIN messages m ON m.id = r.message_id"
+            conditions.append("r.recipient = ?")
+            parameters.append(recipient)
+            order = "r.message_id"
+        else:
+            source = "messages m"
+            order = "m.id"
+
+        if sender is not None:
+            conditions.append("m.sender = ?")
+            parameters.append(sender)
+        if since is not None:
+            conditions.append("m.time >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("m.time < ?")
+            parameters.append(until)
+        if before is not None:
+            conditions.append(f"{order} < ?")
+            parameters.append(before)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = await self.read(f"SELECT {COLUMNS} FROM {source} {where} ORDER BY {order} DESC LIMIT ?", (*parameters, limit))
+        return [row_to_message(row) for row in rows]
+
+    # Messages containing all the words in text, newest first
+    async def search(self, text, before=None, limit=PAGE_SIZE):
+        match = match_words(text)
+        if not match:
+            return []
+
+        condition = "AND messages_text.rowid < ?" if before is not None else ""
+        parameters = (match, before, limit) if before is not None else (match, limit)
+        rows = await self.read(
+            f"SELECT {COLUMNS} FROM messages_text JOIN messages m ON m.id = messages_text.rowid "
+            f"WHERE messages_text MATCH ? {condition} ORDER BY messages_text.rowid DESC LIMIT ?",
+            parameters
+        )
+        return [row_to_message(row) for row in rows]
+
+    # Number of stored messages
+    async def count(self):
+        return (await self.read("SELECT count(*) FROM messages"))[0][0]
+
+    def stats(self):
+        return {"pending": len(self.pending), "written": self.written, "batches": self.batches}
+
+    # Write everything still pending, then close the database
+    async def close(self):
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.writer, self.close_connection, "write_connection")
+        await loop.run_in_executor(self.reader, self.close_connection, "read_connection")
+        self.writer.shutdown()
+        self.reader.shutdown()
+
+    def close_connection(self, name):
+        connection = getattr(self, name)
+        if connection is not None:
+            connection.close()
+            setattr(self, name, None)
@@ -0,0 +1,136 @@
+# Client identity storage
+#
+# KeyStore keeps a client's RSA private key on disk (optionally encrypted with
+# a password), so the client keeps the same identity between runs and does not
+# pay for key generation at startup.
+#
+# KeyPool is a directory of pre-generated private keys for test and load tools
+# that start many clients. Fill it offline with:
+#
+#   python3 keystore.py <pool directory> <number of keys>
+
+import concurrent.futures
+import os
+import sys
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+
+def generate_private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+# PEM (PKCS8) bytes for a private key, encrypted if a password is given
+def private_key_to_pem(private_key, password=None):
+    if password:
+        encryption = serialization.BestAvailableEncryption(password.encode('utf-8'))
+    else:
+        encryption = serialization.NoEncryption()
+
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=encryption
+        )
+
+
+# Load a private key written by this module
+# The RSA key consistency check is slow (tens of ms) but stops a corrupted or
+# tampered key from making faulty signatures that can leak the private key, so
+# it is only skipped (validate=False) for throwaway test keys.
+def private_key_from_pem(pem, password=None, validate=True):
+    return serialization.load_pem_private_key(
+        pem,
+        password.encode('utf-8') if password else None,
+        unsafe_skip_rsa_key_validation=not validate
+        )
+
+
+# Write a file readable only by the current user
+def write_private_file(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as file:
+        file.write(data)
+
+
+# On-disk identity of one client
+class KeyStore:
+    def __init__(self, path, password=None):
+        self.path = path
+        self.password = password
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    # Load the stored private key, or generate and store a new one
+    def load_or_create(self):
+        if self.exists():
+            with open(self.path, "rb") as file:
+                return private_key_from_pem(file.read(), self.password)
+
+        private_key = generate_private_key()
+        self.save(private_key)
+        return private_key
+
+    def save(self, private_key):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_private_file(self.path, private_key_to_pem(private_key, self.password))
+
+
+def generate_pem(_):
+    return private_key_to_pem(generate_private_key())
+
+
+# Directory of pre-generated (unencrypted) private keys
+class KeyPool:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def paths(self):
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".pem"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def __len__(self):
+        return len(self.paths())
+
+    # Generate keys (in parallel) until the pool holds count keys
+    def fill(self, count, workers=None):
+        os.makedirs(self.directory, exist_ok=True)
+        existing = len(self)
+        if existing >= count:
+            return 0
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for i, pem in enumerate(executor.map(generate_pem, range(existing, count), chunksize=8), existing):
+                write_private_file(os.path.join(self.directory, f"key-{i:07d}.pem"), pem)
+
+        return count - existing
+
+    # Load count keys starting at offset (separate processes use separate offsets
+    # so every client gets its own identity). Pool keys are test identities, so
+    # they are loaded without the consistency check.
+    def load(self, count, offset=0):
+        paths = self.paths()[offset:offset + count]
+        if len(paths) < count:
+            raise ValueError(f"Key pool {self.directory} has {len(paths)} keys from offset {offset}, {count} needed")
+
+        keys = []
+        for path in paths:
+            with open(path, "rb") as file:
+                keys.append(private_key_from_pem(file.read(), validate=False))
+        return keys
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 keystore.py <pool directory> <number of keys>")
+        sys.exit(1)
+
+    pool = KeyPool(sys.argv[1])
+    generated = pool.fill(int(sys.argv[2]))
+    print(f"Generated {generated} keys ({len(pool)} in {pool.directory})")
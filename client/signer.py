@@ -0,0 +1,204 @@
+# Message encryption and signing helpers for the client
+#
+# Everything here is a plain function of its arguments (private keys are passed
+# as PEM bytes and parsed once per process), so it can run on the event loop,
+# in a thread pool or in a process pool.
+
+import asyncio
+import base64
+import concurrent.futures
+import functools
+import hashlib
+import os
+import secrets
+import sys
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+# Shared modules (message codec) are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import codec
+from keystore import private_key_from_pem
+
+# VULNERABLE MODULES
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import AES, PKCS1_OAEP
+
+# Number of recipient keys and fingerprints kept (keyed by PEM)
+KEY_CACHE_SIZE = 1024
+
+# Ways of running the encryption and signing work
+SIGNING_MODES = ("inline", "thread", "process")
+
+
+# RSA-OAEP cipher for a recipient's PEM public key (imported once per key)
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def recipient_cipher(public_key_pem: str):
+    return PKCS1_OAEP.new(RSA.import_key(public_key_pem.encode('utf-8')))
+
+
+# Client ID (SHA256 of base64 encoded public key) for a PEM public key
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def fingerprint(public_key_pem: str):
+    return hashlib.sha256(base64.b64encode(public_key_pem.encode('utf-8'))).hexdigest()
+
+
+# Parsed private key for signing (cached per process)
+@functools.lru_cache(maxsize=16)
+def signing_key(private_key_pem: bytes):
+    return private_key_from_pem(private_key_pem)
+
+
+# RSA-OAEP cipher for decrypting AES keys sent to us (cached per process)
+@functools.lru_cache(maxsize=16)
+def decrypt_cipher(private_key_pem: bytes):
+    return PKCS1_OAEP.new(RSA.import_key(private_key_pem))
+
+
+# Sign bytes with an RSA private key (RSA-PSS, SHA256), returning the signature bytes
+def sign(private_key, data: bytes):
+    return private_key.sign(
+        data,
+        padding.PSS(
+            mgf=padding.MGF1(hashes.SHA256()),
+            salt_length=padding.PSS.MAX_LENGTH
+        ),
+        hashes.SHA256()
+        )
+
+
+# Encrypt a message using AES-GCM (components in base64 format for JSON, raw bytes for the binary encoding)
+def aes_encrypt_message(aes_key, message, encoding="json"):
+    aes_cipher = AES.new(aes_key, AES.MODE_GCM)
+    ciphertext, tag = aes_cipher.encrypt_and_digest(message.encode('utf-8'))
+
+    return {
+        "ciphertext": codec.encode_bytes(ciphertext, encoding),
+        "nonce": codec.encode_bytes(aes_cipher.nonce, encoding),
+        "tag": codec.encode_bytes(tag, encoding)
+    }
+
+
+# Decrypt a message using AES-GCM, returning None if it fails to verify
+def aes_decrypt_message(aes_key, encrypted_message):
+    ciphertext = codec.decode_bytes(encrypted_message["ciphertext"])
+    nonce = codec.decode_bytes(encrypted_message["nonce"])
+    tag = codec.decode_bytes(encrypted_message["tag"])
+
+    aes_cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
+    try:
+        return aes_cipher.decrypt_and_verify(ciphertext, tag).decode('utf-8')
+    except ValueError:
+        return None
+
+
+# Encrypt an AES key for one recipient with their RSA public key (base64 result, raw bytes for the binary encoding)
+def wrap_aes_key(aes_key, recipient_public_key, encoding="json"):
+    return codec.encode_bytes(recipient_cipher(recipient_public_key).encrypt(aes_key), encoding)
+
+
+# Signed data frame for data (see codec.encode_signed_data)
+def signed_data_frame(private_key_pem: bytes, data, counter, encoding="json"):
+    private_key = signing_key(private_key_pem)
+    return codec.encode_signed_data(data, counter, functools.partial(sign, private_key), encoding)
+
+
+def public_chat_frame(private_key_pem: bytes, sender, message, counter, encoding="json"):
+    data = {
+        "type": "public_chat",
+        "sender": sender,
+        "message": message
+    }
+    return signed_data_frame(private_key_pem, data, counter, encoding)
+
+
+# Encrypted chat frame for a list of (client ID, PEM public key) recipients
+# (the message is encrypted once and the AES key is wrapped for each recipient)
+def chat_frame(private_key_pem: bytes, sender, recipients, message, counter, encoding="json"):
+    aes_key = secrets.token_bytes(32)
+    encrypted_message = aes_encrypt_message(aes_key, message, encoding)
+    encrypted_aes_keys = [wrap_aes_key(aes_key, public_key, encoding) for _, public_key in recipients]
+
+    # One recipient uses the single recipient format, groups carry one AES key per recipient (same order)
+    if len(recipients) == 1:
+        data = {
+            "type": "chat",
+            "sender": sender,
+            "recipient": recipients[0][0],
+            "aes_key": encrypted_aes_keys[0],
+            "message": encrypted_message
+        }
+    else:
+        data = {
+            "type": "chat",
+            "sender": sender,
+            "recipients": [client_id for client_id, _ in recipients],
+            "aes_keys": encrypted_aes_keys,
+            "message": encrypted_message
+        }
+    return signed_data_frame(private_key_pem, data, counter, encoding)
+
+
+# Decrypt the data of a chat message sent to client_id
+# Returns the incoming message ("message" is None if it cannot be decrypted)
+def decrypt_chat(private_key_pem: bytes, client_id, data):
+    # Group chats carry one wrapped AES key per recipient
+    recipients = data["recipients"] if "recipients" in data else [data.get("recipient")]
+
+    try:
+        if "recipients" in data:
+            encrypted_aes_key = data["aes_keys"][recipients.index(client_id)]
+        else:
+            encrypted_aes_key = data["aes_key"]
+
+        aes_key = decrypt_cipher(private_key_pem).decrypt(codec.decode_bytes(encrypted_aes_key))
+        message = aes_decrypt_message(aes_key, data["message"])
+    except (ValueError, KeyError, IndexError, TypeError):
+        message = None
+
+    return {"type": "chat", "sender": data.get("sender"), "recipients": recipients, "message": message}
+
+
+# Runs encryption, signing and decryption off the event loop
+#
+# Callers get an asyncio future for each job straight away, so several
+# messages can be prepared at once while earlier ones are being sent. A pool
+# can be shared by many clients.
+class SigningPool:
+    def __init__(self, mode="thread", workers=None):
+        if mode not in SIGNING_MODES:
+            raise ValueError(f"Unknown signing mode: {mode}")
+
+        self.mode = mode
+
+        if mode == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sign")
+        elif mode == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = None
+
+    # Run function(*args), returning a future for its result
+    def submit(self, function, *args):
+        loop = asyncio.get_running_loop()
+        if self.executor is not None:
+            return loop.run_in_executor(self.executor, function, *args)
+
+        future = loop.create_future()
+        try:
+            future.set_result(function(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+# Pool shared by clients that are not given one
+@functools.lru_cache(maxsize=None)
+def default_pool():
+    return SigningPool()
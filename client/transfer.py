@@ -0,0 +1,87 @@
+# File upload and download for the client (see server/files.py)
+#
+# Files are streamed: uploads are sent with sendfile straight from disk, and
+# downloads are written to disk a chunk at a time, so a file is never held in
+# memory whatever its size.
+
+import asyncio
+import json
+import os
+import tempfile
+import urllib.parse
+
+CHUNK_SIZE = 1 << 16
+
+
+# Status code, headers and the reader positioned at the body of an HTTP response
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+# Open a connection for a URL and send the request head
+async def request(url, method, headers=None):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != "http":
+        raise ValueError(f"Unsupported URL: {url}")
+
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80, limit=CHUNK_SIZE)
+    lines = [f"{method} {parts.path or '/'} HTTP/1.1", f"Host: {parts.netloc}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+    return reader, writer
+
+
+# Upload a file with the upload token from the server's hello reply, returning its URL on the server
+async def upload(upload_url, path, token):
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/octet-stream", "Content-Length": size}
+        reader, writer = await request(upload_url, "POST", headers)
+        try:
+            await writer.drain()
+            await asyncio.get_running_loop().sendfile(writer.transport, file)
+
+            status, headers = await read_response(reader)
+            body = json.loads(await reader.readexactly(int(headers.get("content-length", 0))))
+        finally:
+            writer.close()
+
+    if status != 200:
+        raise ConnectionError(f"Upload failed: {body.get('error', status)}")
+    return body["file_url"]
+
+
+# Download a file to path (written to a temporary file first, so a failed download leaves nothing behind)
+async def download(file_url, path):
+    reader, writer = await request(file_url, "GET")
+    try:
+        await writer.drain()
+        status, headers = await read_response(reader)
+        if status != 200:
+            raise ConnectionError(f"Download failed with status {status}")
+
+        remaining = int(headers["content-length"])
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                while remaining > 0:
+                    chunk = await reader.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ConnectionError("Download ended early")
+                    file.write(chunk)
+                    remaining -= len(chunk)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    finally:
+        writer.close()
@@ -0,0 +1,270 @@
+# Message codec shared by the client and server
+#
+# Signed data is verified over the exact "data" text that was received (plus the
+# counter), and relayed messages are forwarded as the original frame, so a
+# message is only parsed once per hop and never re-serialized.
+#
+# Besides JSON there is a binary encoding (msgpack), which a client and its
+# server agree on at hello. Binary frames carry signatures, wrapped keys and
+# ciphertext as raw bytes instead of base64, and the signed "data" is packed
+# separately and embedded as a byte string, so it can still be verified and
+# relayed exactly as received.
+
+import base64
+import json
+
+# Use orjson for parsing when it is installed (falls back to the json module)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The binary encoding is only offered when msgpack is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Wire encodings
+ENCODINGS = ("json", "msgpack")
+
+WHITESPACE = " \t\n\r"
+
+# Frames up to this many characters have their signed data found with the json
+# module's C scanner (see find_value_span)
+SMALL_FRAME = 4096
+
+# The json module's string and value scanners (C versions where available)
+scanstring = json.decoder.scanstring
+scan_once = json.JSONDecoder().scan_once
+
+
+# Encodings this installation can read and write
+def available_encodings():
+    return [encoding for encoding in ENCODINGS if encoding != "msgpack" or msgpack is not None]
+
+
+# Check if a frame is in the binary encoding (JSON frames start with "{", possibly after whitespace)
+def is_binary(frame):
+    return isinstance(frame, bytes) and frame[:1] not in b"{ \t\n\r"
+
+
+# Parse a received frame (JSON text or bytes, or a binary frame)
+def loads(frame):
+    if is_binary(frame):
+        if msgpack is None:
+            raise ValueError("Binary frame received but msgpack is not installed")
+        message = msgpack.unpackb(frame)
+        if message.get("type") == "signed_data" and isinstance(message.get("data"), bytes):
+            message["data"] = msgpack.unpackb(message["data"])
+        return message
+
+    if orjson is not None:
+        return orjson.loads(frame)
+    return json.loads(frame)
+
+
+# Encode a message to send
+def dumps(message, encoding="json"):
+    if encoding == "msgpack":
+        return msgpack.packb(message)
+    if orjson is not None:
+        return orjson.dumps(message).decode('utf-8')
+    return json.dumps(message)
+
+
+# A byte string field in a message: raw bytes in the binary encoding, base64 text in JSON
+def encode_bytes(value: bytes, encoding):
+    if encoding == "msgpack":
+        return value
+    return base64.b64encode(value).decode('utf-8')
+
+
+# Bytes of a byte string field from either encoding
+def decode_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return base64.b64decode(value)
+
+
+# Index just past the closing quote of the JSON string starting at i
+def string_end(frame: str, i):
+    j = frame.find('"', i + 1)
+    while j != -1:
+        # The quote is escaped if it follows an odd number of backslashes
+        k = j - 1
+        while frame[k] == "\\":
+            k -= 1
+        if (j - 1 - k) % 2 == 0:
+            return j + 1
+        j = frame.find('"', j + 1)
+    raise ValueError("Unterminated string in frame")
+
+
+# Index just past the end of the JSON object or array starting at i
+# Strings are skipped with str.find, so the cost is mostly in the (short)
+# structure between them rather than in the message text.
+def container_end(frame: str, i):
+    length = len(frame)
+    depth = 0
+    while i < length:
+        char = frame[i]
+        if char == '"':
+            i = string_end(frame, i)
+            continue
+        if char == "{" or char == "[":
+            depth += 1
+        elif char == "}" or char == "]":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    raise ValueError("Unterminated object in frame")
+
+
+# Index of the first character from i that is not whitespace
+def skip_whitespace(frame: str, i):
+    while frame[i] in WHITESPACE:
+        i += 1
+    return i
+
+
+# Find the (start, end) of a top-level key's object or array value in a frame
+# Only the top-level members are walked: keys are decoded with the json module's
+# string scanner (so escaped keys are compared as the parser sees them), string
+# values are skipped with str.find, and other values with the json module's C
+# scanner in small frames (quicker than scanning them here, but it decodes them)
+# or by skipping their strings in large ones.
+# Returns None if the key is missing or its value is not an object or array.
+# Raises ValueError if the key appears more than once at the top level (written
+# as is or with escapes): parsers keep the last one, so the span found here
+# might not be the value that was parsed.
+def find_value_span(frame: str, key: str):
+    small = len(frame) <= SMALL_FRAME
+    found = False
+    span = None
+
+    try:
+        i = skip_whitespace(frame, 0)
+        if frame[i] != "{":
+            return None
+        i = skip_whitespace(frame, i + 1)
+        if frame[i] == "}":
+            return None
+
+        while True:
+            if frame[i] != '"':
+                raise ValueError("Invalid key in frame")
+            name, i = scanstring(frame, i + 1)
+            i = skip_whitespace(frame, i)
+            if frame[i] != ":":
+                raise ValueError("Invalid frame")
+            start = skip_whitespace(frame, i + 1)
+
+            char = frame[start]
+            if char == '"':
+                end = string_end(frame, start)
+            elif small or char not in "{[":
+                end = scan_once(frame, start)[1]
+            else:
+                end = container_end(frame, start)
+
+            if name == key:
+                if found:
+                    raise ValueError(f"Duplicate key in frame: {key}")
+                found = True
+                if char in "{[":
+                    span = (start, end)
+
+            i = skip_whitespace(frame, end)
+            if frame[i] == "}":
+                return span
+            if frame[i] != ",":
+                raise ValueError("Invalid frame")
+            i = skip_whitespace(frame, i + 1)
+    except (IndexError, StopIteration):
+        raise ValueError("Invalid frame")
+
+
+# Span of the "data" value in a parsed text frame (see find_value_span)
+# Small frames with "data" written only once and no "\u" escape (the only way to
+# spell another "data" key) take a shortcut: the message has a top-level "data"
+# key, so that one occurrence is it, and only its value is scanned.
+def data_span(frame: str, message):
+    if len(frame) <= SMALL_FRAME and "data" in message and "\\u" not in frame and frame.count('"data"') == 1:
+        try:
+            i = skip_whitespace(frame, frame.find('"data"') + 6)
+            if frame[i] == ":":
+                start = skip_whitespace(frame, i + 1)
+                if frame[start] in "{[":
+                    end = scan_once(frame, start)[1]
+                    if frame[skip_whitespace(frame, end)] in ",}":
+                        return start, end
+                    raise ValueError("Invalid frame")
+        except (IndexError, StopIteration):
+            raise ValueError("Invalid frame")
+    return find_value_span(frame, "data")
+
+
+# Bytes covered by a signed data message's signature ("data" text + counter)
+# Raises ValueError if a JSON frame has more than one "data" key, or a binary
+# frame's data is not a byte string
+def signed_bytes(frame, message):
+    # Binary frames carry the packed data as a byte string
+    if is_binary(frame):
+        data = msgpack.unpackb(frame).get("data")
+        if not isinstance(data, bytes):
+            raise ValueError("Binary frame data is not a byte string")
+        return data + bytes(str(message["counter"]), 'utf-8')
+
+    if isinstance(frame, bytes):
+        frame = frame.decode('utf-8')
+
+    span = data_span(frame, message)
+    if span is None:
+        # Could not find the raw text, fall back to re-serializing
+        data = json.dumps(message["data"])
+    else:
+        data = frame[span[0]:span[1]]
+
+    return bytes(data + str(message["counter"]), 'utf-8')
+
+
+# Build a signed data frame
+# sign is called with the bytes to sign and returns the signature (bytes).
+# The data is encoded with json.dumps (like other OLAF implementations that
+# re-serialize to verify) and embedded as-is, so the "data" text in the frame
+# is exactly the text that was signed. In the binary encoding the packed data
+# is signed and embedded as a byte string.
+def encode_signed_data(data, counter, sign, encoding="json"):
+    if encoding == "msgpack":
+        packed = msgpack.packb(data)
+        signature = sign(packed + bytes(str(counter), 'utf-8'))
+        return msgpack.packb({"type": "signed_data", "data": packed, "counter": counter, "signature": signature})
+
+    data_text = json.dumps(data)
+    signature = base64.b64encode(sign(bytes(data_text + str(counter), 'utf-8'))).decode('utf-8')
+
+    return (
+        '{"type": "signed_data", "data": ' + data_text
+        + ', "counter": ' + json.dumps(counter)
+        + ', "signature": ' + json.dumps(signature) + '}'
+    )
+
+
+# Byte strings in a message as base64 text (for JSON)
+def base64_fields(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('utf-8')
+    if isinstance(value, dict):
+        return {key: base64_fields(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [base64_fields(item) for item in value]
+    return value
+
+
+# JSON version of a binary frame, for clients that only understand JSON
+# (the signature is over the binary data, so it can no longer be checked
+# against the JSON text; the sender's server has already verified it)
+def to_json(frame):
+    return dumps(base64_fields(loads(frame)))
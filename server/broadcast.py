@@ -0,0 +1,281 @@
+# Outbound message delivery for connected clients
+#
+# Every client gets an Outbox: a bounded queue drained by its own writer task.
+# Relaying a message only puts the (already encoded) frame in the recipients'
+# outboxes, so a slow receiver never delays delivery to anyone else. The writer
+# task only runs while there is something to send, so an idle client costs no
+# task at all.
+
+import asyncio
+import heapq
+import os
+import struct
+import sys
+import tempfile
+import time
+from collections import deque
+
+# Shared modules (message codec) are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import codec
+
+# What to do when a client's outbox is full
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "disconnect", "spill")
+
+# Spill file record header: enqueue time, frame type (0 = text, 1 = binary), frame length
+SPILL_HEADER = struct.Struct(">dBI")
+
+
+# Stored frames queued together, and what to call once they have been sent
+class StoredBatch:
+    __slots__ = ("remaining", "done")
+
+    def __init__(self, remaining, done):
+        self.remaining = remaining
+        self.done = done
+
+    def finish(self, sent):
+        if self.done is not None:
+            self.done(sent)
+
+
+# Bounded outbound queue for one client
+class Outbox:
+    def __init__(self, websocket, max_size, policy, broadcaster, encoding="json"):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+        self.websocket = websocket
+
+        # Client's wire encoding (binary frames are converted for JSON clients)
+        self.json_only = encoding == "json"
+        self.max_size = max_size
+        self.policy = policy
+        self.broadcaster = broadcaster
+
+        # (frame, enqueue time) pairs waiting to be sent
+        self.queue = deque()
+
+        # Frames stored while the client was offline, sent before the queue:
+        # (frame, enqueue time, batch), and the batches not yet fully sent
+        # (created for the first stored frames, most clients never have any)
+        self.stored = None
+        self.stored_batches = None
+
+        # Overflow file for the "spill" policy (frames are read back in order)
+        self.spill_file = None
+        self.spill_read_pos = 0
+        self.spill_count = 0
+
+        # Writer task (None while there is nothing to send)
+        self.task = None
+        self.closed = False
+
+    # Number of frames waiting to be sent (including stored and spilled frames)
+    def depth(self):
+        return len(self.queue) + self.spill_count + (len(self.stored) if self.stored else 0)
+
+    # Queue a frame for sending, returning False if it was not queued
+    def put(self, frame, enqueued_at=None):
+        if self.closed:
+            return False
+
+        if self.json_only and codec.is_binary(frame):
+            frame = self.broadcaster.to_json(frame)
+
+        if enqueued_at is None:
+            enqueued_at = time.perf_counter()
+
+        # Once spilling has started, later frames must also spill to stay in order
+        if len(self.queue) >= self.max_size or self.spill_count:
+            if self.policy == "drop_oldest":
+                self.queue.popleft()
+                self.broadcaster.dropped += 1
+            elif self.policy == "disconnect":
+                self.broadcaster.disconnected += 1
+                self.close()
+                asyncio.ensure_future(self.websocket.close(code=1008, reason="Slow consumer"))
+                return False
+            else:
+                self.spill(frame, enqueued_at)
+                self.wake()
+                return True
+
+        self.queue.append((frame, enqueued_at))
+        self.wake()
+        return True
+
+    # Queue frames stored for a client while it was offline, ahead of anything else
+    # (not limited by the outbox size, the offline store keeps them bounded, and
+    # never dropped). done is called with True once they have all been written to
+    # the connection, or with False if it closes first.
+    def put_stored(self, frames, done=None):
+        if not frames:
+            return
+        if self.closed:
+            if done is not None:
+                done(False)
+            return
+
+        if self.stored is None:
+            self.stored = deque()
+            self.stored_batches = []
+        batch = StoredBatch(len(frames), done)
+        self.stored_batches.append(batch)
+        if self.json_only:
+            frames = [self.broadcaster.to_json(frame) if codec.is_binary(frame) else frame for frame in frames]
+        enqueued_at = time.perf_counter()
+        self.stored.extend((frame, enqueued_at, batch) for frame in frames)
+        self.wake()
+
+    # Start the writer task if it is not already running
+    def wake(self):
+        if self.task is None and not self.closed:
+            self.task = asyncio.ensure_future(self.writer())
+
+    # Write a frame to the overflow file
+    def spill(self, frame, enqueued_at):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+
+        if isinstance(frame, str):
+            frame_type, payload = 0, frame.encode('utf-8')
+        else:
+            frame_type, payload = 1, frame
+
+        self.spill_file.seek(0, 2)
+        self.spill_file.write(SPILL_HEADER.pack(enqueued_at, frame_type, len(payload)))
+        self.spill_file.write(payload)
+        self.spill_count += 1
+        self.broadcaster.spilled += 1
+
+    # Read the oldest frame back from the overflow file
+    def unspill(self):
+        self.spill_file.seek(self.spill_read_pos)
+        enqueued_at, frame_type, length = SPILL_HEADER.unpack(self.spill_file.read(SPILL_HEADER.size))
+        payload = self.spill_file.read(length)
+        self.spill_read_pos = self.spill_file.tell()
+        self.spill_count -= 1
+
+        # Start a fresh file once everything spilled has been sent
+        if self.spill_count == 0:
+            self.spill_file.close()
+            self.spill_file = None
+            self.spill_read_pos = 0
+
+        frame = payload.decode('utf-8') if frame_type == 0 else payload
+        return frame, enqueued_at
+
+    # Next frame to send (in-memory queue first, it always holds the older frames)
+    def next_frame(self):
+        if self.queue:
+            return self.queue.popleft()
+        return self.unspill()
+
+    # Send queued frames until the outbox is empty (or closed)
+    async def writer(self):
+        try:
+            while not self.closed and self.depth():
+                if self.stored:
+                    frame, enqueued_at, batch = self.stored.popleft()
+                else:
+                    (frame, enqueued_at), batch = self.next_frame(), None
+                await self.websocket.send(frame)
+                self.broadcaster.record_latency(time.perf_counter() - enqueued_at)
+
+                # Tell whoever queued a stored batch once it has all been sent
+                # (if the outbox was closed meanwhile, they have been told it was not)
+                if batch is not None and not self.closed:
+                    batch.remaining -= 1
+                    if batch.remaining == 0:
+                        self.stored_batches.remove(batch)
+                        batch.finish(True)
+        except Exception:
+            # Connection closed (cleanup is done by the server's disconnection handler)
+            self.closed = True
+        finally:
+            self.task = None
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self.stored is not None:
+            batches, self.stored, self.stored_batches = self.stored_batches, None, None
+            for batch in batches:
+                batch.finish(False)
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+            self.spill_count = 0
+
+
+# Encodes relayed messages once and fans them out to client outboxes
+class Broadcaster:
+    def __init__(self, max_queue=1024, policy="drop_oldest"):
+        self.max_queue = max_queue
+        self.policy = policy
+
+        # Counters
+        self.broadcasts = 0
+        self.frames = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.spilled = 0
+
+        # Fan-out latency (enqueue to send complete)
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        # Last binary frame converted to JSON (a broadcast is converted once for all JSON clients)
+        self.json_cache = (None, None)
+
+    # Create an outbox for a newly connected client
+    def open_outbox(self, websocket, encoding="json"):
+        return Outbox(websocket, self.max_queue, self.policy, self, encoding)
+
+    # JSON version of a binary frame
+    def to_json(self, frame):
+        binary, text = self.json_cache
+        if binary is not frame:
+            text = codec.to_json(frame)
+            self.json_cache = (frame, text)
+        return text
+
+    # Queue one encoded frame for a list of client records
+    def send(self, recipients, frame):
+        if not recipients:
+            return
+
+        enqueued_at = time.perf_counter()
+        self.broadcasts += 1
+        for recipient in recipients:
+            if recipient.outbox.put(frame, enqueued_at):
+                self.frames += 1
+
+    def record_latency(self, latency):
+        self.latency_count += 1
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+
+    # Outbox totals, plus the queue depth of the top clients with the deepest outboxes
+    # (client ID -> depth) if top is given
+    def stats(self, clients=(), top=0):
+        average = self.latency_total / self.latency_count if self.latency_count else 0.0
+        depths = [(client.outbox.depth(), client.fingerprint) for client in clients]
+        stats = {
+            "broadcasts": self.broadcasts,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "spilled": self.spilled,
+            "latency_avg_ms": average * 1000,
+            "latency_max_ms": self.latency_max * 1000,
+            "queue_depth_total": sum(depth for depth, _ in depths),
+            "queue_depth_max": max((depth for depth, _ in depths), default=0),
+        }
+        if top:
+            stats["queue_depths"] = {fingerprint: depth for depth, fingerprint in heapq.nlargest(top, depths)}
+        return stats
@@ -0,0 +1,202 @@
+# Server configuration
+#
+# Any of these can be overridden by passing a dict to Server(host, port, config)
+
+DEFAULT_CONFIG = {
+    # Where RSA signature verification runs: "inline" (on the event loop),
+    # "thread" (thread pool) or "process" (process pool)
+    "verify_mode": "thread",
+
+    # Number of verification workers (None uses the executor default)
+    "verify_workers": None,
+
+    # Maximum number of signatures sent to a worker in one batch
+    "verify_batch_size": 32,
+
+    # Signature verifications in progress at once (shared fairly between
+    # connections, so a flooding client cannot take them all)
+    "verify_concurrency": 8,
+
+    # How long verified signatures are remembered (seconds, at least, 0 turns
+    # it off) and how many at most: a frame sent again within that time is
+    # turned away without verifying it, see replay.py
+    "replay_window": 600,
+    "replay_filter_size": 1 << 18,
+
+    # Largest frame accepted from a client (bytes, larger frames close the connection)
+    "max_frame_size": 1 << 20,
+
+    # Most recipients a group chat can list
+    "max_recipients": 100,
+
+    # Frames received from one connection that are buffered before the server
+    # stops reading from it (each connection's messages are handled one at a time)
+    "inbound_queue_size": 16,
+
+    # Messages per second allowed for each connection (0 = no limit), the
+    # number that can be sent at once after a quiet period, and bytes per
+    # second (0 = no limit)
+    "rate_limit": 100,
+    "rate_limit_burst": 200,
+    "rate_limit_bytes": 0,
+
+    # What happens to messages over the rate limit: "delay" (stop reading from
+    # the connection until it is within its limit) or "reject" (drop the
+    # message and reply with an error)
+    "rate_limit_policy": "delay",
+
+    # High-water marks of each connection's read and write buffers (bytes). The
+    # buffers only fill up while a connection is busy, these bound how far.
+    "read_buffer_size": 1 << 16,
+    "write_buffer_size": 1 << 16,
+
+    # Keepalive pings (seconds between pings, and how long to wait for the pong
+    # before closing the connection, None turns pings off). "coalesced" pings
+    # every connection from one timer (see keepalive.py) instead of a task and
+    # timer for each connection.
+    "keepalive_interval": 20,
+    "keepalive_timeout": 100,
+    "keepalive_coalesced": False,
+
+    # Drop a client's HTTP handshake headers once it has sent hello (idle
+    # connections then only keep what is needed to relay messages to them)
+    "drop_handshake_headers": False,
+
+    # Connections waiting to be accepted (the listen backlog; raise it, and
+    # net.core.somaxconn, for many clients connecting at once)
+    "listen_backlog": 100,
+
+    # Hellos checked at once, started per second (0 = no limit) and waiting
+    # (more are told to try again after hello_retry_after seconds), see
+    # AdmissionQueue in limits.py
+    "hello_concurrency": 32,
+    "hello_rate": 0,
+    "hello_queue_size": 10000,
+    "hello_retry_after": 2.0,
+
+    # How long a session resumption ticket is valid (seconds, 0 turns
+    # resumption off), the file with the key tickets and upload tokens are
+    # signed with (created if missing; workers and servers sharing it accept
+    # each other's tickets), the database of each client's newest ticket and last counter (shared the
+    # same way), and how often connected clients' counters are saved to it (seconds)
+    "ticket_lifetime": 24 * 3600,
+    "ticket_key_file": "resumption.key",
+    "ticket_store_file": "resumption.db",
+    "ticket_save_interval": 1.0,
+
+    # Wire encodings clients may use besides JSON ("msgpack" needs the msgpack
+    # package). Binary frames are converted to JSON for clients that only use JSON.
+    "encodings": ["msgpack", "json"],
+
+    # permessage-deflate compression of client connections, and its zlib
+    # settings (compression level 1-9, window bits 9-15, memory level 1-9)
+    "compression": True,
+    "deflate_level": 6,
+    "deflate_window_bits": 12,
+    "deflate_mem_level": 5,
+
+    # Port of the HTTP file upload and download endpoint (None is the websocket
+    # port + 1000, 0 turns it off), where uploaded files are kept (shared by
+    # all workers), the largest file accepted and the most all files together
+    # can take (bytes), how long an upload may stop sending before it is
+    # closed (seconds), and how long the upload token in a hello reply is valid
+    # (seconds; tokens are signed with the key in ticket_key_file)
+    "file_port": 0,
+    "file_dir": "files",
+    "max_file_size": 1 << 30,
+    "max_files_size": 10 << 30,
+    "file_read_timeout": 30,
+    "upload_token_lifetime": 24 * 3600,
+
+    # Send client list changes to every connected client as they happen. With
+    # this off clients fetch the changes since their version when they need the
+    # list (each join or leave otherwise queues a frame for every client)
+    "push_client_updates": True,
+
+    # Maximum number of relayed messages queued for one client
+    "outbox_size": 1024,
+
+    # What to do when a client's outbox is full: "drop_oldest", "disconnect"
+    # or "spill" (overflow is written to a temporary file)
+    "slow_consumer_policy": "drop_oldest",
+
+    # Directory for chats stored for offline recipients (each server or worker
+    # uses its own subdirectory, None turns store-and-forward off)
+    "offline_dir": "offline",
+
+    # Size of each offline log segment file, and of the whole log (bytes)
+    "offline_segment_size": 16 << 20,
+    "offline_max_bytes": 256 << 20,
+
+    # How long chats for offline recipients are kept (seconds), how many are
+    # kept for each recipient (the oldest are dropped first), and how many bytes
+    # of chats from one sender can be waiting (more are not stored)
+    "offline_retention": 7 * 24 * 3600,
+    "offline_max_per_recipient": 1000,
+    "offline_max_bytes_per_sender": 16 << 20,
+
+    # Addresses of the other servers in the neighbourhood (e.g. "ws://localhost:8766")
+    "neighbourhood": [],
+
+    # This server's private key (PEM, created with a .pub file next to it if
+    # missing), which its server_hello to other servers is signed with, and
+    # the public key file of every other server in the neighbourhood (address
+    # -> path). Servers without a key here are not accepted. Workers sharing a
+    # port all use this server's key.
+    "server_key_file": "server.key",
+    "neighbourhood_keys": {},
+
+    # How far the time in a server_hello may be from ours (seconds)
+    "server_hello_max_age": 60,
+
+    # Frames kept for a neighbourhood server while its link is down
+    "peer_queue_size": 10000,
+
+    # Reconnect backoff for neighbourhood server links (seconds)
+    "peer_backoff_min": 0.5,
+    "peer_backoff_max": 30.0,
+
+    # Log level for server messages ("DEBUG" also logs every message received)
+    "log_level": "INFO",
+
+    # Maximum log records per second for each kind of log message (0 = no limit)
+    "log_rate_limit": 10,
+
+    # Accept stats_request and profile_request admin messages from other hosts
+    # (by default they are only answered on connections from localhost)
+    "admin_allow_remote": False,
+
+    # Sampling interval of the profiler (seconds)
+    "profile_interval": 0.005,
+
+    # Worker mode (set by workers.py): this worker's internal address and the
+    # addresses of all workers sharing the port
+    "worker_address": None,
+    "workers": [],
+}
+
+
+# Settings for many mostly idle clients per server (--high-density): less
+# memory per connection at some cost in bandwidth (no compression), and
+# clients fetch client list changes when they need them
+HIGH_DENSITY_CONFIG = {
+    "compression": False,
+    "read_buffer_size": 1 << 13,
+    "write_buffer_size": 1 << 13,
+    "inbound_queue_size": 4,
+    "keepalive_interval": 30,
+    "keepalive_coalesced": True,
+    "drop_handshake_headers": True,
+    "push_client_updates": False,
+}
+
+
+# Merge user overrides into the default configuration
+def load_config(overrides=None):
+    config = dict(DEFAULT_CONFIG)
+    if overrides:
+        for key, value in overrides.items():
+            if key not in DEFAULT_CONFIG:
+                raise KeyError(f"Unknown config option: {key}")
+            config[key] = value
+    return config
@@ -0,0 +1,227 @@
+# Links to other servers in the neighbourhood
+#
+# Each server keeps one persistent outbound websocket to every other server in
+# its neighbourhood and sends everything for that server over it: its own
+# client list changes, public chats (once per server, not once per remote
+# client) and chats for clients homed there. Links reconnect with exponential
+# backoff, and frames queued while a link is down are sent once it is back.
+#
+# A link starts with a server_hello signed with the server's key (like the
+# hello of a client, with the time in milliseconds as its counter), and the
+# other server only accepts it if the signature checks out against the key it
+# was given for that address. Workers share one key.
+
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import deque
+
+import websockets
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+import codec
+
+log = logging.getLogger("olaf.federation")
+
+# Size of a generated server key (bits)
+SERVER_KEY_SIZE = 2048
+
+
+# Load the server's private key from a PEM file, creating it (and a .pub file
+# with the public key to give to the other servers) if it does not exist
+# (written under another name first, so a worker never reads a half-written key)
+def load_server_key(path):
+    if not os.path.exists(path):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=SERVER_KEY_SIZE)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".server-key-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+            try:
+                os.link(temp_path, path)
+                with open(path + ".pub", "wb") as file:
+                    file.write(key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+            except FileExistsError:
+                # Another worker created it first
+                pass
+        finally:
+            os.remove(temp_path)
+
+    with open(path, "rb") as file:
+        return serialization.load_pem_private_key(file.read(), password=None)
+
+
+# PEM text of a server's public key
+def public_key_pem(key):
+    return key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+
+
+# Load the public keys of other servers (address -> PEM file), returning address -> (parsed key, PEM text)
+def load_server_public_keys(paths):
+    keys = {}
+    for address, path in paths.items():
+        with open(path, "rb") as file:
+            pem = file.read()
+        keys[address] = (serialization.load_pem_public_key(pem), pem.decode('utf-8'))
+    return keys
+
+
+# Signed server_hello frame for address (RSA-PSS, SHA256, like a client's signed data)
+def signed_server_hello(key, address):
+    def sign(data):
+        return key.sign(data, padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
+
+    return codec.encode_signed_data({"type": "server_hello", "sender": address}, time.time_ns() // 1000000, sign)
+
+
+# Persistent outbound connection to one neighbourhood server
+class PeerLink:
+    def __init__(self, server, uri, max_queue, backoff_min, backoff_max):
+        self.server = server
+        self.uri = uri
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+        # Frames waiting to be sent (oldest dropped if the peer is down for too long)
+        self.queue = deque(maxlen=max_queue)
+        self.ready = asyncio.Event()
+
+        self.websocket = None
+        self.task = None
+
+        # Counters
+        self.sent = 0
+        self.connects = 0
+
+    def connected(self):
+        return self.websocket is not None
+
+    # Queue a frame for the peer
+    def send(self, frame):
+        self.queue.append(frame)
+        self.ready.set()
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    # Open a websocket to the peer ("unix:<path>" addresses are local worker sockets)
+    def connect(self):
+        if self.uri.startswith("unix:"):
+            return websockets.unix_connect(self.uri[len("unix:"):], uri="ws://localhost")
+        return websockets.connect(self.uri)
+
+    # Connect (and reconnect) to the peer until stopped
+    async def run(self):
+        delay = self.backoff_min
+        while True:
+            try:
+                async with self.connect() as websocket:
+                    self.websocket = websocket
+                    self.connects += 1
+                    delay = self.backoff_min
+                    log.info("Connected to neighbourhood server %s", self.uri)
+
+                    # Introduce ourselves and send our full client list
+                    await websocket.send(self.server.server_hello_frame())
+                    await websocket.send(self.server.local_client_update_frame())
+
+                    reader = asyncio.ensure_future(self.read(websocket))
+                    try:
+                        await self.write(websocket)
+                    finally:
+                        reader.cancel()
+
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                log.warning("Link to %s down: %r", self.uri, e)
+
+            finally:
+                self.websocket = None
+
+            # Back off before reconnecting (with jitter so restarted peers are not hit all at once)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self.backoff_max)
+
+    # Send queued frames until the connection closes
+    async def write(self, websocket):
+        closed = asyncio.ensure_future(websocket.wait_closed())
+        try:
+            while True:
+                if not self.queue:
+                    self.ready.clear()
+                    ready = asyncio.ensure_future(self.ready.wait())
+                    await asyncio.wait([ready, closed], return_when=asyncio.FIRST_COMPLETED)
+                    ready.cancel()
+                    if closed.done():
+                        return
+                    continue
+
+                # Only drop the frame once it has been sent (kept for the next connection otherwise)
+                await websocket.send(self.queue[0])
+                self.queue.popleft()
+                self.sent += 1
+        finally:
+            closed.cancel()
+
+    # Handle replies from the peer on our link (requests for our client list, and errors)
+    async def read(self, websocket):
+        try:
+            async for message in websocket:
+                data = codec.loads(message)
+                if data.get("type") == "client_update_request":
+                    self.send(self.server.local_client_update_frame())
+                elif data.get("status") == "error":
+                    log.warning("Neighbourhood server %s: %s", self.uri, data.get("message"))
+        except websockets.ConnectionClosed:
+            pass
+
+
+# Pool of links to all other servers in the neighbourhood
+class Neighbourhood:
+    def __init__(self, server, uris, max_queue=10000, backoff_min=0.5, backoff_max=30.0):
+        self.links = {
+            uri: PeerLink(server, uri, max_queue, backoff_min, backoff_max)
+            for uri in uris if uri not in (server.uri, server.address)
+        }
+
+    def __contains__(self, uri):
+        return uri in self.links
+
+    def start(self):
+        for link in self.links.values():
+            link.start()
+
+    async def stop(self):
+        for link in self.links.values():
+            await link.stop()
+
+    # Send a frame to one server (returns False if it is not a neighbour)
+    def send(self, uri, frame):
+        link = self.links.get(uri)
+        if link is None:
+            return False
+        link.send(frame)
+        return True
+
+    # Send a frame once to every server
+    def broadcast(self, frame):
+        for link in self.links.values():
+            link.send(frame)
+
+    def stats(self):
+        return {
+            uri: {"connected": link.connected(), "queued": len(link.queue), "sent": link.sent, "connects": link.connects}
+            for uri, link in self.links.items()
+        }
@@ -0,0 +1,341 @@
+# HTTP file upload and download (OLAF file transfer)
+#
+#   POST /api/upload          body is the file, the reply is {"file_url": "<url>"}
+#   GET  /api/files/<sha256>  the file
+#
+# Uploads are streamed to a temporary file in chunks (hashing as they go), so
+# no more than a chunk of a file is ever held in memory. The finished file is
+# named after its SHA256, so the same content is only stored once however often
+# it is uploaded. Downloads are sent with sendfile, straight from the page
+# cache to the socket. Files are shared by chat messages carrying their URL.
+#
+# Only connected clients can upload: the hello reply carries an upload token
+# (the client ID and an expiry time, with an HMAC-SHA256 over them, keyed like
+# resumption tickets so every worker accepts it), sent as "Authorization:
+# Bearer <token>". All files together are kept under a size limit, and a
+# request that stops sending for read_timeout seconds is closed.
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+log = logging.getLogger("olaf.files")
+
+# Largest request head (request line and headers), also the stream buffer size
+MAX_HEAD_SIZE = 64 * 1024
+
+FILE_PATH = re.compile(r"^/api/files/([0-9a-f]{64})$")
+
+# Chunk size line of a chunked body (hex digits only: int() would also take signs, "0x" and "_")
+CHUNK_SIZE = re.compile(rb"^[0-9a-fA-F]{1,16}$")
+
+# Seconds the total size of the stored files is trusted for before the directory is
+# read again (other workers add files too)
+USAGE_RESCAN_INTERVAL = 10
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    411: "Length Required",
+    413: "Payload Too Large",
+    507: "Insufficient Storage",
+}
+
+
+# Upload token for a client: "<client ID>.<expiry time>.<HMAC>"
+def issue_token(key, client_id, lifetime):
+    payload = f"{client_id}.{int(time.time() + lifetime)}"
+    return f"{payload}.{token_mac(key, payload)}"
+
+
+# Check an upload token, returning the client ID in it (None if it is not valid)
+def check_token(key, token):
+    payload, _, mac = token.rpartition(".")
+    if not hmac.compare_digest(mac.encode('utf-8'), token_mac(key, payload).encode('utf-8')):
+        return None
+
+    client_id, _, expires = payload.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return None
+    return client_id
+
+
+def token_mac(key, payload):
+    return hmac.new(key, b"upload." + payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+# Bad request from a client, answered with its status code
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Request line and headers of an HTTP request
+class Request:
+    def __init__(self, method, path, headers):
+        self.method = method
+        self.path = path
+        self.headers = headers
+
+    @classmethod
+    async def read(cls, reader, timeout):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        except asyncio.LimitOverrunError:
+            raise HTTPError(400, "Request head too large")
+        except asyncio.TimeoutError:
+            raise HTTPError(408, "Request head not received in time")
+
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ")
+        except ValueError:
+            raise HTTPError(400, "Invalid request line")
+
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+        return cls(method, target.split("?", 1)[0], headers)
+
+
+# Serves file uploads and downloads on its own port
+class FileServer:
+    def __init__(self, directory, key, max_file_size=1 << 30, max_total_size=10 << 30, read_timeout=30, chunk_size=1 << 16):
+        self.directory = directory
+        self.key = key
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        self.read_timeout = read_timeout
+        self.chunk_size = chunk_size
+        self.server = None
+
+        # Total size of the stored files (as of the last time the directory was read),
+        # and of the uploads in progress on this server
+        self.used = 0
+        self.used_at = None
+        self.receiving = 0
+
+        # Counters
+        self.uploads = 0
+        self.deduplicated = 0
+        self.downloads = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.rejected = 0
+
+    async def start(self, host, port, reuse_port=False):
+        os.makedirs(self.directory, exist_ok=True)
+        self.server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEAD_SIZE, reuse_port=reuse_port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    # Path of a stored file
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    # Handle one request (connections are closed after each request)
+    async def handle(self, reader, writer):
+        try:
+            request = await Request.read(reader, self.read_timeout)
+
+            if request.path == "/api/upload":
+                if request.method != "POST":
+                    raise HTTPError(405, "Use POST to upload")
+                self.authorize(request)
+                digest = await self.receive_file(reader, request)
+                host = request.headers.get("host", "localhost")
+                await self.respond(writer, 200, {"file_url": f"http://{host}/api/files/{digest}"})
+                return
+
+            match = FILE_PATH.match(request.path)
+            if match is None:
+                raise HTTPError(404, "Not found")
+            if request.method not in ("GET", "HEAD"):
+                raise HTTPError(405, "Use GET to download")
+            await self.send_file(writer, match.group(1), request.method == "HEAD")
+
+        except HTTPError as error:
+            await self.respond(writer, error.status, {"error": str(error)})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Check the upload token of a request
+    def authorize(self, request):
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or check_token(self.key, token.strip()) is None:
+            self.rejected += 1
+            raise HTTPError(401, "Valid upload token required")
+
+    # Total size of the stored files, read from the directory now and then
+    async def usage(self):
+        now = time.monotonic()
+        if self.used_at is None or now - self.used_at > USAGE_RESCAN_INTERVAL:
+            self.used_at = now
+            self.used = await asyncio.get_running_loop().run_in_executor(None, self.scan)
+        return self.used
+
+    def scan(self):
+        total = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+    # Stream an upload to disk, returning its SHA256
+    async def receive_file(self, reader, request):
+        if request.headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = self.read_chunked(reader)
+            length = 0
+        elif "content-length" in request.headers:
+            try:
+                length = int(request.headers["content-length"])
+            except ValueError:
+                raise HTTPError(400, "Invalid Content-Length")
+            if length < 0:
+                raise HTTPError(400, "Invalid Content-Length")
+            if length > self.max_file_size:
+                raise HTTPError(413, "File too large")
+            chunks = self.read_length(reader, length)
+        else:
+            raise HTTPError(411, "Content-Length or chunked transfer encoding required")
+
+        if await self.usage() + self.receiving + length > self.max_total_size:
+            self.rejected += 1
+            raise HTTPError(507, "Server is out of space for files")
+
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    self.receiving += len(chunk)
+                    if size > self.max_file_size:
+                        raise HTTPError(413, "File too large")
+                    if self.used + self.receiving > self.max_total_size:
+                        self.rejected += 1
+                        raise HTTPError(507, "Server is out of space for files")
+                    sha256.update(chunk)
+
+                    # Written on the event loop (a chunk to the page cache is quicker than a hop to a thread)
+                    file.write(chunk)
+
+            # Content addressed: an existing file with the same hash is the same file
+            digest = sha256.hexdigest()
+            if os.path.exists(self.path(digest)):
+                self.deduplicated += 1
+            else:
+                os.replace(temp_path, self.path(digest))
+                self.used += size
+        finally:
+            self.receiving -= size
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.uploads += 1
+        self.bytes_received += size
+        log.debug("Received file %s (%d bytes)", digest, size)
+        return digest
+
+    # Wait for a read from the request, for at most read_timeout seconds
+    async def read(self, read):
+        try:
+            return await asyncio.wait_for(read, self.read_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(408, "Upload stalled")
+
+    # Body with a Content-Length, in chunks
+    async def read_length(self, reader, length):
+        while length > 0:
+            chunk = await self.read(reader.read(min(self.chunk_size, length)))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", length)
+            length -= len(chunk)
+            yield chunk
+
+    # Body in chunked transfer encoding, in chunks
+    async def read_chunked(self, reader):
+        while True:
+            size_line = await self.read(reader.readuntil(b"\r\n"))
+            size_text = size_line.split(b";", 1)[0].strip()
+            if not CHUNK_SIZE.match(size_text):
+                raise HTTPError(400, "Invalid chunk size")
+            size = int(size_text, 16)
+
+            if size == 0:
+                # Trailers end with an empty line
+                while await self.read(reader.readuntil(b"\r\n")) != b"\r\n":
+                    pass
+                return
+
+            async for chunk in self.read_length(reader, size):
+                yield chunk
+            await self.read(reader.readexactly(2))
+
+    # Send a stored file (zero copy with sendfile where the platform has it)
+    async def send_file(self, writer, digest, head_only):
+        try:
+            file = open(self.path(digest), "rb")
+        except FileNotFoundError:
+            raise HTTPError(404, "File not found")
+
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: application/octet-stream\r\n"
+                + f"Content-Length: {size}\r\n".encode('latin-1')
+                + b"Connection: close\r\n\r\n"
+            )
+            if not head_only:
+                await writer.drain()
+                await asyncio.get_running_loop().sendfile(writer.transport, file)
+                self.downloads += 1
+                self.bytes_sent += size
+            await writer.drain()
+
+    async def respond(self, writer, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n".encode('latin-1')
+            + b"Content-Type: application/json\r\n"
+            + f"Content-Length: {len(payload)}\r\n".encode('latin-1')
+            + b"Connection: close\r\n\r\n"
+            + payload
+        )
+        await writer.drain()
+
+    def stats(self):
+        return {
+            "uploads": self.uploads,
+            "deduplicated": self.deduplicated,
+            "downloads": self.downloads,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "rejected": self.rejected,
+            "used": self.used,
+        }
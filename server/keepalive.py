@@ -0,0 +1,96 @@
+# Keepalive pings for all connections from one timer
+#
+# websockets' own keepalive runs a task with a timer for every connection,
+# each waking up on its own. With many idle connections that is a lot of
+# memory and wakeups for very little work. Keepalive keeps the connections in
+# buckets instead and pings one bucket per tick, so every connection is pinged
+# once per interval from a single task, with the pings spread evenly over the
+# interval. A connection whose ping has not been answered within the timeout
+# is closed, as websockets does.
+
+import asyncio
+import functools
+import time
+
+import websockets
+
+# Number of buckets (ticks per interval)
+BUCKETS = 20
+
+
+class Keepalive:
+    def __init__(self, interval, timeout, buckets=BUCKETS):
+        self.interval = interval
+        self.timeout = timeout
+
+        # websocket -> time its unanswered ping was sent (None if it has no ping waiting)
+        self.buckets = [{} for _ in range(buckets)]
+        self.task = None
+
+        # Counters
+        self.pings = 0
+        self.timeouts = 0
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def bucket(self, websocket):
+        return self.buckets[hash(websocket) % len(self.buckets)]
+
+    def add(self, websocket):
+        self.bucket(websocket)[websocket] = None
+
+    def remove(self, websocket):
+        self.bucket(websocket).pop(websocket, None)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        tick = self.interval / len(self.buckets)
+        while True:
+            for bucket in self.buckets:
+                await asyncio.sleep(tick)
+                await self.ping_bucket(bucket)
+
+    # Ping every connection in a bucket (and close those that did not answer the last ping)
+    async def ping_bucket(self, bucket):
+        now = time.monotonic()
+        for websocket, sent in list(bucket.items()):
+            if sent is not None:
+                if self.timeout is not None and now - sent > self.timeout:
+                    self.timeouts += 1
+                    bucket.pop(websocket, None)
+                    websocket.fail_connection(1011, "keepalive ping timeout")
+                continue
+
+            # Closing connections are skipped, and so are connections with a full
+            # write buffer (they are busy, and the ping would wait behind it)
+            if not websocket.open or websocket.transport.get_write_buffer_size() >= websocket.write_limit:
+                continue
+
+            try:
+                pong_waiter = await websocket.ping()
+            except websockets.ConnectionClosed:
+                continue
+
+            if websocket in bucket:
+                bucket[websocket] = now
+                pong_waiter.add_done_callback(functools.partial(self.answered, bucket, websocket))
+                self.pings += 1
+
+    # Pong received (or the connection closed): the connection can be pinged again
+    def answered(self, bucket, websocket, pong_waiter):
+        # Retrieve the ConnectionClosed error of a closed connection (otherwise asyncio logs it)
+        if not pong_waiter.cancelled():
+            pong_waiter.exception()
+
+        if websocket in bucket:
+            bucket[websocket] = None
+
+    def stats(self):
+        return {"connections": len(self), "pings": self.pings, "timeouts": self.timeouts}
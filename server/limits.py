@@ -0,0 +1,195 @@
+# Per-connection limits
+#
+# TokenBucket limits how many messages (and bytes) one connection can send per
+# second. FairScheduler shares a fixed number of signature verification slots
+# between connections, so a connection that always has a message ready cannot
+# crowd out connections that only send now and then. AdmissionQueue lets
+# hellos in a few at a time when many clients connect at once.
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+# What to do with a message over a connection's rate limit
+RATE_LIMIT_POLICIES = ("delay", "reject")
+
+
+# Token bucket: rate tokens per second, up to burst tokens saved up
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    # Take tokens, returning how long to wait (seconds) before the request is within the limit
+    # (0 if it already is). The tokens are taken either way, so waiting the returned time
+    # and then going ahead keeps to the rate.
+    def take(self, tokens=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        self.tokens -= tokens
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    # Give back tokens taken for a request that was not carried out
+    def refund(self, tokens=1):
+        self.tokens = min(self.burst, self.tokens + tokens)
+
+
+# Message and byte rate limits for one connection (a limit of 0 is no limit)
+class ConnectionLimiter:
+    __slots__ = ("messages", "bytes")
+
+    def __init__(self, messages_per_second, burst, bytes_per_second):
+        self.messages = TokenBucket(messages_per_second, burst) if messages_per_second else None
+        self.bytes = TokenBucket(bytes_per_second, bytes_per_second) if bytes_per_second else None
+
+    # Seconds to wait before handling a frame of the given size
+    def take(self, size):
+        delay = 0.0
+        if self.messages is not None:
+            delay = self.messages.take()
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.take(size))
+        return delay
+
+    def refund(self, size):
+        if self.messages is not None:
+            self.messages.refund()
+        if self.bytes is not None:
+            self.bytes.refund(size)
+
+
+# Start-time fair queuing for a limited number of concurrent jobs
+#
+# Each connection has a virtual time that moves on by one for every job it
+# runs. Waiting jobs are started in order of their connection's virtual time,
+# and a connection that has been idle starts again from the scheduler's
+# current virtual time. A busy connection is therefore served at most as often
+# as each other connection with work waiting.
+class FairScheduler:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.running = 0
+
+        # Waiting jobs: (start tag, order, future)
+        self.waiting = []
+        self.order = itertools.count()
+
+        # Virtual time of the last job started, and each connection's virtual time
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+
+    # Wait for a slot for a job of key (a connection)
+    async def acquire(self, key):
+        start = max(self.finish_tags.get(key, 0.0), self.virtual_time)
+        self.finish_tags[key] = start + 1
+
+        if self.running < self.concurrency and not self.waiting:
+            self.running += 1
+            self.virtual_time = start
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (start, next(self.order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Pass the slot on if it was handed over just as the job was cancelled
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    # Finish a job, starting the next waiting one
+    def release(self):
+        while self.waiting:
+            start, _, future = heapq.heappop(self.waiting)
+            if future.done():
+                continue
+            self.virtual_time = start
+            future.set_result(None)
+            return
+        self.running -= 1
+
+    def forget(self, key):
+        self.finish_tags.pop(key, None)
+
+    def stats(self):
+        return {"running": self.running, "waiting": len(self.waiting)}
+
+
+# Admission queue for hellos
+#
+# When a server restarts, all of its clients reconnect at once. Hellos are let
+# in at most concurrency at a time (and at most rate per second, 0 = no limit)
+# in the order they arrived, so the hellos of a reconnect storm are worked
+# through steadily instead of all parsing keys and queueing verifications at
+# once. Once max_waiting hellos are queued, further ones are turned away
+# straight away (the client is told to try again later) rather than building
+# an unbounded backlog.
+class AdmissionQueue:
+    def __init__(self, concurrency, rate=0, max_waiting=10000):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, 1) if rate else None
+        self.max_waiting = max_waiting
+        self.running = 0
+
+        # Futures of waiting hellos, oldest first
+        self.waiting = deque()
+
+        # Counters
+        self.admitted = 0
+        self.rejected = 0
+
+    # Wait for a hello's turn, returning False if the queue is full
+    # (release() must be called once an admitted hello is done)
+    async def acquire(self):
+        if self.running >= self.concurrency or self.waiting:
+            if len(self.waiting) >= self.max_waiting:
+                self.rejected += 1
+                return False
+
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Pass the turn on if it was handed over just as the hello was cancelled
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        else:
+            self.running += 1
+
+        # Pace the hellos (the turn is held while waiting, so they start in order)
+        if self.bucket is not None:
+            delay = self.bucket.take()
+            if delay:
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    self.release()
+                    raise
+
+        self.admitted += 1
+        return True
+
+    # Finish a hello, letting the next waiting one in
+    def release(self):
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self):
+        return {"running": self.running, "waiting": len(self.waiting), "admitted": self.admitted, "rejected": self.rejected}
@@ -0,0 +1,75 @@
+# Server logging
+#
+# Log calls on the event loop only format a record and put it on a queue; a
+# background thread writes the records out (logging's QueueHandler and
+# QueueListener). Each message (by its format string) is also rate limited, so
+# a flood of identical events cannot turn into a flood of writes. Dropped
+# records are counted and reported with the next record of that message that
+# gets through.
+
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+# Token bucket per message format string (rate records per second, up to rate at once)
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(1, rate)
+
+        # format string -> [tokens, last refill time, records dropped since the last one let through]
+        self.buckets = {}
+
+        # Records dropped in total
+        self.dropped = 0
+
+    def filter(self, record):
+        if not self.rate:
+            return True
+
+        now = time.monotonic()
+        bucket = self.buckets.get(record.msg)
+        if bucket is None:
+            bucket = self.buckets[record.msg] = [self.burst, now, 0]
+
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            bucket[2] += 1
+            self.dropped += 1
+            return False
+
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f"{record.msg} ({bucket[2]} similar messages suppressed)"
+            bucket[2] = 0
+        return True
+
+
+# Send server log records through a queue to a writer thread
+# Returns the listener (stop it at shutdown to flush the queue) and the rate limit filter
+def setup_logging(level="INFO", rate=0, stream=None):
+    logger = logging.getLogger("olaf")
+    logger.setLevel(level)
+    logger.propagate = False
+
+    rate_limit = RateLimitFilter(rate)
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(rate_limit)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(queue_handler.queue, output)
+    listener.start()
+
+    return listener, rate_limit
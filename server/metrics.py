@@ -0,0 +1,133 @@
+# Server metrics
+#
+# Counters and latency histograms, kept in plain Python objects and only
+# summarised when stats are requested. Histograms use fixed log-scale buckets
+# (four per doubling), so recording a value is a few arithmetic operations and
+# percentiles are accurate to within about 20%.
+
+import asyncio
+import functools
+import math
+import time
+from collections import defaultdict
+
+# Histogram buckets: 4 per doubling from 1 microsecond up to about 70 seconds
+BUCKETS_PER_DOUBLING = 4
+BUCKET_MIN = 1e-6
+BUCKET_COUNT = 26 * BUCKETS_PER_DOUBLING
+
+# How often the event loop lag is sampled (seconds)
+LOOP_LAG_INTERVAL = 0.1
+
+
+# Latency histogram (values in seconds)
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+        if value <= BUCKET_MIN:
+            index = 0
+        else:
+            index = min(BUCKET_COUNT - 1, int(math.log2(value / BUCKET_MIN) * BUCKETS_PER_DOUBLING) + 1)
+        self.buckets[index] += 1
+
+    # Upper bound of a bucket
+    @staticmethod
+    def bucket_limit(index):
+        return BUCKET_MIN * 2 ** (index / BUCKETS_PER_DOUBLING)
+
+    # Value below which the fraction p of the observed values lie (bucket upper bound)
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+
+        rank = math.ceil(p * self.count)
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_limit(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "p999_ms": round(self.percentile(0.999) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.started = time.monotonic()
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    def summary(self):
+        return {
+            "uptime_s": round(time.monotonic() - self.started, 1),
+            "counters": dict(self.counters),
+            "latency": {name: histogram.summary() for name, histogram in self.histograms.items()},
+        }
+
+
+# Decorator for Server handler coroutines: counts calls and errors and records
+# the handler's latency under name (in self.metrics)
+def timed(name):
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await handler(self, *args, **kwargs)
+            except Exception:
+                self.metrics.count(name + ".errors")
+                raise
+            finally:
+                self.metrics.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# Measures how late the event loop wakes up a sleeping task (time other
+# callbacks held the loop), recorded as the "event_loop_lag" histogram
+class LoopLagMonitor:
+    def __init__(self, metrics, interval=LOOP_LAG_INTERVAL):
+        self.metrics = metrics
+        self.interval = interval
+        self.task = None
+
+        # Most recent lag (seconds)
+        self.last = 0.0
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, time.perf_counter() - start - self.interval)
+            self.metrics.observe("event_loop_lag", self.last)
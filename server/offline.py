@@ -0,0 +1,378 @@
+# Store-and-forward for chats to offline recipients
+#
+# Chats for recipients that are not connected anywhere in the neighbourhood are
+# appended to a log of fixed size, memory-mapped segment files, and an in-memory
+# index keeps the position of every stored chat by recipient. A group chat is
+# stored once, with the list of its offline recipients, and indexed for each
+# of them. When a recipient connects, its chats are read straight out of the
+# mapped segments and sent together, and once they have been sent a
+# "delivered" record is appended for it (up to the last chat sent), so the
+# index can be rebuilt from the log after a restart.
+#
+# The log is kept bounded: whole segments are deleted from the start of the log
+# once nothing in them is waiting for delivery, or once they are older than the
+# retention time or the log is over its size limit (their chats are dropped).
+# Each recipient keeps only its newest chats, and each sender can only have so
+# many bytes of chats waiting, so one sender cannot push everyone else's out.
+
+import mmap
+import os
+import re
+import struct
+import time
+from collections import deque
+
+# Record header: record type, write time, name length, payload length. The name
+# is the recipient of chat and delivered records, and the sender of stored
+# records (a chat for a list of recipients: recipient count, recipients, frame).
+RECORD_HEADER = struct.Struct(">BdBI")
+CHAT_RECORD = 1
+DELIVERED_RECORD = 2
+BINARY_CHAT_RECORD = 3
+STORED_RECORD = 4
+BINARY_STORED_RECORD = 5
+RECORD_TYPES = (CHAT_RECORD, DELIVERED_RECORD, BINARY_CHAT_RECORD, STORED_RECORD, BINARY_STORED_RECORD)
+
+# Recipient count of a stored record, and the position (segment number, offset)
+# of the last chat covered by a delivered record
+RECIPIENT_COUNT = struct.Struct(">H")
+POSITION = struct.Struct(">IQ")
+
+# Length of a client ID
+FINGERPRINT_LENGTH = 64
+
+SEGMENT_NAME = re.compile(r"^(\d{8})\.log$")
+
+# Client IDs are hex SHA256 fingerprints
+FINGERPRINT = re.compile(r"^[0-9a-f]{64}$")
+
+
+# Check if a recipient ID can be a client ID (chats to anything else are not stored)
+def is_fingerprint(client_id):
+    return isinstance(client_id, str) and FINGERPRINT.match(client_id) is not None
+
+
+# One log file, created at its full size and memory-mapped
+class Segment:
+    def __init__(self, path, number, size):
+        self.path = path
+        self.number = number
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # New segments are created at their full size (sparse, so unused space takes no disk)
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+        # End of the last record
+        self.end = 0
+
+        # Stored chats in this segment not yet delivered or dropped, and their recipients
+        self.live = 0
+        self.recipients = set()
+
+        # Write time of the newest record
+        self.newest = 0.0
+
+    # Append a record, returning its offset (None if the segment is full)
+    def append(self, record_type, recipient: bytes, payload: bytes, now):
+        offset = self.end
+        start = offset + RECORD_HEADER.size
+        end = start + len(recipient) + len(payload)
+        if end > self.size:
+            return None
+
+        # Header last: a record cut short by a crash has no header and ends the log
+        self.map[start:start + len(recipient)] = recipient
+        self.map[start + len(recipient):end] = payload
+        RECORD_HEADER.pack_into(self.map, offset, record_type, now, len(recipient), len(payload))
+
+        self.end = end
+        self.newest = now
+        return offset
+
+    # Frame stored in the chat record at offset (text, or bytes for a binary frame)
+    def read(self, offset):
+        record_type, _, name_length, length = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size + name_length
+        end = start + length
+        if record_type in (STORED_RECORD, BINARY_STORED_RECORD):
+            start += RECIPIENT_COUNT.size + RECIPIENT_COUNT.unpack_from(self.map, start)[0] * FINGERPRINT_LENGTH
+        payload = self.map[start:end]
+        return payload if record_type in (BINARY_CHAT_RECORD, BINARY_STORED_RECORD) else payload.decode('utf-8')
+
+    # Recipients of the stored record at offset
+    def recipients_of(self, offset):
+        _, _, name_length, _ = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size + name_length
+        count = RECIPIENT_COUNT.unpack_from(self.map, start)[0]
+        start += RECIPIENT_COUNT.size
+        recipients = self.map[start:start + count * FINGERPRINT_LENGTH].decode('ascii')
+        return [recipients[i:i + FINGERPRINT_LENGTH] for i in range(0, len(recipients), FINGERPRINT_LENGTH)]
+
+    # Position of the last chat covered by the delivered record at offset (None for all chats before it)
+    def delivered_position(self, offset):
+        _, _, name_length, length = RECORD_HEADER.unpack_from(self.map, offset)
+        if length != POSITION.size:
+            return None
+        return POSITION.unpack_from(self.map, offset + RECORD_HEADER.size + name_length)
+
+    # Records from the start of the segment: (offset, record type, write time, name, payload length)
+    def scan(self):
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            record_type, written, name_length, length = RECORD_HEADER.unpack_from(self.map, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + name_length + length
+            if record_type not in RECORD_TYPES or end > self.size:
+                break
+
+            yield offset, record_type, written, self.map[start:start + name_length].decode('ascii'), length
+            offset = end
+            self.end = end
+            self.newest = written
+
+    def close(self, delete=False):
+        self.map.close()
+        if delete:
+            os.remove(self.path)
+
+
+# Append-only log of chats waiting for offline recipients
+class OfflineStore:
+    def __init__(self, directory, segment_size=16 << 20, max_bytes=256 << 20, retention=7 * 24 * 3600, max_per_recipient=1000, max_bytes_per_sender=16 << 20):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_bytes // segment_size)
+        self.retention = retention
+        self.max_per_recipient = max_per_recipient
+        self.max_bytes_per_sender = max_bytes_per_sender
+
+        # Segments by number, oldest first (the last one is written to)
+        self.segments = {}
+
+        # Recipient -> (segment number, offset) of its stored chats, oldest first
+        self.index = {}
+
+        # (segment number, offset) -> [sender, size, recipients still to deliver to] of stored
+        # chats with a sender, and bytes of chats waiting to be delivered per sender
+        self.records = {}
+        self.sender_bytes = {}
+
+        # Counters
+        self.appended = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.expired = 0
+        self.rejected = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    # Rebuild the index from the segments on disk
+    def load(self):
+        names = sorted(name for name in os.listdir(self.directory) if SEGMENT_NAME.match(name))
+        for name in names:
+            number = int(SEGMENT_NAME.match(name).group(1))
+            segment = Segment(os.path.join(self.directory, name), number, self.segment_size)
+            self.segments[number] = segment
+
+            for offset, record_type, _, name, length in segment.scan():
+                if record_type in (STORED_RECORD, BINARY_STORED_RECORD):
+                    self.add_record(name, segment, offset, segment.recipients_of(offset), RECORD_HEADER.size + len(name) + length)
+                elif record_type != DELIVERED_RECORD:
+                    self.add_to_index(name, segment, offset)
+                else:
+                    self.discard(name, segment.delivered_position(offset))
+
+        if not self.segments:
+            self.new_segment()
+
+        self.truncate(time.time())
+
+        # Counters are for this run only (rebuilding the index replays earlier drops)
+        self.dropped = self.expired = 0
+
+    # Open the next segment for writing
+    def new_segment(self):
+        number = next(reversed(self.segments)) + 1 if self.segments else 0
+        path = os.path.join(self.directory, f"{number:08d}.log")
+        self.segments[number] = Segment(path, number, self.segment_size)
+        return self.segments[number]
+
+    def current(self):
+        return self.segments[next(reversed(self.segments))]
+
+    # Record a stored chat for its recipients (counted against its sender's bytes, if it has one)
+    def add_record(self, sender, segment, offset, recipients, size):
+        if sender:
+            self.records[(segment.number, offset)] = [sender, size, len(recipients)]
+            self.sender_bytes[sender] = self.sender_bytes.get(sender, 0) + size
+        for recipient in recipients:
+            self.add_to_index(recipient, segment, offset)
+
+    # Record a stored chat in the index (dropping the recipient's oldest if it has too many)
+    def add_to_index(self, recipient, segment, offset):
+        entries = self.index.setdefault(recipient, deque())
+        entries.append((segment.number, offset))
+        segment.live += 1
+        segment.recipients.add(recipient)
+
+        if len(entries) > self.max_per_recipient:
+            self.release(*entries.popleft())
+            self.dropped += 1
+
+    # A stored chat no longer waits for one of its recipients
+    def release(self, number, offset):
+        segment = self.segments.get(number)
+        if segment is not None:
+            segment.live -= 1
+
+        record = self.records.get((number, offset))
+        if record is not None:
+            record[2] -= 1
+            if record[2] == 0:
+                del self.records[(number, offset)]
+                sender, size, _ = record
+                self.sender_bytes[sender] -= size
+                if not self.sender_bytes[sender]:
+                    del self.sender_bytes[sender]
+
+    # Forget a recipient's stored chats, up to a position (all of them if None)
+    def discard(self, recipient, position=None):
+        entries = self.index.get(recipient)
+        count = 0
+        while entries and (position is None or entries[0] <= position):
+            self.release(*entries.popleft())
+            count += 1
+        if entries is not None and not entries:
+            del self.index[recipient]
+        return count
+
+    # Append a record, starting a new segment (and dropping the oldest) when the current one is full
+    def append(self, record_type, recipient, payload, now):
+        recipient = recipient.encode('ascii')
+        segment = self.current()
+        offset = segment.append(record_type, recipient, payload, now)
+        if offset is None:
+            segment = self.new_segment()
+            offset = segment.append(record_type, recipient, payload, now)
+            self.truncate(now)
+        return segment, offset
+
+    # Store a chat frame once for its offline recipients (client IDs), returning False if
+    # it is too large to store or its sender (a client ID, None if not known) has too much
+    # waiting already
+    def put(self, recipients, frame, sender=None):
+        recipients = list(dict.fromkeys(recipients))
+        if not recipients or not all(is_fingerprint(recipient) for recipient in recipients):
+            return False
+        if isinstance(frame, str):
+            record_type, frame = STORED_RECORD, frame.encode('utf-8')
+        else:
+            record_type = BINARY_STORED_RECORD
+        sender = sender or ""
+        payload = RECIPIENT_COUNT.pack(len(recipients)) + "".join(recipients).encode('ascii') + frame
+
+        size = RECORD_HEADER.size + len(sender) + len(payload)
+        if size > self.segment_size or len(recipients) > 0xffff:
+            return False
+        if sender and self.sender_bytes.get(sender, 0) + size > self.max_bytes_per_sender:
+            self.rejected += 1
+            return False
+
+        segment, offset = self.append(record_type, sender, payload, time.time())
+        self.add_record(sender, segment, offset, recipients, size)
+        self.appended += 1
+        return True
+
+    # Check if there are chats stored for a recipient
+    def __contains__(self, recipient):
+        return recipient in self.index
+
+    # All of a recipient's stored chat frames (oldest first), and the position of the last
+    # one (to mark them delivered with once they have been sent)
+    def peek(self, recipient):
+        self.truncate(time.time())
+
+        entries = self.index.get(recipient)
+        if not entries:
+            return [], None
+
+        return [self.segments[number].read(offset) for number, offset in entries], entries[-1]
+
+    # Mark a recipient's stored chats up to a position (from peek) delivered
+    def mark_delivered(self, recipient, position):
+        count = self.discard(recipient, position)
+        if count:
+            now = time.time()
+            self.append(DELIVERED_RECORD, recipient, POSITION.pack(*position), now)
+            self.delivered += count
+            self.truncate(now)
+
+    # Take all of a recipient's stored chat frames (oldest first), marking them delivered
+    def take(self, recipient):
+        frames, position = self.peek(recipient)
+        if frames:
+            self.mark_delivered(recipient, position)
+        return frames
+
+    # Delete segments from the start of the log that are no longer needed. Only the oldest
+    # segment is ever deleted, so "delivered" records always outlive the chats they cover.
+    def truncate(self, now):
+        while True:
+            segment = self.segments[next(iter(self.segments))]
+            if segment is self.current():
+                # Move on from an expired segment that has not filled up, so it can be deleted
+                if segment.live and segment.newest < now - self.retention:
+                    self.new_segment()
+                    continue
+                return
+
+            live = segment.live
+            if live == 0:
+                pass
+            elif len(self.segments) > self.max_segments:
+                self.drop_segment(segment)
+                self.dropped += live
+            elif segment.newest < now - self.retention:
+                self.drop_segment(segment)
+                self.expired += live
+            else:
+                return
+
+            del self.segments[segment.number]
+            segment.close(delete=True)
+
+    # Remove the index entries pointing into a segment that is about to be deleted
+    def drop_segment(self, segment):
+        for recipient in segment.recipients:
+            entries = self.index.get(recipient)
+            while entries and entries[0][0] <= segment.number:
+                self.release(*entries.popleft())
+            if entries is not None and not entries:
+                del self.index[recipient]
+
+    def stats(self):
+        return {
+            "recipients": len(self.index),
+            "stored": sum(segment.live for segment in self.segments.values()),
+            "segments": len(self.segments),
+            "appended": self.appended,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "expired": self.expired,
+            "rejected": self.rejected,
+            "senders": len(self.sender_bytes),
+        }
+
+    # Close the segments (written records stay in the page cache if the process exits without this)
+    def close(self):
+        for segment in self.segments.values():
+            segment.map.flush()
+            segment.close()
+        self.segments = {}
@@ -0,0 +1,88 @@
+# Sampling profiler for the server's event loop thread
+#
+# A background thread looks at the event loop thread's current stack every
+# interval seconds and counts the functions on it. Nothing is added to the
+# code being profiled, so it can be switched on in a running server (see the
+# profile_request admin message) at a cost of one stack walk per sample.
+
+import os
+import sys
+import threading
+from collections import Counter
+
+
+# Name of the function a frame is running (file:line of its definition)
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # Thread being profiled (the one that calls start())
+        self.target = None
+
+        self.samples = 0
+
+        # Samples with the function running (self) or anywhere on the stack (cumulative)
+        self.self_counts = Counter()
+        self.cumulative_counts = Counter()
+
+    def running(self):
+        return self.thread is not None
+
+    # Start sampling the calling thread (clears earlier samples)
+    def start(self):
+        if self.running():
+            return
+
+        self.target = threading.get_ident()
+        self.samples = 0
+        self.self_counts.clear()
+        self.cumulative_counts.clear()
+
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.thread.start()
+
+    # Stop sampling and return the report
+    def stop(self, limit=30):
+        if self.running():
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        return self.report(limit)
+
+    def sample(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+
+            self.samples += 1
+            self.self_counts[frame_name(frame)] += 1
+
+            # Count recursive functions once per sample
+            seen = set()
+            while frame is not None:
+                name = frame_name(frame)
+                if name not in seen:
+                    seen.add(name)
+                    self.cumulative_counts[name] += 1
+                frame = frame.f_back
+
+    # Functions with the most samples (percentages of all samples)
+    def report(self, limit=30):
+        def top(counts):
+            return [[name, count, round(count / self.samples * 100, 1)] for name, count in counts.most_common(limit)]
+
+        return {
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "self": top(self.self_counts) if self.samples else [],
+            "cumulative": top(self.cumulative_counts) if self.samples else [],
+        }
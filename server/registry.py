@@ -0,0 +1,194 @@
+# Connection registry for clients connected to this server
+#
+# Every lookup the server makes on the hot path (by websocket for each inbound
+# message, by fingerprint for each private chat) is a single dict access, so
+# the cost per message does not grow with the number of connected clients.
+#
+# The client list (clients on this server and on neighbourhood servers) is
+# versioned: every change bumps the version and is kept in a bounded change log,
+# so clients that already hold a list only need the changes since their version.
+
+import secrets
+from collections import deque
+
+# Number of client list changes kept for delta updates
+CLIENT_LIST_HISTORY = 1024
+
+
+# Compact record for a connected client (replaces the per-client dict)
+class ClientRecord:
+    __slots__ = ("fingerprint", "public_key", "verify_key", "websocket", "outbox", "counter")
+
+    def __init__(self, fingerprint, public_key: str, verify_key, websocket, outbox, counter):
+        # Client ID (SHA256 of base64 encoded RSA public key)
+        self.fingerprint = fingerprint
+
+        # Client's public key (PEM string, the same object as in the client list)
+        self.public_key = public_key
+
+        # Parsed public key (created once at hello, used to verify every message;
+        # None until first needed for a client that resumed its session)
+        self.verify_key = verify_key
+
+        # WebSocket object for communication
+        self.websocket = websocket
+
+        # Outbound queue for messages relayed to this client (see broadcast.py)
+        self.outbox = outbox
+
+        # Most recent counter value (used to prevent replay attacks)
+        self.counter = counter
+
+
+# Versioned list of clients in the neighbourhood, grouped by home server
+class ClientList:
+    def __init__(self, history=CLIENT_LIST_HISTORY):
+        # Server address -> {fingerprint: PEM string}, in connection order
+        self.servers = {}
+
+        # Fingerprint -> home server address
+        self.homes = {}
+
+        # Per-server sequence number (counts changes to that server's clients only)
+        self.seqs = {}
+
+        # Server address -> address shown to clients (workers of one server share its address)
+        self.aliases = {}
+
+        # Identifies this list's version numbers (clients only get deltas for versions from this list)
+        self.list_id = secrets.token_hex(8)
+
+        # Client list version and recent changes: (version, address, fingerprint, PEM string or None if removed)
+        self.version = 0
+        self.changes = deque(maxlen=history)
+
+    # Home server address of a client (None if not in the list)
+    def home(self, fingerprint):
+        return self.homes.get(fingerprint)
+
+    def add(self, address, fingerprint, public_key: str):
+        self.servers.setdefault(address, {})[fingerprint] = public_key
+        self.homes[fingerprint] = address
+        self.record(address, fingerprint, public_key)
+
+    def remove(self, address, fingerprint):
+        clients = self.servers.get(address)
+        if clients is None or clients.pop(fingerprint, None) is None:
+            return
+        if self.homes.get(fingerprint) == address:
+            del self.homes[fingerprint]
+        self.record(address, fingerprint, None)
+
+    # Replace all clients of a server (e.g. a full list from a neighbourhood server)
+    def replace(self, address, public_keys, seq=None):
+        old = self.servers.get(address, {})
+        new = dict(public_keys)
+
+        for fingerprint in [fingerprint for fingerprint in old if fingerprint not in new]:
+            self.remove(address, fingerprint)
+        for fingerprint, public_key in new.items():
+            if fingerprint not in old:
+                self.add(address, fingerprint, public_key)
+
+        if seq is not None:
+            self.seqs[address] = seq
+
+    # Forget a server and all of its clients
+    def remove_server(self, address):
+        self.replace(address, [])
+        self.servers.pop(address, None)
+        self.seqs.pop(address, None)
+
+    def record(self, address, fingerprint, public_key):
+        self.version += 1
+        self.seqs[address] = self.seqs.get(address, 0) + 1
+        self.changes.append((self.version, address, fingerprint, public_key))
+
+    # Address shown to clients for a server
+    def public_address(self, address):
+        return self.aliases.get(address, address)
+
+    # Full list in client list message format
+    def snapshot(self):
+        servers = {}
+        for address, clients in self.servers.items():
+            address = self.public_address(address)
+            servers.setdefault(address, {"address": address, "clients": []})["clients"].extend(clients.values())
+        return list(servers.values())
+
+    # Net changes since a version, in client update message format
+    # Returns None if the version is unknown or too old to build a delta from
+    def changes_since(self, version):
+        if version == self.version:
+            return []
+        if version > self.version or not self.changes or self.changes[0][0] > version + 1:
+            return None
+
+        # Only the last change to each client matters
+        latest = {}
+        for change_version, address, fingerprint, public_key in reversed(self.changes):
+            if change_version <= version:
+                break
+            latest.setdefault((address, fingerprint), public_key)
+
+        servers = {}
+        for (address, fingerprint), public_key in latest.items():
+            address = self.public_address(address)
+            server = servers.setdefault(address, {"address": address, "added": [], "removed": []})
+            if public_key is None:
+                server["removed"].append(fingerprint)
+            else:
+                server["added"].append(public_key)
+        return list(servers.values())
+
+
+class ClientRegistry:
+    def __init__(self, address, history=CLIENT_LIST_HISTORY):
+        # Address of this server (home server of the registered clients)
+        self.address = address
+
+        # Fingerprint -> client record
+        self.by_fingerprint = {}
+
+        # WebSocket -> client record (reverse index)
+        self.by_websocket = {}
+
+        # Client list (this server's clients, plus neighbourhood clients added by the server)
+        self.client_list = ClientList(history)
+
+    def __len__(self):
+        return len(self.by_fingerprint)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.by_fingerprint
+
+    def __iter__(self):
+        return iter(self.by_fingerprint.values())
+
+    # Get a client record by fingerprint (None if not connected)
+    def get(self, fingerprint):
+        return self.by_fingerprint.get(fingerprint)
+
+    # Get a client record by websocket (None if hello has not been sent)
+    def get_by_websocket(self, websocket):
+        return self.by_websocket.get(websocket)
+
+    # Register a new client
+    def add(self, record: ClientRecord):
+        self.by_fingerprint[record.fingerprint] = record
+        self.by_websocket[record.websocket] = record
+        self.client_list.add(self.address, record.fingerprint, record.public_key)
+
+    # Remove the client using a websocket, returning its record (or None)
+    def remove_websocket(self, websocket):
+        record = self.by_websocket.pop(websocket, None)
+        if record is None:
+            return None
+
+        del self.by_fingerprint[record.fingerprint]
+        self.client_list.remove(self.address, record.fingerprint)
+        return record
+
+    # List of PEM public keys of this server's clients
+    def public_key_list(self):
+        return list(self.client_list.servers.get(self.address, {}).values())
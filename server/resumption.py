@@ -0,0 +1,255 @@
+# Session resumption tickets
+#
+# A client that completes hello gets a ticket: its client ID, its counter and
+# the time, with an HMAC-SHA256 over them. The HMAC key is kept in a file, so
+# tickets survive a restart and every worker (and every server started from
+# the same directory) accepts them. A client reconnecting with its ticket and
+# public key is let back in after a SHA256 and an HMAC check instead of a key
+# parse and an RSA verify, and its key is only parsed once it sends a signed
+# message. That makes reconnecting cheap for the server after a restart, when
+# all of its clients come back at once.
+#
+# Each resume is answered with a new ticket, and only the newest ticket for a
+# client is accepted, once. The newest ticket of every client and the last
+# counter the server accepted from it are kept in a small SQLite database next
+# to the key (shared by the workers, and kept across restarts), so a resumed
+# client starts from its last counter, not the one in its ticket, and signed
+# messages recorded before cannot be sent again. Counters are saved when the
+# client disconnects and every ticket_save_interval seconds while it is
+# connected (if the server crashes, the last few seconds are lost). A ticket
+# only lets its holder take the client's place, not send messages as the
+# client (those are still signed), but it is a secret just like the
+# connection it was sent on.
+
+import asyncio
+import concurrent.futures
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import sqlite3
+import tempfile
+import time
+
+# Size of the HMAC key (bytes)
+TICKET_KEY_SIZE = 32
+
+# Counters are stored as SQLite integers (signed 64-bit)
+MAX_COUNTER = 2**63
+
+# Seconds between deleting the sessions of clients whose newest ticket has expired
+PRUNE_INTERVAL = 3600
+
+log = logging.getLogger("olaf.resumption")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    fingerprint TEXT PRIMARY KEY,
+    issued INTEGER NOT NULL,
+    counter INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+# Check that a message counter is an integer the store can keep
+def valid_counter(counter):
+    return type(counter) is int and 0 <= counter < MAX_COUNTER
+
+
+# Load the ticket key from a file, creating it if it does not exist
+# (written under another name first, so a worker never reads a half-written key)
+def load_ticket_key(path):
+    try:
+        with open(path, "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".ticket-key-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(secrets.token_bytes(TICKET_KEY_SIZE))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            # Another worker created it first
+            pass
+    finally:
+        os.remove(temp_path)
+
+    with open(path, "rb") as file:
+        return file.read()
+
+
+# Issues and checks tickets: "<client ID>.<counter>.<issue time in microseconds>.<HMAC>"
+#
+# The store is shared by the workers, so a statement can wait for another worker's
+# write: every database call runs on a thread of its own (with its own connection,
+# opened on first use), never on the event loop.
+class TicketBook:
+    def __init__(self, key, lifetime, path, save_interval=1.0):
+        self.key = key
+        self.lifetime = lifetime
+        self.path = path
+        self.save_interval = save_interval
+
+        # Client ID -> (issue time of its newest ticket, or 0 once it has been used; last counter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tickets")
+        self.db = None
+        self.closed = False
+        self.pruned = 0.0
+
+        # Counters accepted from connected clients since they were last saved
+        self.counters = {}
+        self.task = None
+
+        # Counters
+        self.issued = 0
+        self.resumed = 0
+        self.rejected = 0
+
+    def mac(self, payload):
+        return hmac.new(self.key, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    # Run a function on the database thread
+    async def call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    # Run a statement (on the database thread), returning all rows
+    def execute(self, sql, parameters=()):
+        if self.db is None:
+            # Autocommit: every statement is its own transaction
+            self.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+        return self.db.execute(sql, parameters).fetchall()
+
+    # New ticket for a client with its current counter (older tickets for it stop being accepted),
+    # or None if it could not be stored
+    async def issue(self, fingerprint, counter):
+        issued = time.time_ns() // 1000
+        self.counters.pop(fingerprint, None)
+        try:
+            await self.call(self.execute, "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (fingerprint, issued, counter))
+        except sqlite3.Error as e:
+            log.warning("Could not store ticket of %s: %s", fingerprint, e)
+            return None
+
+        self.issued += 1
+        payload = f"{fingerprint}.{counter}.{issued}"
+        return f"{payload}.{self.mac(payload)}"
+
+    # Check a client's ticket and use it up, returning the client's last counter (None if the
+    # ticket is not valid)
+    async def check(self, ticket, fingerprint):
+        counter = await self.parse(ticket, fingerprint)
+        if counter is None:
+            self.rejected += 1
+        else:
+            self.resumed += 1
+        return counter
+
+    async def parse(self, ticket, fingerprint):
+        if not isinstance(ticket, str):
+            return None
+
+        payload, _, mac = ticket.rpartition(".")
+        if not hmac.compare_digest(mac.encode('utf-8'), self.mac(payload).encode('utf-8')):
+            return None
+
+        ticket_fingerprint, counter, issued = payload.split(".")
+        if ticket_fingerprint != fingerprint:
+            return None
+
+        issued = int(issued)
+        if issued / 1e6 + self.lifetime < time.time():
+            return None
+
+        # Only the newest ticket, and only once (in one statement, so two workers cannot both use it)
+        try:
+            rows = await self.call(
+                self.execute,
+                "UPDATE sessions SET issued = 0 WHERE fingerprint = ? AND issued = ? RETURNING counter",
+                (fingerprint, issued)
+            )
+        except sqlite3.Error as e:
+            log.warning("Could not check ticket of %s: %s", fingerprint, e)
+            return None
+        if not rows:
+            return None
+        return max(int(counter), rows[0][0])
+
+    # Note the counter of a signed message accepted from a client (saved with the next batch)
+    def update_counter(self, fingerprint, counter):
+        self.counters[fingerprint] = counter
+
+    # Save a client's counter now (when it disconnects; after close, the server has
+    # already noted the counters of the clients still connected)
+    async def save_counter(self, fingerprint, counter):
+        self.counters.pop(fingerprint, None)
+        if self.closed:
+            return
+        try:
+            await self.call(self.execute, "UPDATE sessions SET counter = max(counter, ?) WHERE fingerprint = ?", (counter, fingerprint))
+        except sqlite3.Error as e:
+            # Saved with the next batch instead
+            log.warning("Could not save counter of %s: %s", fingerprint, e)
+            self.counters.setdefault(fingerprint, counter)
+
+    # Save the counters noted since the last time, and delete expired sessions now and then
+    # (if saving fails, the counters are kept for the next time)
+    async def save(self):
+        if self.counters:
+            counters, self.counters = self.counters, {}
+            try:
+                await self.call(self.write_counters, [(counter, fingerprint) for fingerprint, counter in counters.items() if valid_counter(counter)])
+            except sqlite3.Error as e:
+                log.warning("Could not save %d counters: %s", len(counters), e)
+                # Counters noted since are newer
+                for fingerprint, counter in counters.items():
+                    self.counters.setdefault(fingerprint, counter)
+                return
+        if time.monotonic() - self.pruned > PRUNE_INTERVAL:
+            self.pruned = time.monotonic()
+            try:
+                await self.call(self.execute, "DELETE FROM sessions WHERE issued < ?", ((time.time() - self.lifetime) * 1e6,))
+            except sqlite3.Error as e:
+                log.warning("Could not delete expired sessions: %s", e)
+
+    # Write a batch of (counter, client ID) in one transaction (on the database thread)
+    def write_counters(self, rows):
+        self.execute("BEGIN")
+        try:
+            self.db.executemany("UPDATE sessions SET counter = max(counter, ?) WHERE fingerprint = ?", rows)
+            self.db.execute("COMMIT")
+        except BaseException:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            raise
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await self.save()
+            await asyncio.sleep(self.save_interval)
+
+    # Save the counters noted so far, then close the database
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.closed = True
+        await self.save()
+        await self.call(self.close_connection)
+        self.executor.shutdown()
+
+    def close_connection(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        return {"issued": self.issued, "resumed": self.resumed, "rejected": self.rejected, "unsaved": len(self.counters)}
@@ -1,36 +1,150 @@
+import argparse
 import asyncio
 import websockets
-import json
 import base64
+import binascii
 import hashlib
+import logging
+import os
 import sys
-
-import cryptography.exceptions
+import time
 
 from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+from websockets.datastructures import Headers
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+# Shared modules (message codec) are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import codec
+from config import HIGH_DENSITY_CONFIG, load_config
+from broadcast import Broadcaster
+from federation import Neighbourhood, load_server_key, load_server_public_keys, public_key_pem, signed_server_hello
+from files import FileServer, issue_token
+from keepalive import Keepalive
+from limits import RATE_LIMIT_POLICIES, AdmissionQueue, ConnectionLimiter, FairScheduler
+from logs import setup_logging
+from metrics import LoopLagMonitor, Metrics, timed
+from offline import OfflineStore, is_fingerprint
+from profiler import SamplingProfiler
+from registry import ClientRecord, ClientRegistry
+from replay import ReplayFilter
+from resumption import TicketBook, load_ticket_key, valid_counter
+from verifier import KeyCache, VerificationPool
+from workers import run_workers
+
+log = logging.getLogger("olaf.server")
+
+# Messages only answered for administrators (connections from localhost, see admin_allow_remote)
+ADMIN_MESSAGE_TYPES = ("stats_request", "profile_request")
+
+# Most rows an admin message can ask for (stats "top", profile "limit")
+MAX_ADMIN_ROWS = 1000
+
+# Handshake headers of clients once they are dropped (see drop_handshake_headers)
+NO_HEADERS = Headers()
 
 # Server class
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, config=None):
+        # Server settings (defaults in config.py)
+        self.config = load_config(config)
+        if self.config["rate_limit_policy"] not in RATE_LIMIT_POLICIES:
+            raise ValueError(f"Unknown rate limit policy: {self.config['rate_limit_policy']}")
+
         # IP and port number
         self.host = host
         self.port = port
         self.uri = f'ws://{self.host}:{self.port}'
 
-        # Store connected clients (to this server)
-        self.clients = {}
+        # Address other servers know this server by (workers sharing a port each have their own)
+        self.address = self.config["worker_address"] or self.uri
+
+        # Store connected clients (to this server), indexed by fingerprint and websocket
+        self.clients = ClientRegistry(self.address)
+
+        # Clients on this server and on neighbourhood servers (for client list requests and routing)
+        self.client_list = self.clients.client_list
+
+        # Clients of the other workers are shown with this server's address
+        for worker in self.config["workers"]:
+            self.client_list.aliases[worker] = self.uri
+
+        # Parsed public keys of clients seen recently (kept across reconnects)
+        self.key_cache = KeyCache()
+
+        # Signature verification workers (keeps RSA verifies off the event loop)
+        self.verification_pool = VerificationPool(
+            self.config["verify_mode"],
+            self.config["verify_workers"],
+            self.config["verify_batch_size"]
+        )
+
+        # Signatures verified recently, so duplicates are turned away before verifying them (see replay.py)
+        self.replay_filter = None
+        if self.config["replay_window"]:
+            self.replay_filter = ReplayFilter(self.config["replay_window"], self.config["replay_filter_size"])
+
+        # Signature verifications in progress, shared fairly between connections
+        self.verify_scheduler = FairScheduler(self.config["verify_concurrency"])
+
+        # Hellos waiting for their turn to be checked (paces reconnect storms)
+        self.admission = AdmissionQueue(self.config["hello_concurrency"], self.config["hello_rate"], self.config["hello_queue_size"])
+
+        # Session resumption tickets (set up when the server runs, see resumption.py)
+        self.tickets = None
+
+        # Encoded client list for the current client list version: (version, frame)
+        self.client_list_cache = (None, None)
+
+        # Fan-out of relayed messages to client outboxes
+        self.broadcaster = Broadcaster(self.config["outbox_size"], self.config["slow_consumer_policy"])
+
+        # List of servers in the neighbourhood (this server first)
+        self.neighbourhood_servers = [self.uri] + [uri for uri in self.config["neighbourhood"] if uri != self.uri]
+
+        # Persistent links to the other servers in the neighbourhood (and other workers)
+        self.neighbourhood = Neighbourhood(
+            self,
+            self.neighbourhood_servers + self.config["workers"],
+            self.config["peer_queue_size"],
+            self.config["peer_backoff_min"],
+            self.config["peer_backoff_max"]
+        )
 
-        # Client list (For client list request)
-        self.client_list = {"address": self.uri, "clients": []}
+        # Chats stored for offline recipients (opened when the server runs, see offline.py)
+        self.offline = None
 
-        # List of servers in the neighbourhood (hard coded for now, can probably be passed in as a text file)
-        self.neighbourhood_servers = [self.uri]
+        # HTTP file upload and download endpoint (set up when the server runs, see files.py)
+        self.file_port = self.config["file_port"] if self.config["file_port"] is not None else self.port + 1000
+        self.file_server = None
 
-        # List of clients in the neighbourhood (outside this server)
-        self.neighbourhood_clients = {}
+        # Incoming connections from neighbourhood servers (websocket -> address, and address -> latest websocket)
+        self.server_connections = {}
+        self.server_websockets = {}
+
+        # This server's key, the other servers' keys (address -> (parsed key, PEM)),
+        # loaded when the server runs, and the last server_hello counter accepted from each
+        self.server_key = None
+        self.server_keys = {}
+        self.server_hello_counters = {}
+
+        # Keepalive pings for all connections from one timer (otherwise websockets pings each connection itself)
+        self.keepalive = None
+        if self.config["keepalive_coalesced"] and self.config["keepalive_interval"]:
+            self.keepalive = Keepalive(self.config["keepalive_interval"], self.config["keepalive_timeout"])
+
+        # Counters and latency histograms (see metrics.py), and the number of open connections
+        self.metrics = Metrics()
+        self.loop_lag = LoopLagMonitor(self.metrics)
+        self.connections = 0
+
+        # Sampling profiler, started and stopped with profile_request admin messages
+        self.profiler = SamplingProfiler(self.config["profile_interval"])
+
+        # Log writer thread and rate limit (set up when the server runs)
+        self.log_listener = None
+        self.log_rate_limit = None
 
     # Check if a message is a valid OLAF Neighbourhood protocol message
     def check_json_headers(self, message: dict):
@@ -38,49 +152,63 @@ class Server:
         valid_keys = ["type", "data", "counter", "signature"]
 
         # List of valid data types for messages sent by client
-        valid_data_types = ["hello", "chat", "public_chat"]
+        valid_data_types = ["hello", "chat", "public_chat", "server_hello"]
 
         # Check if message has the required keys (and nothing else)
         for key in message.keys():
             if key not in valid_keys:
-                print(f"Message has invalid key: {key}")
+                log.info("Message has invalid key: %s", key)
                 return False
 
         # Check validity of data type (content is not checked at the moment)
         data_type = message["data"]["type"]
         if data_type not in valid_data_types:
-            print(f"Message has invalid data type: {data_type}")
+            log.info("Message has invalid data type: %s", data_type)
             return False
 
         return True
 
     # Function to validate signed data signatures
-    def validate_signature(self, message, public_key:bytes):
-        data = json.dumps(message["data"])
-        counter = str(message["counter"])
+    @timed("validate_signature")
+    async def validate_signature(self, websocket, message, frame, verify_key, public_key:str):
+        # Malformed signatures are rejected without verifying them
+        # (an RSA-PSS signature is exactly as long as the key; binary frames carry it as raw bytes)
         signature = message["signature"]
+        if not isinstance(signature, bytes):
+            try:
+                signature = base64.b64decode(signature, validate=True)
+            except (binascii.Error, TypeError, ValueError):
+                signature = None
+        if signature is None or len(signature) != verify_key.key_size // 8:
+            self.metrics.count("rejected.malformed_signature")
+            return False
 
-        public_key = serialization.load_pem_public_key(public_key)
-        data_c = bytes(data + counter, 'utf-8')
-
-        signature = base64.b64decode(signature)
+        # Signature covers the data exactly as received, plus the counter
+        # (frames with more than one "data" key are rejected: the one verified
+        # might not be the one that was parsed; so are binary frames whose data
+        # is not packed)
+        try:
+            data_c = codec.signed_bytes(frame, message)
+        except ValueError:
+            self.metrics.count("rejected.malformed_data")
+            return False
 
+        # Verification runs in the worker pool (see verifier.py), with the
+        # pool's slots shared fairly between connections
+        await self.verify_scheduler.acquire(websocket)
         try:
-            public_key.verify(
-                signature,
-                data_c,
-                padding.PSS(
-                    mgf=padding.MGF1(hashes.SHA256()),
-                    salt_length=padding.PSS.MAX_LENGTH
-                ), 
-                hashes.SHA256()
-                )
-            print("Signature is authentic.")
+            authentic = await self.verification_pool.verify(verify_key, public_key, signature, data_c)
+        finally:
+            self.verify_scheduler.release()
+
+        if authentic:
+            if self.replay_filter is not None:
+                self.replay_filter.add(message["signature"])
             return True
 
-        except cryptography.exceptions.InvalidSignature:
-            print("Signature is not authentic.")
-            return False
+        self.metrics.count("invalid_signatures")
+        log.warning("Signature is not authentic.")
+        return False
 
 
     # Helper function to return a client ID
@@ -89,170 +217,804 @@ class Server:
 
     # Check if a user has an active websocket connection
     def check_connection(self, websocket):
-        for client in self.clients:
-            if self.clients[client]["websocket"] == websocket:
-                return self.clients[client]
-        return None
+        return self.clients.get_by_websocket(websocket)
 
     # Handler for all types of signed data messages
-    async def handle_signed_data(self, websocket, message):
+    @timed("handle_signed_data")
+    async def handle_signed_data(self, websocket, message, frame):
         # Check message has the valid headers first
         if not self.check_json_headers(message):
-            await websocket.send(json.dumps({"status": "error", "message": "Invalid signed data message"}))
+            await websocket.send(codec.dumps({"status": "error", "message": "Invalid signed data message"}))
             return
 
         data_type = message["data"]["type"]
         current_client = self.check_connection(websocket)
 
         if current_client is None:
-            if data_type == "hello":
-                await self.handle_hello(websocket, message)
+            if data_type in ("hello", "server_hello") and self.is_duplicate(message):
+                await websocket.send(codec.dumps({"status": "error", "message": "Duplicate message"}))
+            elif data_type == "hello":
+                await self.handle_hello(websocket, message, frame)
+            elif data_type == "server_hello":
+                await self.handle_server_hello(websocket, message, frame)
             else:
-                await websocket.send(json.dumps({"status": "error", "message": "Hello message not sent yet"}))
+                await websocket.send(codec.dumps({"status": "error", "message": "Hello message not sent yet"}))
         else:
-            public_key = current_client["public_key"]
-            counter = current_client["counter"]
-
-            if not self.validate_signature(message, public_key):
-                await websocket.send(json.dumps({"status": "error", "message": "Message has invalid signature"}))
+            # Cheap checks first, so replayed and spoofed messages cost no signature verification
+            counter = message.get("counter")
+            if not valid_counter(counter):
+                self.metrics.count("rejected.counter")
+                await websocket.send(codec.dumps({"status": "error", "message": "Invalid counter"}))
+            elif counter <= current_client.counter:
+                self.metrics.count("rejected.counter")
+                await websocket.send(codec.dumps({"status": "error", "message": "Counter value is too low"}))
+            elif message["data"].get("sender") != current_client.fingerprint:
+                self.metrics.count("rejected.sender")
+                await websocket.send(codec.dumps({"status": "error", "message": "Sender does not match client"}))
+            elif self.is_duplicate(message):
+                await websocket.send(codec.dumps({"status": "error", "message": "Duplicate message"}))
+            elif not await self.validate_signature(websocket, message, frame, self.verify_key(current_client), current_client.public_key):
+                await websocket.send(codec.dumps({"status": "error", "message": "Message has invalid signature"}))
             else:
-                if message["counter"] <= counter:
-                    await websocket.send(json.dumps({"status": "error", "message": "Counter value is too low"}))
+                # Update the counter (and note it for resuming the session, see resumption.py)
+                current_client.counter = counter
+                if self.tickets is not None:
+                    self.tickets.update_counter(current_client.fingerprint, counter)
+
+                # Handle valid message types
+                if data_type == "public_chat":
+                    await self.handle_public_chat(websocket, message, frame)
+                elif data_type == "chat":
+                    await self.handle_chat(websocket, message, frame)
                 else:
-                    # Update the counter
-                    self.clients[current_client["fingerprint"]]["counter"] = message["counter"]
-
-                    # Handle valid message types
-                    if data_type == "public_chat":
-                        await self.handle_public_chat(websocket, message)
-                    elif data_type == "chat":
-                        await self.handle_chat(websocket, message)
-                    else:
-                        await websocket.send(json.dumps({"status": "error", "message": "Invalid message type for connected client"}))
-
-    # Handle new client hello message
-    async def handle_hello(self, websocket, message):
+                    await websocket.send(codec.dumps({"status": "error", "message": "Invalid message type for connected client"}))
+
+    # Check if a message's signature was verified recently (a replayed or resent frame)
+    def is_duplicate(self, message):
+        if self.replay_filter is None or not self.replay_filter.seen(message.get("signature")):
+            return False
+        self.metrics.count("rejected.duplicate")
+        return True
+
+    # Handle new client hello message (let in through the admission queue, see limits.py)
+    @timed("handle_hello")
+    async def handle_hello(self, websocket, message, frame):
+        # The counter becomes the client's first counter (and goes in its ticket)
+        if not valid_counter(message.get("counter")):
+            self.metrics.count("rejected.counter")
+            await websocket.send(codec.dumps({"status": "error", "message": "Invalid counter for hello message"}))
+            return
+
+        if not await self.admission.acquire():
+            self.metrics.count("rejected.hello_busy")
+            await websocket.send(codec.dumps({"status": "error", "message": "Server busy, try again later", "retry_after": self.config["hello_retry_after"]}))
+            return
+
+        try:
+            # The client may have given up while it waited
+            if websocket.open:
+                await self.check_hello(websocket, message, frame)
+        finally:
+            self.admission.release()
+
+    # Check a hello's key and signature, and register the client
+    async def check_hello(self, websocket, message, frame):
+        # PEM string from the message (the only copy kept, shared by the client record and client list)
         public_key = message["data"]["public_key"]
 
         # Convert public key to bytes format
-        public_key = bytes(public_key, 'utf-8')
+        public_key_bytes = bytes(public_key, 'utf-8')
 
-        # Validate signature using new public key
-        if not self.validate_signature(message, public_key):
-            await websocket.send(json.dumps({"status": "error", "message": "Invalid signature for hello message"}))
+        # Generate unique client ID (SHA256 of base64 encoded RSA public key)
+        client_id = self.get_client_id(public_key_bytes)
+
+        # Check if client ID is a duplicate (before spending a key parse and verify on it)
+        if client_id in self.clients:
+            await websocket.send(codec.dumps({"status": "error", "message": "Client ID already exists"}))
             return
 
-        # Generate unique client ID (SHA256 of base64 encoded RSA public key)
-        client_id = self.get_client_id(public_key)
+        # Parse the public key (or reuse it if this client has connected before)
+        try:
+            verify_key = self.key_cache.get(client_id, public_key_bytes)
+        except ValueError:
+            await websocket.send(codec.dumps({"status": "error", "message": "Invalid public key for hello message"}))
+            return
 
-        # Check if client ID is a duplicate
+        # Validate signature using new public key
+        if not await self.validate_signature(websocket, message, frame, verify_key, public_key):
+            await websocket.send(codec.dumps({"status": "error", "message": "Invalid signature for hello message"}))
+            return
+
+        # The client may have connected on another connection while this hello was verified
         if client_id in self.clients:
-            await websocket.send(json.dumps({"status": "error", "message": "Client ID already exists"}))
+            await websocket.send(codec.dumps({"status": "error", "message": "Client ID already exists"}))
             return
 
-        # Get counter value from message
-        counter = message["counter"]
+        reply = {"status": "success", "message": "Hello successfully received"}
+        await self.register_client(websocket, client_id, public_key, verify_key, message["counter"], message["data"], reply)
 
-        # Add the client to the connected clients dictionary
-        self.clients[client_id] = {
-            'fingerprint': client_id,  # Client ID is also the fingerprint (stored for easier access)
-            'public_key': public_key,  # Store the client's public key
-            'websocket': websocket,    # Store the WebSocket object for communication
-            'counter': counter         # Store most recent counter value (used to prevent replay attacks)
-        }
+    # Handle a resume message: a returning client with a ticket from an earlier hello (see resumption.py)
+    @timed("handle_resume")
+    async def handle_resume(self, websocket, message):
+        public_key = message.get("public_key")
+        if self.tickets is None or not isinstance(public_key, str):
+            await websocket.send(codec.dumps({"status": "error", "message": "Session cannot be resumed, send hello"}))
+            return
 
-        # Append string version of public key to client list
-        self.client_list["clients"].append(public_key.decode('utf-8'))
+        # The client's own last counter, if it sends one (checked before the ticket is used up)
+        if "counter" in message and not valid_counter(message["counter"]):
+            self.metrics.count("rejected.counter")
+            await websocket.send(codec.dumps({"status": "error", "message": "Invalid counter"}))
+            return
 
-        # Respond to the client to confirm receipt of the 'hello'
-        await websocket.send(json.dumps({"status": "success", "message": "Hello successfully received", "client_id": str(client_id)}))
+        client_id = self.get_client_id(bytes(public_key, 'utf-8'))
+        if client_id in self.clients:
+            await websocket.send(codec.dumps({"status": "error", "message": "Client ID already exists"}))
+            return
+
+        # The ticket is checked against the client ID of the key (no key parse or signature check),
+        # and gives the last counter accepted from the client
+        counter = await self.tickets.check(message.get("ticket"), client_id)
+        if counter is None:
+            await websocket.send(codec.dumps({"status": "error", "message": "Invalid or expired ticket, send hello"}))
+            return
+
+        # The client's own last counter if that is later
+        # (signed messages with lower counters are rejected as replays)
+        counter = max(counter, message.get("counter", 0))
+
+        reply = {"status": "success", "message": "Session resumed"}
+        await self.register_client(websocket, client_id, public_key, None, counter, message, reply)
+
+    # Register a client after hello or resume, and send the reply
+    # (options holds the encodings the client offered, if any)
+    async def register_client(self, websocket, client_id, public_key, verify_key, counter, options, reply):
+        # Encoding for the client to send in (the first of the client's choices that the server allows)
+        encoding = self.choose_encoding(options.get("encodings"))
+
+        # Ticket to resume the session with next time (stored before the client is added,
+        # so nothing is sent to it before the reply)
+        if self.tickets is not None:
+            ticket = await self.tickets.issue(client_id, counter)
+            if ticket is not None:
+                reply["ticket"] = ticket
+
+            # The client may have connected on another connection while the ticket was stored
+            if client_id in self.clients:
+                await websocket.send(codec.dumps({"status": "error", "message": "Client ID already exists"}))
+                return
+
+        # Add the client to the connected clients registry (also adds it to the client list),
+        # with any chats stored while it was offline queued first
+        outbox = self.broadcaster.open_outbox(websocket, encoding)
+        if self.offline is not None and client_id in self.offline:
+            self.send_stored(outbox, client_id)
+        self.clients.add(ClientRecord(client_id, public_key, verify_key, websocket, outbox, counter))
+
+        # Respond to the client to confirm receipt of the 'hello' (with the encoding, if it offered any)
+        reply["client_id"] = str(client_id)
+        if "encodings" in options:
+            reply["encoding"] = encoding
+
+        # Where to upload files, on the host name the client reached us on, and the token to upload with
+        if self.file_server is not None:
+            reply["upload_url"] = f"http://{self.request_hostname(websocket)}:{self.file_port}/api/upload"
+            reply["upload_token"] = issue_token(self.file_server.key, client_id, self.config["upload_token_lifetime"])
+        await websocket.send(codec.dumps(reply))
+
+        # Nothing needs the handshake headers after hello
+        if self.config["drop_handshake_headers"]:
+            websocket.request_headers = websocket.response_headers = NO_HEADERS
+
+        # Tell everyone else (including neighbourhood servers) about the new client
+        self.push_client_update(self.client_list.version - 1, exclude=client_id)
+        self.push_local_change([public_key], [])
+
+    # Parsed public key of a client (clients that resumed a session have theirs parsed when first needed)
+    def verify_key(self, client):
+        if client.verify_key is None:
+            client.verify_key = self.key_cache.get(client.fingerprint, bytes(client.public_key, 'utf-8'))
+        return client.verify_key
+
+    # Host name a client connected to (from its Host header, without the port)
+    def request_hostname(self, websocket):
+        host = websocket.request_headers.get("Host") or self.host
+        if ":" in host and not host.endswith("]"):
+            host = host.rsplit(":", 1)[0]
+        return host
+
+    # Wire encoding for a client from the encodings it offered at hello (JSON if none match)
+    def choose_encoding(self, offered):
+        if not isinstance(offered, list):
+            return "json"
+        allowed = [encoding for encoding in self.config["encodings"] if encoding in codec.available_encodings()]
+        for encoding in offered:
+            if encoding in allowed:
+                return encoding
+        return "json"
 
     # Handle public chat (broadcast to clients in all neighbourhoods)
-    async def handle_public_chat(self, websocket, message):
+    @timed("handle_public_chat")
+    async def handle_public_chat(self, websocket, message, frame):
         sender_fingerprint = message["data"]["sender"]
 
-        # Relay to all clients connected to the server
-        for client in self.clients:
-            if client != sender_fingerprint:
-                await self.clients[client]["websocket"].send(json.dumps(message))
+        # Relay the original frame to all clients connected to the server (sent concurrently)
+        recipients = [client for client in self.clients if client.fingerprint != sender_fingerprint]
+        self.broadcaster.send(recipients, frame)
+
+        # Send once to each neighbourhood server (they relay it to their own clients)
+        self.neighbourhood.broadcast(frame)
+
+    # Recipients of a chat message (a single "recipient", or a "recipients" list for group
+    # chats, each recipient once), None if they are not valid or there are too many
+    def chat_recipients(self, message):
+        data = message["data"]
+        if "recipients" in data:
+            recipients = data["recipients"]
+            if not isinstance(recipients, list) or len(recipients) > self.config["max_recipients"]:
+                return None
+            if not all(isinstance(recipient, str) for recipient in recipients):
+                return None
+            return list(dict.fromkeys(recipients))
+        return [data["recipient"]]
 
     # Handle private chat (route to individual recipients)
-    async def handle_chat(self, websocket, message):
-        recipient_id = message["data"]["recipient"]
+    @timed("handle_chat")
+    async def handle_chat(self, websocket, message, frame):
+        recipient_ids = self.chat_recipients(message)
+        if recipient_ids is None:
+            await websocket.send(codec.dumps({"status": "error", "message": "Invalid recipients"}))
+            return
 
-        # Check if the recipient is connected to the current server
-        if recipient_id not in self.clients:
-            await websocket.send(json.dumps({"status": "error", "message": "Recipient not found"}))
+        # Recipients connected to the current server, and the home servers of the rest
+        local_recipients = []
+        home_servers = set()
+        missing = []
+        for recipient_id in recipient_ids:
+            recipient = self.clients.get(recipient_id)
+            if recipient is not None:
+                local_recipients.append(recipient)
+                continue
+
+            home_server = self.client_list.home(recipient_id)
+            if home_server is not None and home_server in self.neighbourhood:
+                home_servers.add(home_server)
+            else:
+                missing.append(recipient_id)
+
+        # Forward the original frame once to each local recipient's outbox and once to each home server
+        self.broadcaster.send(local_recipients, frame)
+        for home_server in home_servers:
+            self.neighbourhood.send(home_server, frame)
+
+        log.debug("Forwarded encrypted message from %s to %d recipient(s).", message['data']['sender'], len(recipient_ids) - len(missing))
+
+        # Store chats for offline recipients until they connect (once for all of them)
+        offline = [recipient_id for recipient_id in missing if is_fingerprint(recipient_id)] if self.offline is not None else []
+        if offline:
+            missing = [recipient_id for recipient_id in missing if not is_fingerprint(recipient_id)]
+            if self.offline.put(offline, frame, message["data"]["sender"]):
+                await websocket.send(codec.dumps({"status": "success", "message": "Recipient offline, message stored", "recipients": offline}))
+            else:
+                await websocket.send(codec.dumps({"status": "error", "message": "Message could not be stored for offline recipients", "recipients": offline}))
+
+        if missing:
+            await websocket.send(codec.dumps({"status": "error", "message": "Recipient not found", "recipients": missing}))
+
+    # Send chats stored for clients that have connected to a neighbourhood server (or another worker)
+    def forward_stored(self, address, client_ids):
+        if self.offline is None or address not in self.neighbourhood:
             return
+        for client_id in client_ids:
+            if client_id in self.offline:
+                # Binary frames can only be carried in a binary message
+                frames = self.offline.take(client_id)
+                encoding = "msgpack" if any(codec.is_binary(frame) for frame in frames) else "json"
+                self.neighbourhood.send(address, codec.dumps({"type": "stored_chats", "recipient": client_id, "frames": frames}, encoding))
+
+    # Full client list message, encoded once per client list version
+    def client_list_frame(self):
+        version, frame = self.client_list_cache
+        if version != self.client_list.version:
+            client_list_req = {
+                "type": "client_list",
+                "list_id": self.client_list.list_id,
+                "version": self.client_list.version,
+                "servers": self.client_list.snapshot()
+            }
+            frame = codec.dumps(client_list_req)
+            self.client_list_cache = (self.client_list.version, frame)
+        return frame
+
+    # Client list changes since a version (servers: list of {address, added PEM strings, removed fingerprints})
+    def client_update_message(self, base_version, servers):
+        return {
+            "type": "client_update",
+            "list_id": self.client_list.list_id,
+            "base_version": base_version,
+            "version": self.client_list.version,
+            "servers": servers
+        }
 
-        # Retrieve recipient websocket and forward the message
-        recipient_ws = self.clients[recipient_id]["websocket"]
-        await recipient_ws.send(json.dumps(message))
-        print(f"Forwarded encrypted message from {message['data']['sender']} to {recipient_id}.")
+    # Send the client list changes since a version to every connected client
+    def push_client_update(self, base_version, exclude=None):
+        if not self.config["push_client_updates"]:
+            return
+
+        servers = self.client_list.changes_since(base_version)
+        if not servers:
+            return
+
+        frame = codec.dumps(self.client_update_message(base_version, servers))
+        recipients = [client for client in self.clients if client.fingerprint != exclude]
+        self.broadcaster.send(recipients, frame)
+
+    # Hello message for neighbourhood servers (signed with this server's key)
+    def server_hello_frame(self):
+        return signed_server_hello(self.server_key, self.address)
+
+    # Full list of this server's clients for neighbourhood servers
+    def local_client_update_frame(self):
+        return codec.dumps({
+            "type": "client_update",
+            "sender": self.address,
+            "seq": self.client_list.seqs.get(self.address, 0),
+            "clients": self.clients.public_key_list()
+        })
+
+    # Send a change to this server's clients to neighbourhood servers
+    def push_local_change(self, added, removed):
+        seq = self.client_list.seqs[self.address]
+        self.neighbourhood.broadcast(codec.dumps({
+            "type": "client_update_delta",
+            "sender": self.address,
+            "base_seq": seq - 1,
+            "seq": seq,
+            "added": added,
+            "removed": removed
+        }))
 
     # Handle client list request
-    async def handle_client_list_request(self, websocket):
-        client_list_req = {
-            "type": "client_list",
-            "servers": [self.client_list]
-        }
-        await websocket.send(json.dumps(client_list_req))
+    @timed("handle_client_list_request")
+    async def handle_client_list_request(self, websocket, message):
+        # Clients that already hold a list (from this server) send its version and only get the changes since then
+        version = message.get("version")
+        if type(version) is int and message.get("list_id") == self.client_list.list_id:
+            servers = self.client_list.changes_since(version)
+            if servers is not None:
+                await websocket.send(codec.dumps(self.client_update_message(version, servers)))
+                return
+
+        await websocket.send(self.client_list_frame())
+
+    # Handle hello from a neighbourhood server (only servers in our neighbourhood
+    # are accepted, and only with a recent hello signed with their key)
+    @timed("handle_server_hello")
+    async def handle_server_hello(self, websocket, message, frame):
+        address = message["data"].get("sender")
+        key = self.server_keys.get(address) if address in self.neighbourhood else None
+        if key is None:
+            await self.reject_server(websocket, "Server is not in the neighbourhood")
+            return
+
+        # The counter is the time the hello was signed (milliseconds), so a recorded hello is soon refused
+        counter = message.get("counter")
+        now = time.time_ns() // 1000000
+        if type(counter) is not int or abs(now - counter) > self.config["server_hello_max_age"] * 1000 or counter <= self.server_hello_counters.get(address, 0):
+            self.metrics.count("rejected.server_hello_counter")
+            await self.reject_server(websocket, "Server hello is too old")
+            return
+
+        verify_key, public_key = key
+        if not await self.validate_signature(websocket, message, frame, verify_key, public_key):
+            await self.reject_server(websocket, "Message has invalid signature")
+            return
+
+        self.server_hello_counters[address] = counter
+        self.server_connections[websocket] = address
+        self.server_websockets[address] = websocket
+        log.info("Neighbourhood server %s connected", address)
+
+    # Turn away a server whose hello is not accepted
+    async def reject_server(self, websocket, reason):
+        log.warning("Server hello from %s rejected: %s", websocket.remote_address, reason)
+        await websocket.send(codec.dumps({"status": "error", "message": reason}))
+        await websocket.close()
+
+    # Handle messages sent by a neighbourhood server
+    async def handle_server_message(self, websocket, message, frame):
+        address = self.server_connections[websocket]
+        message_type = message.get("type", "")
+
+        if message_type == "client_update":
+            self.handle_server_client_update(address, message)
+        elif message_type == "client_update_delta":
+            await self.handle_server_client_update_delta(websocket, address, message)
+        elif message_type == "signed_data":
+            # Already verified by the sender's home server
+            data_type = message["data"]["type"]
+            if data_type == "public_chat":
+                self.broadcaster.send(list(self.clients), frame)
+            elif data_type == "chat":
+                recipients = [self.clients.get(recipient_id) for recipient_id in self.chat_recipients(message) or []]
+                self.broadcaster.send([recipient for recipient in recipients if recipient is not None], frame)
+        elif message_type == "stored_chats":
+            self.handle_stored_chats(message)
+        else:
+            log.info("Unknown message type received from %s: %s", address, message_type)
+
+    # Queue a client's stored chats, marking them delivered once they have been sent
+    # (if the connection is lost first, they stay stored for next time)
+    def send_stored(self, outbox, client_id):
+        frames, position = self.offline.peek(client_id)
+
+        def done(sent):
+            if sent and self.offline is not None:
+                self.offline.mark_delivered(client_id, position)
+
+        outbox.put_stored(frames, done)
+
+    # Chats stored for one of our clients by a neighbourhood server
+    def handle_stored_chats(self, message):
+        recipient_id = message["recipient"]
+        frames = message["frames"]
+
+        # Gone again (now, or before they have been sent), keep them here instead
+        def store(sent=False):
+            if not sent and self.offline is not None:
+                for frame in frames:
+                    self.offline.put([recipient_id], frame)
+
+        recipient = self.clients.get(recipient_id)
+        if recipient is not None:
+            recipient.outbox.put_stored(frames, store)
+        else:
+            store()
+
+    # Replace a neighbourhood server's clients with its full list
+    def handle_server_client_update(self, address, message):
+        base_version = self.client_list.version
+        public_keys = [(self.get_client_id(bytes(public_key, 'utf-8')), public_key) for public_key in message["clients"]]
+        self.client_list.replace(address, public_keys, message["seq"])
+        self.push_client_update(base_version)
+        self.forward_stored(address, [client_id for client_id, _ in public_keys])
+
+    # Apply a change to a neighbourhood server's clients
+    async def handle_server_client_update_delta(self, websocket, address, message):
+        seq = self.client_list.seqs.get(address)
+
+        # Already have this change
+        if seq is not None and message["seq"] <= seq:
+            return
+
+        # Missed a change, ask for the full list
+        if seq is None or message["base_seq"] != seq:
+            await websocket.send(codec.dumps({"type": "client_update_request"}))
+            return
+
+        base_version = self.client_list.version
+        added = [self.get_client_id(bytes(public_key, 'utf-8')) for public_key in message["added"]]
+        for client_id in message["removed"]:
+            self.client_list.remove(address, client_id)
+        for client_id, public_key in zip(added, message["added"]):
+            self.client_list.add(address, client_id, public_key)
+        self.client_list.seqs[address] = message["seq"]
+
+        self.push_client_update(base_version)
+        self.forward_stored(address, added)
 
     # Handle when a client disconnects
     async def handle_disconnection(self, websocket):
-        public_key = ""
+        # Neighbourhood server: forget its clients (unless it has already reconnected)
+        address = self.server_connections.pop(websocket, None)
+        if address is not None:
+            if self.server_websockets.get(address) is websocket:
+                del self.server_websockets[address]
+                base_version = self.client_list.version
+                self.client_list.remove_server(address)
+                self.push_client_update(base_version)
+            return
+
+        # Remove from local clients and client list
+        client = self.clients.remove_websocket(websocket)
+
+        # Stop sending to the client, keep its last counter for resuming, and tell everyone else it has gone
+        if client is not None:
+            client.outbox.close()
+            self.push_client_update(self.client_list.version - 1)
+            self.push_local_change([], [client.fingerprint])
+            if self.tickets is not None:
+                await self.tickets.save_counter(client.fingerprint, client.counter)
+
+    # Server statistics (answer to a stats_request admin message), with the outbox
+    # depths of the top clients with the most queued frames if asked for
+    def stats(self, top=0):
+        return {
+            "type": "stats",
+            "address": self.address,
+            "connections": self.connections,
+            "clients": len(self.clients),
+            "client_list": {"version": self.client_list.version, "clients": len(self.client_list.homes)},
+            "event_loop_lag_ms": round(self.loop_lag.last * 1000, 3),
+            **self.metrics.summary(),
+            "outbox": self.broadcaster.stats(self.clients, top),
+            "neighbourhood": self.neighbourhood.stats(),
+            "key_cache": self.key_cache.stats(),
+            "offline": self.offline.stats() if self.offline is not None else None,
+            "files": self.file_server.stats() if self.file_server is not None else None,
+            "keepalive": self.keepalive.stats() if self.keepalive is not None else None,
+            "verify_scheduler": self.verify_scheduler.stats(),
+            "replay_filter": self.replay_filter.stats() if self.replay_filter is not None else None,
+            "admission": self.admission.stats(),
+            "tickets": self.tickets.stats() if self.tickets is not None else None,
+            "log_records_dropped": self.log_rate_limit.dropped if self.log_rate_limit else 0,
+            "profiling": self.profiler.running(),
+        }
+
+    # Admin messages are only accepted from this machine (or a worker's Unix socket), unless configured otherwise
+    def is_admin(self, websocket):
+        if self.config["admin_allow_remote"]:
+            return True
+        address = websocket.remote_address
+        return not address or address[0] in ("127.0.0.1", "::1", "localhost")
 
-        # Remove from local client list
-        for client in self.clients:
-            if self.clients[client]["websocket"] == websocket:
-                public_key = self.clients[client]["public_key"]
-                del self.clients[client]
-                break
+    # Check a number of rows asked for in an admin message
+    def is_row_count(self, value):
+        return type(value) is int and 0 <= value <= MAX_ADMIN_ROWS
 
-        if public_key in self.client_list["clients"]:
-            self.client_list["clients"].remove(public_key)
+    # Handle stats and profiler requests
+    async def handle_admin_request(self, websocket, message):
+        if not self.is_admin(websocket):
+            await websocket.send(codec.dumps({"status": "error", "message": "Admin messages are only accepted from localhost"}))
+            return
+
+        if message["type"] == "stats_request":
+            top = message.get("top", 0)
+            if not self.is_row_count(top):
+                await websocket.send(codec.dumps({"status": "error", "message": f"'top' must be an integer from 0 to {MAX_ADMIN_ROWS}"}))
+                return
+            await websocket.send(codec.dumps(self.stats(top)))
+            return
+
+        # Profiler: "start" begins sampling, "stop" ends it and returns the most sampled functions
+        action = message.get("action")
+        if action == "start":
+            self.profiler.start()
+            await websocket.send(codec.dumps({"type": "profile", "status": "started", "address": self.address}))
+        elif action == "stop":
+            limit = message.get("limit", 30)
+            if not self.is_row_count(limit):
+                await websocket.send(codec.dumps({"status": "error", "message": f"'limit' must be an integer from 0 to {MAX_ADMIN_ROWS}"}))
+                return
+            report = self.profiler.stop(limit)
+            await websocket.send(codec.dumps({"type": "profile", "status": "stopped", "address": self.address, **report}))
+        else:
+            await websocket.send(codec.dumps({"status": "error", "message": "Profile action must be 'start' or 'stop'"}))
+
+    # Check a frame against its connection's rate limits before it is parsed
+    # Returns False if the frame is to be dropped (with the "reject" policy)
+    async def check_rate_limit(self, websocket, limiter, frame):
+        delay = limiter.take(len(frame))
+        if not delay:
+            return True
+
+        self.metrics.count("rate_limited")
+        if self.config["rate_limit_policy"] == "reject":
+            limiter.refund(len(frame))
+            await websocket.send(codec.dumps({"status": "error", "message": "Rate limit exceeded"}))
+            return False
+
+        # Stop reading from this connection until it is back within its limit
+        # (its frames then queue up in the socket, and the sender is slowed down by TCP)
+        await asyncio.sleep(delay)
+        return True
 
     # Handle WebSocket connection
     async def handle_connection(self, websocket, path):
-        print(f"New connection from: {websocket.remote_address}")
+        self.connections += 1
+        self.metrics.count("connections_opened")
+        log.debug("New connection from: %s", websocket.remote_address)
+
+        limiter = ConnectionLimiter(self.config["rate_limit"], self.config["rate_limit_burst"], self.config["rate_limit_bytes"])
+        if self.keepalive is not None:
+            self.keepalive.add(websocket)
 
         try:
             async for message in websocket:
-                print(f"Received message: {message}")
-                data = json.loads(message)
-                message_type = data.get("type", "")
+                # Neighbourhood servers are not rate limited
+                if websocket not in self.server_connections and not await self.check_rate_limit(websocket, limiter, message):
+                    continue
 
-                if message_type == "signed_data":
-                    await self.handle_signed_data(websocket, data)
+                data = codec.loads(message)
+                message_type = data.get("type", "")
+                self.metrics.count("frames_received")
+                log.debug("Received %s message (%d bytes)", message_type, len(message))
+
+                if websocket in self.server_connections:
+                    await self.handle_server_message(websocket, data, message)
+                elif message_type == "signed_data":
+                    await self.handle_signed_data(websocket, data, message)
+                elif message_type == "resume" and self.check_connection(websocket) is None:
+                    await self.handle_resume(websocket, data)
                 elif message_type == "client_list_request":
-                    await self.handle_client_list_request(websocket)
+                    await self.handle_client_list_request(websocket, data)
+                elif message_type in ADMIN_MESSAGE_TYPES:
+                    await self.handle_admin_request(websocket, data)
                 else:
-                    print(f"Unknown message type received: {data}")
+                    log.info("Unknown message type received: %s", message_type)
+
+                # Let go of the frame and parsed message while waiting for the next one
+                del message, data
 
         except websockets.ConnectionClosed:
-            print(f"Connection closed from: {websocket.remote_address}")
-            if self.check_connection(websocket):
-                await self.handle_disconnection(websocket)
+            log.debug("Connection closed from: %s", websocket.remote_address)
 
         finally:
-            print(f"Cleaning up connection for {websocket.remote_address}")
-            if self.check_connection(websocket):
-                await self.handle_disconnection(websocket)
+            self.connections -= 1
+            self.verify_scheduler.forget(websocket)
+            if self.keepalive is not None:
+                self.keepalive.remove(websocket)
+            await self.handle_disconnection(websocket)
+
+    # websockets' own keepalive settings (off when the coalesced keepalive pings instead)
+    def keepalive_options(self):
+        if self.keepalive is not None:
+            return {"ping_interval": None}
+        return {"ping_interval": self.config["keepalive_interval"], "ping_timeout": self.config["keepalive_timeout"]}
+
+    # permessage-deflate settings for client connections (see "compression" in config.py)
+    def compression_options(self):
+        if not self.config["compression"]:
+            return {"compression": None}
+
+        deflate = ServerPerMessageDeflateFactory(
+            server_max_window_bits=self.config["deflate_window_bits"],
+            client_max_window_bits=self.config["deflate_window_bits"],
+            compress_settings={"level": self.config["deflate_level"], "memLevel": self.config["deflate_mem_level"]}
+        )
+        return {"compression": None, "extensions": [deflate]}
+
+    # Open the store for chats to offline recipients (in this server's or worker's own directory)
+    def open_offline_store(self):
+        if not self.config["offline_dir"]:
+            return None
+
+        name = f"{self.host}-{self.port}"
+        if self.config["workers"]:
+            name += f"-worker{self.config['workers'].index(self.address)}"
+
+        return OfflineStore(
+            os.path.join(self.config["offline_dir"], name),
+            self.config["offline_segment_size"],
+            self.config["offline_max_bytes"],
+            self.config["offline_retention"],
+            self.config["offline_max_per_recipient"],
+            self.config["offline_max_bytes_per_sender"]
+        )
+
+    # Load this server's key and the keys of the servers it links to (workers share this server's key)
+    def load_server_keys(self):
+        self.server_key = load_server_key(self.config["server_key_file"])
+        self.server_keys = load_server_public_keys(self.config["neighbourhood_keys"])
+        for address in self.config["workers"]:
+            self.server_keys[address] = (self.server_key.public_key(), public_key_pem(self.server_key))
+
+        for address in self.neighbourhood.links:
+            if address not in self.server_keys:
+                log.warning("No key for neighbourhood server %s, its links will not be accepted", address)
 
     # Run server
     async def run(self):
-        async with websockets.serve(self.handle_connection, self.host, self.port, ping_interval=20, ping_timeout=100):
-            print("Server running on", self.uri)
-            await asyncio.get_running_loop().create_future()
-
+        # Workers share the port (the kernel spreads new connections between them)
+        reuse_port = bool(self.config["workers"])
+
+        self.log_listener, self.log_rate_limit = setup_logging(self.config["log_level"], self.config["log_rate_limit"])
+        self.loop_lag.start()
+        if self.keepalive is not None:
+            self.keepalive.start()
+        self.offline = self.open_offline_store()
+        if self.config["ticket_lifetime"]:
+            self.tickets = TicketBook(
+                load_ticket_key(self.config["ticket_key_file"]),
+                self.config["ticket_lifetime"],
+                self.config["ticket_store_file"],
+                self.config["ticket_save_interval"]
+            )
+            self.tickets.start()
+        if self.neighbourhood.links:
+            self.load_server_keys()
+
+        if self.file_port:
+            # Upload tokens are signed with the ticket key, so every worker accepts them
+            self.file_server = FileServer(
+                self.config["file_dir"],
+                load_ticket_key(self.config["ticket_key_file"]),
+                self.config["max_file_size"],
+                self.config["max_files_size"],
+                self.config["file_read_timeout"]
+            )
 
-if __name__ == "__main__":
-    # Default port (if no port is specified)
-    port = 8765
+        try:
+            if self.file_server is not None:
+                await self.file_server.start(self.host, self.file_port, reuse_port)
+                log.info("File uploads on http://%s:%d/api/upload", self.host, self.file_port)
+
+            # Frames over max_size close the connection, at most max_queue received
+            # frames are buffered per connection before reading stops, and the read
+            # and write buffers are bounded by read_limit and write_limit
+            limits = {
+                "max_size": self.config["max_frame_size"],
+                "max_queue": self.config["inbound_queue_size"],
+                "read_limit": self.config["read_buffer_size"],
+                "write_limit": self.config["write_buffer_size"],
+            }
+
+            async with websockets.serve(self.handle_connection, self.host, self.port, reuse_port=reuse_port, backlog=self.config["listen_backlog"], **limits, **self.keepalive_options(), **self.compression_options()):
+                log.info("Server running on %s", self.address)
+
+                if self.address.startswith("unix:"):
+                    # Other workers connect on a local socket
+                    async with websockets.unix_serve(self.handle_connection, self.address[len("unix:"):], max_size=None):
+                        self.neighbourhood.start()
+                        await asyncio.get_running_loop().create_future()
+                else:
+                    self.neighbourhood.start()
+                    await asyncio.get_running_loop().create_future()
+        finally:
+            await self.neighbourhood.stop()
+            if self.file_server is not None:
+                await self.file_server.stop()
+            self.verification_pool.close()
+            self.loop_lag.stop()
+            if self.keepalive is not None:
+                self.keepalive.stop()
+            self.profiler.stop()
+            self.log_listener.stop()
+            if self.offline is not None:
+                self.offline.close()
+            if self.tickets is not None:
+                # Clients still connected are cut off by the shutdown, so save their counters now
+                for client in self.clients:
+                    self.tickets.update_counter(client.fingerprint, client.counter)
+                await self.tickets.close()
 
-    # Get port from command line
-    if len(sys.argv) > 1:
-        port = sys.argv[1]
 
-    server = Server("localhost", port)
-    asyncio.run(server.run())
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OLAF Neighbourhood server")
+    parser.add_argument("port", nargs="?", type=int, default=8765, help="port to listen on (default 8765)")
+    parser.add_argument("neighbourhood", nargs="*", help="addresses of the other servers in the neighbourhood")
+    parser.add_argument("--server-key", help="this server's private key file, signing its hello to other servers (default server.key, created if missing)")
+    parser.add_argument("--neighbour-key", action="append", default=[], metavar="ADDRESS=FILE", help="public key file of a neighbourhood server (once per server)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes sharing the port")
+    parser.add_argument("--files", action="store_true", help="accept file uploads and downloads (on port + 1000)")
+    parser.add_argument("--file-port", type=int, help="port for file uploads and downloads (turns them on)")
+    parser.add_argument("--rate-limit", type=float, help="messages/s allowed per connection (0 for no limit)")
+    parser.add_argument("--high-density", action="store_true", help="use less memory per connection, for many mostly idle clients")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"), help="log level (DEBUG logs every message received)")
+    args = parser.parse_args()
+
+    config = {"neighbourhood": args.neighbourhood, "log_level": args.log_level}
+    if args.high_density:
+        config.update(HIGH_DENSITY_CONFIG)
+    if args.files:
+        config["file_port"] = None
+    if args.file_port is not None:
+        config["file_port"] = args.file_port
+    if args.rate_limit is not None:
+        config["rate_limit"] = args.rate_limit
+    if args.server_key is not None:
+        config["server_key_file"] = args.server_key
+    config["neighbourhood_keys"] = {}
+    for entry in args.neighbour_key:
+        address, separator, path = entry.partition("=")
+        if not separator:
+            parser.error(f"--neighbour-key needs ADDRESS=FILE: {entry}")
+        config["neighbourhood_keys"][address] = path
+
+    if args.workers > 1:
+        if args.neighbourhood:
+            parser.error("--workers cannot be combined with neighbourhood servers")
+        run_workers(Server, "localhost", args.port, config, args.workers)
+    else:
+        server = Server("localhost", args.port, config)
+        asyncio.run(server.run())
\ No newline at end of file
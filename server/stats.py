@@ -0,0 +1,60 @@
+# Print a running server's statistics, or profile it for a while
+#
+# Usage:
+#   python3 stats.py [host:port]                 statistics as JSON
+#   python3 stats.py [host:port] --top 20        ...with the 20 deepest client outboxes
+#   python3 stats.py [host:port] --profile 10    sample the server for 10 seconds
+#
+# Only works from the server's own machine (unless it allows remote admin
+# messages). With --workers each connection reaches one worker, so the
+# statistics are for whichever worker accepted the connection.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+import websockets
+
+# Shared modules (message codec) are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import codec
+
+
+async def request(websocket, message):
+    await websocket.send(codec.dumps(message))
+    reply = codec.loads(await websocket.recv())
+    if reply.get("status") == "error":
+        raise SystemExit(reply["message"])
+    return reply
+
+
+def print_profile(report):
+    print(f"{report['samples']} samples every {report['interval_ms']} ms from {report['address']}")
+    for title, rows in (("Self", report["self"]), ("Cumulative", report["cumulative"])):
+        print(f"\n{title}:")
+        for name, count, percent in rows:
+            print(f"{percent:>6.1f}% {count:>7}  {name}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="OLAF Neighbourhood server statistics")
+    parser.add_argument("server", nargs="?", default="localhost:8765", help="address (host:port) of the server (default localhost:8765)")
+    parser.add_argument("--profile", type=float, metavar="SECONDS", help="run the sampling profiler for this many seconds")
+    parser.add_argument("--limit", type=int, default=30, help="functions to show in the profile (default 30)")
+    parser.add_argument("--top", type=int, default=0, metavar="N", help="also show the outbox depth of the N clients with the most queued frames")
+    args = parser.parse_args()
+
+    async with websockets.connect("ws://" + args.server, max_size=None) as websocket:
+        if args.profile:
+            await request(websocket, {"type": "profile_request", "action": "start"})
+            await asyncio.sleep(args.profile)
+            print_profile(await request(websocket, {"type": "profile_request", "action": "stop", "limit": args.limit}))
+        else:
+            print(json.dumps(await request(websocket, {"type": "stats_request", "top": args.top}), indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
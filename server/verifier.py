@@ -0,0 +1,166 @@
+# Signature verification helpers for the server
+
+import asyncio
+import concurrent.futures
+import functools
+from collections import OrderedDict
+
+import cryptography.exceptions
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+# Default number of parsed public keys to keep across reconnects
+KEY_CACHE_SIZE = 4096
+
+
+# Bounded LRU of parsed public keys, keyed by client fingerprint
+class KeyCache:
+    def __init__(self, max_size=KEY_CACHE_SIZE):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+
+        # Counters (to confirm the cache is doing its job)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Get the parsed key for a fingerprint, parsing the PEM only on a miss
+    def get(self, fingerprint, public_key: bytes):
+        key = self.keys.get(fingerprint)
+        if key is not None:
+            self.hits += 1
+            self.keys.move_to_end(fingerprint)
+            return key
+
+        self.misses += 1
+
+        # Raises ValueError if the PEM is not a valid public key
+        key = serialization.load_pem_public_key(public_key)
+
+        self.keys[fingerprint] = key
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+
+        return key
+
+    def stats(self):
+        return {"size": len(self.keys), "hits": self.hits, "misses": self.misses}
+
+
+# Parse a PEM public key inside a process pool worker (cached per worker process)
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def load_worker_key(public_key: str):
+    return serialization.load_pem_public_key(public_key.encode('utf-8'))
+
+
+# Verify a single RSA-PSS signature (key is a parsed key, or a PEM string in a process worker)
+def verify_signature(key, signature: bytes, data: bytes):
+    if isinstance(key, str):
+        key = load_worker_key(key)
+
+    try:
+        key.verify(
+            signature,
+            data,
+            padding.PSS(
+                mgf=padding.MGF1(hashes.SHA256()),
+                salt_length=padding.PSS.MAX_LENGTH
+            ),
+            hashes.SHA256()
+            )
+        return True
+    except cryptography.exceptions.InvalidSignature:
+        return False
+
+
+# Verify a batch of (key, signature, data) jobs in one worker call
+def verify_batch(jobs):
+    return [verify_signature(key, signature, data) for key, signature, data in jobs]
+
+
+# Runs signature verification off the event loop
+#
+# Requests made in the same event loop iteration are grouped into batches of up
+# to batch_size and sent to the executor together. Each caller awaits its own
+# result, so a connection that awaits verification before reading its next
+# message keeps its messages (and counter checks) in order.
+class VerificationPool:
+    def __init__(self, mode="thread", workers=None, batch_size=32):
+        if mode not in ("inline", "thread", "process"):
+            raise ValueError(f"Unknown verification mode: {mode}")
+
+        self.mode = mode
+        self.batch_size = batch_size
+
+        # Pending (job, future) pairs waiting to be sent to a worker
+        self.pending = []
+        self.flush_scheduled = False
+
+        if mode == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify")
+        elif mode == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = None
+
+    # Verify a signature, returning True if it is authentic
+    async def verify(self, verify_key, public_key: str, signature: bytes, data: bytes):
+        if self.executor is None:
+            return verify_signature(verify_key, signature, data)
+
+        # Parsed keys cannot be pickled, so process workers get the PEM instead
+        key = public_key if self.mode == "process" else verify_key
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(((key, signature, data), future))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            loop.call_soon(self.flush)
+
+        return await future
+
+    # Send all pending jobs to the executor in batches
+    def flush(self):
+        self.flush_scheduled = False
+        if not self.pending:
+            return
+
+        loop = asyncio.get_running_loop()
+        pending, self.pending = self.pending, []
+
+        for i in range(0, len(pending), self.batch_size):
+            batch = pending[i:i + self.batch_size]
+            jobs = [job for job, _ in batch]
+            futures = [future for _, future in batch]
+
+            result = loop.run_in_executor(self.executor, verify_batch, jobs)
+            result.add_done_callback(functools.partial(self.resolve, futures))
+
+    # Hand batch results back to the waiting callers
+    @staticmethod
+    def resolve(futures, result):
+        if result.cancelled():
+            for future in futures:
+                future.cancel()
+            return
+
+        error = result.exception()
+        for i, future in enumerate(futures):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result.result()[i])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,60 @@
+# Multi-process server mode
+#
+# Starts several worker processes that all listen on the same port
+# (SO_REUSEPORT, so the kernel spreads new connections between them). Each
+# worker owns its own connections and links to the other workers over Unix
+# sockets in a private directory, using the same links as neighbourhood
+# servers. Workers share their client lists over these links, which gives every
+# worker a directory of fingerprint -> worker for routing chats and public chats
+# to clients connected to a different worker.
+
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+
+# Internal address of a worker (its Unix socket)
+def worker_address(ipc_dir, index):
+    return "unix:" + os.path.join(ipc_dir, f"worker-{index}.sock")
+
+
+# Entry point of a worker process
+def run_worker(server_class, host, port, config):
+    server = server_class(host, port, config)
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
+
+
+# Start the worker processes and wait for them to exit
+def run_workers(server_class, host, port, config, count):
+    ipc_dir = tempfile.mkdtemp(prefix="olaf-workers-")
+    addresses = [worker_address(ipc_dir, i) for i in range(count)]
+
+    processes = []
+    for address in addresses:
+        worker_config = dict(config, worker_address=address, workers=addresses)
+        process = multiprocessing.Process(target=run_worker, args=(server_class, host, port, worker_config), daemon=True)
+        process.start()
+        processes.append(process)
+
+    print(f"Started {count} workers on port {port}")
+
+    # Stop the workers too when the server is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
@@ -0,0 +1,140 @@
+# Tests for the codec's signed data span finder
+#
+# Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import codec
+
+
+def sign(data):
+    return b"signature"
+
+
+class FindValueSpanTest(unittest.TestCase):
+    # The span is the exact data text of a signed frame
+    def test_signed_frame(self):
+        data = {"type": "public_chat", "sender": "a", "message": 'text with "quotes", {braces} and \\ "data": {}'}
+        frame = codec.encode_signed_data(data, 7, sign)
+        start, end = codec.find_value_span(frame, "data")
+        self.assertEqual(frame[start:end], json.dumps(data))
+
+    # Keys inside nested objects and inside strings are not top-level keys
+    def test_nested_keys(self):
+        frame = '{"type": "signed_data", "other": {"data": [1]}, "note": "\\"data\\": {}", "data": {"data": {}}}'
+        start, end = codec.find_value_span(frame, "data")
+        self.assertEqual(frame[start:end], '{"data": {}}')
+
+    def test_missing_key(self):
+        self.assertIsNone(codec.find_value_span('{"type": "signed_data", "counter": 1}', "data"))
+
+    def test_not_an_object(self):
+        self.assertIsNone(codec.find_value_span('{"type": "signed_data", "data": "text"}', "data"))
+
+    def test_array(self):
+        frame = '{"data" : [1, {"a": "]"}], "counter": 1}'
+        start, end = codec.find_value_span(frame, "data")
+        self.assertEqual(frame[start:end], '[1, {"a": "]"}]')
+
+    # Parsers keep the last duplicate key, so a second one must not go unnoticed
+    def test_duplicate_key(self):
+        frame = codec.encode_signed_data({"type": "public_chat", "message": "a"}, 1, sign)
+        forged = frame[:-1] + ', "data": {"type": "public_chat", "message": "b"}}'
+        self.assertEqual(json.loads(forged)["data"]["message"], "b")
+        with self.assertRaises(ValueError):
+            codec.find_value_span(forged, "data")
+
+    def test_duplicate_key_not_an_object(self):
+        with self.assertRaises(ValueError):
+            codec.find_value_span('{"data": "text", "data": {"type": "hello"}}', "data")
+        with self.assertRaises(ValueError):
+            codec.find_value_span('{"data": {"type": "hello"}, "data": 1}', "data")
+
+    def test_escaped_duplicate_key(self):
+        frame = codec.encode_signed_data({"type": "public_chat", "message": "a"}, 1, sign)
+        for key in ('"\\u0064ata"', '"d\\u0061t\\u0061"', '"\\u0064\\u0061\\u0074\\u0061"'):
+            forged = frame[:-1] + ', ' + key + ': {"type": "public_chat", "message": "b"}}'
+            self.assertEqual(json.loads(forged)["data"]["message"], "b")
+            with self.assertRaises(ValueError):
+                codec.find_value_span(forged, "data")
+
+    # An escaped key on its own is found (it is the key the parser sees)
+    def test_escaped_key(self):
+        frame = '{"type": "signed_data", "\\u0064ata": {"type": "hello"}, "counter": 1}'
+        start, end = codec.find_value_span(frame, "data")
+        self.assertEqual(frame[start:end], '{"type": "hello"}')
+
+    # Keys that only look like "data" once escapes are decoded wrongly are other keys
+    def test_other_escaped_keys(self):
+        frame = '{"data\\n": {"a": 1}, "dat\\\\a": {"b": 2}, "data": {"c": 3}}'
+        start, end = codec.find_value_span(frame, "data")
+        self.assertEqual(frame[start:end], '{"c": 3}')
+
+
+# The same, with the scan used for large frames
+class LargeFrameFindValueSpanTest(FindValueSpanTest):
+    def setUp(self):
+        small_frame = codec.SMALL_FRAME
+        codec.SMALL_FRAME = 0
+        self.addCleanup(setattr, codec, "SMALL_FRAME", small_frame)
+
+    def test_large_frame(self):
+        data = {"type": "public_chat", "message": "x" * 5000 + '"]}', "nested": [{"a": ["{"]}, "\\"]}
+        frame = codec.encode_signed_data(data, 7, sign)
+        start, end = codec.find_value_span(frame, "data")
+        self.assertEqual(frame[start:end], json.dumps(data))
+
+
+class SignedBytesTest(unittest.TestCase):
+    def test_signed_bytes(self):
+        data = {"type": "public_chat", "sender": "a", "message": "hello"}
+        frame = codec.encode_signed_data(data, 12, sign)
+        self.assertEqual(codec.signed_bytes(frame, codec.loads(frame)), bytes(json.dumps(data) + "12", 'utf-8'))
+
+    # Small frames with "data" written once give the same bytes as the member walk
+    def test_small_frame(self):
+        frames = (
+            '{"type": "signed_data", "data": {"type": "hello"}, "counter": 3}',
+            '{"counter":3,"data" :\t[1, {"data": 2}]}',
+            '{"type": "signed_data", "data": {"message": "\\"data\\""}, "counter": 3}',
+        )
+        for frame in frames:
+            span = codec.find_value_span(frame, "data")
+            expected = bytes(frame[span[0]:span[1]] + "3", 'utf-8')
+            self.assertEqual(codec.signed_bytes(frame, json.loads(frame)), expected)
+
+    # Frames that are not a JSON object of members are rejected
+    def test_invalid_frames(self):
+        for frame in ('{"data": {"a": 1}', '{"data" {"a": 1}}', '{"data": {"a": 1} "counter": 1}', '{1: {}}', '{"data": {"a": }}'):
+            with self.assertRaises(ValueError):
+                codec.signed_bytes(frame, {"data": {"a": 1}, "counter": 1})
+
+    def test_duplicate_data(self):
+        frame = codec.encode_signed_data({"type": "public_chat", "message": "a"}, 1, sign)
+        for key in ('"data"', '"\\u0064ata"'):
+            forged = frame[:-1] + ', ' + key + ': {"type": "public_chat", "message": "b"}}'
+            with self.assertRaises(ValueError):
+                codec.signed_bytes(forged, codec.loads(forged))
+            with self.assertRaises(ValueError):
+                codec.signed_bytes(forged.encode('utf-8'), codec.loads(forged))
+
+    # Binary frames must carry the data packed as a byte string
+    @unittest.skipIf(codec.msgpack is None, "msgpack is not installed")
+    def test_binary_data_not_bytes(self):
+        data = {"type": "public_chat", "sender": "a", "message": "hello"}
+        frame = codec.encode_signed_data(data, 3, sign, "msgpack")
+        self.assertEqual(codec.signed_bytes(frame, codec.loads(frame)), codec.msgpack.packb(data) + b"3")
+
+        for value in (data, "text", None):
+            forged = codec.msgpack.packb({"type": "signed_data", "data": value, "counter": 3, "signature": b"signature"})
+            with self.assertRaises(ValueError):
+                codec.signed_bytes(forged, codec.loads(forged))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+# Tests for the file server's upload tokens, storage limit and request parsing
+#
+# Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from files import FileServer, check_token, issue_token, token_mac
+
+KEY = b"k" * 32
+CLIENT_ID = "a" * 64
+
+
+class TokenTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(check_token(KEY, issue_token(KEY, CLIENT_ID, 60)), CLIENT_ID)
+
+    def test_expired(self):
+        self.assertIsNone(check_token(KEY, issue_token(KEY, CLIENT_ID, -1)))
+
+    def test_other_key(self):
+        self.assertIsNone(check_token(b"x" * 32, issue_token(KEY, CLIENT_ID, 60)))
+
+    def test_tampered(self):
+        token = issue_token(KEY, CLIENT_ID, 60)
+        payload, _, mac = token.rpartition(".")
+        client_id, _, expires = payload.partition(".")
+        for forged in (f"{client_id}.{int(expires) + 3600}.{mac}", f"{'b' * 64}.{expires}.{mac}", token[:-1], "", "."):
+            self.assertIsNone(check_token(KEY, forged))
+
+    # A MAC over a payload without a valid expiry time is not enough
+    def test_bad_expiry(self):
+        for payload in (CLIENT_ID, f"{CLIENT_ID}.soon", f"{CLIENT_ID}.-1"):
+            self.assertIsNone(check_token(KEY, f"{payload}.{token_mac(KEY, payload)}"))
+
+
+class FileServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = FileServer(self.directory.name, KEY, max_file_size=1000, max_total_size=2500, read_timeout=0.5)
+        await self.server.start("127.0.0.1", 0)
+        self.port = self.server.server.sockets[0].getsockname()[1]
+        self.token = issue_token(KEY, CLIENT_ID, 60)
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+        self.directory.cleanup()
+
+    # Send a raw request, returning the status code and the JSON body
+    async def request(self, head, body=b"", token=None, close=True):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        if token is not None:
+            head += f"Authorization: Bearer {token}\r\n"
+        writer.write(head.encode('latin-1') + b"\r\n" + body)
+        if close:
+            writer.write_eof()
+        reply = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+
+        status_line, _, rest = reply.partition(b"\r\n")
+        payload = rest.partition(b"\r\n\r\n")[2]
+        return int(status_line.split(b" ")[1]), json.loads(payload) if payload else None
+
+    async def upload(self, body, token=None):
+        head = f"POST /api/upload HTTP/1.1\r\nHost: files\r\nContent-Length: {len(body)}\r\n"
+        return await self.request(head, body, self.token if token is None else token)
+
+    async def test_upload_and_download(self):
+        status, reply = await self.upload(b"hello")
+        self.assertEqual(status, 200)
+        digest = hashlib.sha256(b"hello").hexdigest()
+        self.assertEqual(reply["file_url"], f"http://files/api/files/{digest}")
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(f"GET /api/files/{digest} HTTP/1.1\r\n\r\n".encode('latin-1'))
+        reply = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        self.assertTrue(reply.startswith(b"HTTP/1.1 200"))
+        self.assertTrue(reply.endswith(b"\r\n\r\nhello"))
+
+    async def test_missing_token(self):
+        status, _ = await self.request("POST /api/upload HTTP/1.1\r\nContent-Length: 5\r\n", b"hello")
+        self.assertEqual(status, 401)
+
+    async def test_bad_token(self):
+        for token in ("nonsense", issue_token(b"x" * 32, CLIENT_ID, 60), self.token[:-1] + ("1" if self.token.endswith("0") else "0")):
+            status, _ = await self.upload(b"hello", token)
+            self.assertEqual(status, 401)
+
+    async def test_expired_token(self):
+        status, _ = await self.upload(b"hello", issue_token(KEY, CLIENT_ID, -1))
+        self.assertEqual(status, 401)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    async def test_wrong_scheme(self):
+        head = f"POST /api/upload HTTP/1.1\r\nContent-Length: 5\r\nAuthorization: Basic {self.token}\r\n"
+        status, _ = await self.request(head, b"hello")
+        self.assertEqual(status, 401)
+
+    # All files together are kept under max_total_size
+    async def test_storage_limit(self):
+        for i in range(2):
+            status, _ = await self.upload(bytes([i]) * 1000)
+            self.assertEqual(status, 200)
+
+        # Content-Length known up front
+        status, _ = await self.upload(b"x" * 1000)
+        self.assertEqual(status, 507)
+
+        # Chunked: stopped once it goes over
+        head = "POST /api/upload HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+        body = b"".join(b"c8\r\n" + b"y" * 200 + b"\r\n" for _ in range(4)) + b"0\r\n\r\n"
+        status, _ = await self.request(head, body, self.token)
+        self.assertEqual(status, 507)
+
+        # Still room for a small file
+        status, _ = await self.upload(b"z" * 400)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.server.stats()["rejected"], 2)
+        self.assertEqual(sorted(name for name in os.listdir(self.directory.name) if name.startswith(".")), [])
+
+    async def test_chunked(self):
+        head = "POST /api/upload HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+        status, reply = await self.request(head, b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nTrailer: x\r\n\r\n", self.token)
+        self.assertEqual(status, 200)
+        self.assertTrue(reply["file_url"].endswith(hashlib.sha256(b"hello world").hexdigest()))
+
+    async def test_invalid_chunk_size(self):
+        head = "POST /api/upload HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+        for size in (b"-5", b"+5", b"0x5", b"5_0", b"zz", b"", b"1" * 17):
+            status, _ = await self.request(head, size + b"\r\n\r\n0\r\n\r\n", self.token)
+            self.assertEqual(status, 400, size)
+
+    # A request that stops sending is closed after read_timeout
+    async def test_stalled_upload(self):
+        start = time.monotonic()
+        head = f"POST /api/upload HTTP/1.1\r\nContent-Length: 100\r\nAuthorization: Bearer {self.token}\r\n"
+        status, _ = await self.request(head, b"x" * 10, close=False)
+        self.assertEqual(status, 408)
+        self.assertLess(time.monotonic() - start, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
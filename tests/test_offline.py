@@ -0,0 +1,201 @@
+# Tests for the offline chat store (segment log and the index rebuilt from it)
+#
+# Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import offline
+from offline import OfflineStore
+
+ALICE = "a" * 64
+BOB = "b" * 64
+CAROL = "c" * 64
+SENDER = "d" * 64
+
+SEGMENT_SIZE = 4096
+
+
+def frame(i):
+    return f'{{"type": "signed_data", "data": {{"type": "chat", "message": "chat {i}"}}, "counter": {i}}}'
+
+
+class OfflineStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.directory.cleanup()
+
+    def open(self, **options):
+        store = OfflineStore(self.directory.name, segment_size=SEGMENT_SIZE, **options)
+        self.stores.append(store)
+        return store
+
+    # Close a store and open it again (the index is rebuilt from the log)
+    def reopen(self, store, **options):
+        store.close()
+        self.stores.remove(store)
+        return self.open(**options)
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.directory.name) if name.endswith(".log"))
+
+    def test_take(self):
+        store = self.open()
+        self.assertTrue(store.put([ALICE], frame(1)))
+        self.assertTrue(store.put([ALICE], frame(2).encode('utf-8') + b"\x00"))
+        self.assertIn(ALICE, store)
+
+        self.assertEqual(store.take(ALICE), [frame(1), frame(2).encode('utf-8') + b"\x00"])
+        self.assertNotIn(ALICE, store)
+        self.assertEqual(store.take(ALICE), [])
+        self.assertEqual(store.stats()["delivered"], 2)
+
+    def test_not_client_ids(self):
+        store = self.open()
+        for recipients in ([], ["public"], [ALICE, "A" * 64], [ALICE[:-1]]):
+            self.assertFalse(store.put(recipients, frame(1)))
+        self.assertEqual(store.stats()["appended"], 0)
+
+    # A group chat is stored once and delivered to each recipient on its own
+    def test_group_chat(self):
+        store = self.open()
+        self.assertTrue(store.put([ALICE, BOB, ALICE], frame(1), SENDER))
+        self.assertEqual(store.stats()["appended"], 1)
+        self.assertEqual(store.stats()["stored"], 2)
+
+        self.assertEqual(store.take(ALICE), [frame(1)])
+        self.assertEqual(store.sender_bytes.keys(), {SENDER})
+        self.assertEqual(store.take(BOB), [frame(1)])
+        self.assertEqual(store.sender_bytes, {})
+
+    # Chats are only marked delivered up to what was sent
+    def test_peek_and_mark_delivered(self):
+        store = self.open()
+        store.put([ALICE], frame(1))
+        frames, position = store.peek(ALICE)
+        self.assertEqual(frames, [frame(1)])
+
+        store.put([ALICE], frame(2))
+        store.mark_delivered(ALICE, position)
+        self.assertEqual(store.peek(ALICE)[0], [frame(2)])
+
+        store = self.reopen(store)
+        self.assertEqual(store.peek(ALICE)[0], [frame(2)])
+
+    # Stored and delivered records are replayed when the store is opened again
+    def test_rebuild(self):
+        store = self.open()
+        store.put([ALICE, BOB], frame(1), SENDER)
+        store.put([BOB], frame(2), SENDER)
+        store.put([CAROL], frame(3).encode('utf-8'))
+        store.take(ALICE)
+        sender_bytes = dict(store.sender_bytes)
+
+        store = self.reopen(store)
+        self.assertNotIn(ALICE, store)
+        self.assertEqual(store.peek(BOB)[0], [frame(1), frame(2)])
+        self.assertEqual(store.peek(CAROL)[0], [frame(3).encode('utf-8')])
+        self.assertEqual(store.sender_bytes, sender_bytes)
+        self.assertEqual(store.stats()["stored"], 3)
+
+        # New chats go after the old ones
+        store.put([BOB], frame(4))
+        self.assertEqual(store.take(BOB), [frame(1), frame(2), frame(4)])
+        store = self.reopen(store)
+        self.assertNotIn(BOB, store)
+        self.assertEqual(store.sender_bytes, {})
+
+    # Each recipient keeps only its newest chats
+    def test_max_per_recipient(self):
+        store = self.open(max_per_recipient=3)
+        for i in range(5):
+            store.put([ALICE], frame(i))
+        self.assertEqual(store.peek(ALICE)[0], [frame(2), frame(3), frame(4)])
+        self.assertEqual(store.stats()["dropped"], 2)
+
+        store = self.reopen(store, max_per_recipient=3)
+        self.assertEqual(store.peek(ALICE)[0], [frame(2), frame(3), frame(4)])
+
+    # A sender can only have so many bytes waiting, and can store again once they are delivered
+    def test_max_bytes_per_sender(self):
+        store = self.open(max_bytes_per_sender=500)
+        stored = 0
+        while store.put([ALICE], frame(stored), SENDER):
+            stored += 1
+        self.assertGreater(stored, 0)
+        self.assertEqual(store.stats()["rejected"], 1)
+        self.assertLessEqual(store.sender_bytes[SENDER], 500)
+
+        # Other senders are not affected
+        self.assertTrue(store.put([ALICE], frame(0), CAROL))
+
+        store.take(ALICE)
+        self.assertTrue(store.put([BOB], frame(0), SENDER))
+
+    # Segments older than the retention time are deleted with their chats
+    def test_expired_segments(self):
+        store = self.open(retention=60)
+        store.put([ALICE], frame(1))
+        self.assertEqual(self.segment_files(), ["00000000.log"])
+
+        store.truncate(time.time() + 120)
+        self.assertNotIn(ALICE, store)
+        self.assertEqual(store.stats()["expired"], 1)
+        self.assertEqual(self.segment_files(), ["00000001.log"])
+
+        store = self.reopen(store, retention=60)
+        self.assertNotIn(ALICE, store)
+
+    # The oldest segments are dropped when the log is over its size limit
+    def test_max_bytes(self):
+        store = self.open(max_bytes=2 * SEGMENT_SIZE)
+        for i in range(100):
+            store.put([ALICE], frame(i))
+        self.assertLessEqual(len(self.segment_files()), 3)
+        self.assertGreater(store.stats()["dropped"], 0)
+
+        frames = store.peek(ALICE)[0]
+        self.assertEqual(frames[-1], frame(99))
+        self.assertEqual(len(frames) + store.stats()["dropped"], 100)
+
+    # Segments whose chats have all been delivered are deleted
+    def test_delivered_segments(self):
+        store = self.open()
+        for i in range(100):
+            store.put([ALICE], frame(i))
+        self.assertGreater(len(self.segment_files()), 1)
+
+        store.take(ALICE)
+        self.assertEqual(len(self.segment_files()), 1)
+
+    # A record cut short by a crash (its header is written last) ends the log
+    def test_torn_record(self):
+        store = self.open()
+        store.put([ALICE], frame(1))
+        segment = store.current()
+        end = segment.end
+        torn = offline.RECORD_HEADER.size + 64 + len(frame(2))
+        segment.map[end + offline.RECORD_HEADER.size:end + torn] = os.urandom(torn - offline.RECORD_HEADER.size)
+
+        store = self.reopen(store)
+        self.assertEqual(store.peek(ALICE)[0], [frame(1)])
+        self.assertEqual(store.current().end, end)
+
+        # Overwritten by the next record
+        store.put([ALICE], frame(3))
+        store = self.reopen(store)
+        self.assertEqual(store.peek(ALICE)[0], [frame(1), frame(3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
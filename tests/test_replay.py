@@ -0,0 +1,113 @@
+# Tests for the replay filter's two generations of recently verified signatures
+#
+# Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+
+import base64
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import replay
+from replay import ReplayFilter
+
+WINDOW = 600
+
+
+def signature(i):
+    return base64.b64encode(i.to_bytes(4, "big") * 64).decode('ascii')
+
+
+class ReplayFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(replay.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_seen(self):
+        replays = ReplayFilter(WINDOW, 100)
+        self.assertFalse(replays.seen(signature(1)))
+        replays.add(signature(1))
+        self.assertTrue(replays.seen(signature(1)))
+        self.assertFalse(replays.seen(signature(2)))
+        self.assertEqual(replays.stats()["duplicates"], 1)
+
+    # Binary frames carry the signature as bytes; anything else is never a duplicate
+    def test_signature_types(self):
+        replays = ReplayFilter(WINDOW, 100)
+        raw = bytes(range(256))
+        replays.add(raw)
+        self.assertTrue(replays.seen(raw))
+        for value in (None, 5, ["a"]):
+            self.assertFalse(replays.seen(value))
+
+    # Only the start of a signature is kept
+    def test_prefix(self):
+        replays = ReplayFilter(WINDOW, 100)
+        replays.add("x" * replay.SIGNATURE_PREFIX + "a")
+        self.assertTrue(replays.seen("x" * replay.SIGNATURE_PREFIX + "b"))
+
+    # A signature moves to the previous generation after a window, and is forgotten after the next
+    def test_generations(self):
+        replays = ReplayFilter(WINDOW, 100)
+        replays.add(signature(1))
+
+        self.now += WINDOW - 1
+        self.assertTrue(replays.seen(signature(1)))
+        self.assertEqual(replays.stats()["rotations"], 0)
+
+        self.now += 2
+        replays.add(signature(2))
+        self.assertEqual(replays.stats()["rotations"], 1)
+        self.assertTrue(replays.seen(signature(1)))
+        self.assertTrue(replays.seen(signature(2)))
+
+        self.now += WINDOW + 1
+        self.assertFalse(replays.seen(signature(1)))
+        self.assertTrue(replays.seen(signature(2)))
+        self.assertEqual(replays.stats()["rotations"], 2)
+
+        self.now += WINDOW + 1
+        self.assertFalse(replays.seen(signature(2)))
+        self.assertEqual(len(replays), 0)
+
+    # After more than two idle windows, both generations are dropped at once
+    def test_idle(self):
+        replays = ReplayFilter(WINDOW, 100)
+        replays.add(signature(1))
+        self.now += 2 * WINDOW + 1
+        self.assertFalse(replays.seen(signature(1)))
+        self.assertEqual(len(replays), 0)
+
+    # A full generation rotates early (so memory stays bounded), keeping the one before
+    def test_max_size(self):
+        replays = ReplayFilter(WINDOW, 4)
+        for i in range(3):
+            replays.add(signature(i))
+        self.assertEqual(replays.stats()["rotations"], 1)
+        self.assertTrue(all(replays.seen(signature(i)) for i in range(3)))
+
+        for i in range(3, 5):
+            replays.add(signature(i))
+        self.assertFalse(replays.seen(signature(0)))
+        self.assertLessEqual(len(replays), 4)
+
+    # A recorded hello replayed after its client has left, within the window, is turned away
+    def test_replayed_hello(self):
+        replays = ReplayFilter(WINDOW, 1 << 18)
+        hello = signature(7)
+        replays.add(hello)
+
+        # Other clients keep the filter busy while the client is connected, then it leaves
+        for i in range(100):
+            self.now += 5
+            replays.add(signature(100 + i))
+
+        self.assertTrue(replays.seen(hello))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+# Tests for session resumption tickets and the shared ticket store
+#
+# Usage: python3 -m pytest tests (or python3 -m unittest discover tests)
+
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import resumption
+from resumption import TicketBook, load_ticket_key, valid_counter
+
+ALICE = "a" * 64
+BOB = "b" * 64
+
+
+class TicketBookTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.key = load_ticket_key(os.path.join(self.directory.name, "resumption.key"))
+        self.path = os.path.join(self.directory.name, "resumption.db")
+
+    async def asyncSetUp(self):
+        self.book = self.open()
+
+    async def asyncTearDown(self):
+        if not self.book.closed:
+            await self.book.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self, lifetime=86400):
+        return TicketBook(self.key, lifetime, self.path)
+
+    async def test_resume(self):
+        ticket = await self.book.issue(ALICE, 5)
+        self.assertEqual(await self.book.check(ticket, ALICE), 5)
+        self.assertEqual(self.book.stats()["resumed"], 1)
+
+    async def test_single_use(self):
+        ticket = await self.book.issue(ALICE, 5)
+        self.assertEqual(await self.book.check(ticket, ALICE), 5)
+        self.assertIsNone(await self.book.check(ticket, ALICE))
+        self.assertEqual(self.book.stats()["rejected"], 1)
+
+    # Only the newest ticket of a client is accepted
+    async def test_newest_only(self):
+        old = await self.book.issue(ALICE, 5)
+        new = await self.book.issue(ALICE, 6)
+        self.assertIsNone(await self.book.check(old, ALICE))
+        self.assertEqual(await self.book.check(new, ALICE), 6)
+
+    async def test_wrong_fingerprint(self):
+        ticket = await self.book.issue(ALICE, 5)
+        self.assertIsNone(await self.book.check(ticket, BOB))
+        # Not used up by the failed attempt
+        self.assertEqual(await self.book.check(ticket, ALICE), 5)
+
+    async def test_tampered(self):
+        ticket = await self.book.issue(ALICE, 5)
+        payload, _, mac = ticket.rpartition(".")
+        fingerprint, counter, issued = payload.split(".")
+        for forged in (f"{fingerprint}.9.{issued}.{mac}", ticket[:-1] + ("1" if ticket.endswith("0") else "0"), "", None, 5):
+            self.assertIsNone(await self.book.check(forged, ALICE))
+
+    async def test_other_key(self):
+        ticket = await self.book.issue(ALICE, 5)
+        other = TicketBook(b"k" * resumption.TICKET_KEY_SIZE, 86400, self.path)
+        try:
+            self.assertIsNone(await other.check(ticket, ALICE))
+        finally:
+            await other.close()
+
+    async def test_expired(self):
+        await self.book.close()
+        self.book = self.open(lifetime=0.01)
+        ticket = await self.book.issue(ALICE, 5)
+        await asyncio.sleep(0.05)
+        self.assertIsNone(await self.book.check(ticket, ALICE))
+
+    # The last counter accepted from a client is kept across a restart, and
+    # a ticket from before is resumed with it
+    async def test_counter_saved(self):
+        ticket = await self.book.issue(ALICE, 5)
+        self.book.update_counter(ALICE, 40)
+        await self.book.save()
+        self.assertEqual(self.book.stats()["unsaved"], 0)
+        await self.book.close()
+
+        self.book = self.open()
+        self.assertEqual(await self.book.check(ticket, ALICE), 40)
+
+    async def test_counter_saved_on_disconnect(self):
+        ticket = await self.book.issue(ALICE, 5)
+        self.book.update_counter(ALICE, 7)
+        await self.book.save_counter(ALICE, 12)
+        self.assertEqual(self.book.stats()["unsaved"], 0)
+        self.assertEqual(await self.book.check(ticket, ALICE), 12)
+
+    async def test_counter_saved_on_close(self):
+        ticket = await self.book.issue(ALICE, 5)
+        self.book.update_counter(ALICE, 9)
+        await self.book.close()
+        # Ignored once closed (the server notes the counters of connected clients before closing)
+        await self.book.save_counter(ALICE, 50)
+
+        self.book = self.open()
+        self.assertEqual(await self.book.check(ticket, ALICE), 9)
+
+    # A counter never goes back
+    async def test_counter_only_increases(self):
+        ticket = await self.book.issue(ALICE, 5)
+        await self.book.save_counter(ALICE, 20)
+        self.book.update_counter(ALICE, 10)
+        await self.book.save()
+        self.assertEqual(await self.book.check(ticket, ALICE), 20)
+
+    # Counters that could not be saved are kept for the next save
+    async def test_save_failure(self):
+        ticket = await self.book.issue(ALICE, 5)
+        other = sqlite3.connect(self.path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        await self.book.call(self.book.execute, "PRAGMA busy_timeout = 0")
+        self.book.update_counter(ALICE, 30)
+        with self.assertLogs("olaf.resumption", "WARNING"):
+            await self.book.save()
+        self.assertEqual(self.book.stats()["unsaved"], 1)
+
+        other.execute("COMMIT")
+        other.close()
+        await self.book.save()
+        self.assertEqual(self.book.stats()["unsaved"], 0)
+        self.assertEqual(await self.book.check(ticket, ALICE), 30)
+
+
+class ValidCounterTest(unittest.TestCase):
+    def test_valid_counter(self):
+        for counter in (0, 1, 2**63 - 1):
+            self.assertTrue(valid_counter(counter))
+        for counter in (-1, 2**63, 2**70, 1.5, "5", None, True):
+            self.assertFalse(valid_counter(counter))
+
+
+if __name__ == "__main__":
+    unittest.main()